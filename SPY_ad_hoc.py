@@ -1,20 +1,16 @@
 from datetime import datetime, timedelta
 import matplotlib.ticker as ticker
-import backtrader as bt
 
 import matplotlib.pyplot as plt
-import akshare as ak
 import pandas as pd
 
-import os
+from market_panel import load_panel
 
 plt.rcParams["font.sans-serif"] = ["SimHei"]  # 设置字体
 plt.rcParams["axes.unicode_minus"] = False    # 该语句解决图像中的“-”负号的乱码问题
 
 
 
-DATA_PATH = './data'
-
 today = datetime.now().date()   #.strftime('%Y-%m-%d')
 ten_years_ago = today - timedelta(days=10*365)
 five_years_ago = today - timedelta(days=5*365)
@@ -28,16 +24,7 @@ start_date = datetime(2016,1,1)
 end_date = today
 
 
-data_df = pd.read_csv(os.path.join(DATA_PATH, 'spy.csv'))
-data_df['date'] = pd.to_datetime(data_df['date'], format='%Y-%m-%d') 
-data_df.set_index('date', inplace=True)
-    
-fear_greed_index_df = pd.read_csv(os.path.join(DATA_PATH, 'all_fng_csv.csv'))
-fear_greed_index_df.rename(columns={'Date': 'date'}, inplace=True)
-fear_greed_index_df['date'] = pd.to_datetime(fear_greed_index_df['date'], format='%Y-%m-%d') 
-fear_greed_index_df.set_index('date', inplace=True)
-    
-data_df['fear_greed'] = fear_greed_index_df['Fear Greed']    
+data_df = load_panel('spy')  # 价格和按日期对齐的恐贪指数
 
 data_df = data_df[(data_df.index >= pd.to_datetime(start_date)) & (data_df.index <= pd.to_datetime(end_date))]
 
@@ -0,0 +1,372 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块，不报告内存峰值
+    resource = None
+
+# 回测热点路径的性能基准。每个 (基准, 数据集, 规模) 在一个新的子进程中运行，这样内存峰值只属于这一项。
+#
+#   python benchmark.py                                  # 真实数据 + 合成数据 10x/100x/1000x
+#   python benchmark.py --only back_trade max_dd --scales 10 100
+#   python benchmark.py --output bench.json --baseline baseline.json   # 和保存的基准结果比较
+#
+# 合成数据为几何布朗运动（GBM）生成的净值面板和 OHLC 序列。面板类基准的规模按 sqrt(scale) 分别放大天数和基金数
+# （总数据量为 scale 倍），单序列基准按 scale 放大天数。
+
+SYNTHETIC_DAYS = 2500       # 1x 的净值面板天数，约 10 年
+SYNTHETIC_FUNDS = 7         # 1x 的基金数，同 Portfolio_LaoHuangNiu
+SYNTHETIC_BARS = 5000       # 1x 的 OHLC 序列长度，约 20 年，和 spy.csv / qqq.csv 相当
+REBALANCE_DAYS = 220
+
+DEFAULT_SCALES = [10, 100, 1000]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.10    # 和基准结果比较时，耗时变化超过 10% 视为变慢/变快
+
+
+def synthetic_dates(num_days: int) -> pd.DatetimeIndex:
+    ''' 工作日日期；超过 pandas 日期范围能容纳的天数时改用分钟，算法只关心行数 '''
+    freq = 'B' if num_days <= 50000 else 'min'  # 1990 年起 5 万个工作日约到 2180 年，datetime64[ns] 最多到 2262 年
+    return pd.date_range('1990-01-01', periods=num_days, freq=freq, name='date')
+
+
+def gbm_paths(num_days: int, num_paths: int, seed: int = 0, mu: float = 0.02, sigma: float = 0.2) -> np.ndarray:
+    '''
+    (天数, 路径数) 的几何布朗运动，初值为 1，按每年 250 个交易日。
+    默认 mu = sigma^2 / 2，对数价格没有漂移，1000x（上万年）的序列也不会溢出。
+    '''
+    rng = np.random.default_rng(seed)
+    dt = 1 / 250
+    log_returns = (mu - sigma ** 2 / 2) * dt + sigma * math.sqrt(dt) * rng.standard_normal((num_days, num_paths))
+    log_returns[0] = 0.0
+    return np.exp(np.cumsum(log_returns, axis=0))
+
+
+def synthetic_nav_panel(num_days: int, num_funds: int, seed: int = 0) -> pd.DataFrame:
+    ''' 和 load_portfolio_funds_data 相同格式的净值面板，列名为 F0000, F0001, ... '''
+    sigmas = np.linspace(0.02, 0.3, num_funds)  # 从债基到股基
+    paths = gbm_paths(num_days, num_funds, seed=seed) ** (sigmas / 0.2)
+    return pd.DataFrame(paths, index=synthetic_dates(num_days), columns=['F{:04d}'.format(i) for i in range(num_funds)])
+
+
+def synthetic_portfolio(tickers) -> pd.DataFrame:
+    ''' 等权组合，格式同 fund_code.Portfolio_Columns '''
+    import fund_code
+    portfolio_df = pd.DataFrame([[ticker, ticker, 100 / len(tickers), fund_code.TYPE_EQUITY] for ticker in tickers],
+                                columns=fund_code.Portfolio_Columns)
+    return portfolio_df.set_index('ticker')
+
+
+def synthetic_ohlc(num_bars: int, seed: int = 0) -> pd.DataFrame:
+    ''' 和 load_strategy_data / load_analysis_data 相同列的数据：open, high, low, close, adj close, volume, rsi, fear_greed, psar '''
+    from native_indicators import parabolic_sar, rsi_safe
+
+    rng = np.random.default_rng(seed)
+    closes = 100 * gbm_paths(num_bars, 1, seed=seed)[:, 0]
+    opens = np.concatenate([[closes[0]], closes[:-1]])
+    highs = np.maximum(opens, closes) * (1 + np.abs(rng.normal(0, 0.005, num_bars)))
+    lows = np.minimum(opens, closes) * (1 - np.abs(rng.normal(0, 0.005, num_bars)))
+    fear_greed = np.abs((np.cumsum(rng.normal(0, 3, num_bars)) + 50) % 200 - 100).round()  # 在 0 到 100 之间反射的随机游走
+    data_df = pd.DataFrame({'open': opens, 'high': highs, 'low': lows, 'close': closes, 'adj close': closes,
+                            'volume': rng.integers(10**6, 10**8, num_bars), 'rsi': np.nan_to_num(rsi_safe(closes), nan=50.0),
+                            'fear_greed': fear_greed}, index=synthetic_dates(num_bars))
+    data_df['psar'] = parabolic_sar(highs, lows, closes, period=20, af=0.015)
+    return data_df
+
+
+def _panel_shape(scale: int):
+    factor = math.sqrt(scale)
+    return int(round(SYNTHETIC_DAYS * factor)), int(round(SYNTHETIC_FUNDS * factor))
+
+
+def _real_portfolio():
+    import fund_code
+    portfolio_df = pd.DataFrame(fund_code.Portfolio_LaoHuangNiu, columns=fund_code.Portfolio_Columns)
+    return portfolio_df.set_index('ticker')
+
+
+def _real_panel(portfolio_df):
+    from fund_data_prepare_util import load_portfolio_funds_data
+    return load_portfolio_funds_data(portfolio_df.index, pd.to_datetime('2016-01-01'), pd.to_datetime('2024-04-22')).ffill().bfill()
+
+
+# 每个基准的 setup(dataset, scale) 返回 (run 的参数, 处理的 bar 数)，只有 run 计时。
+# 被测模块在 setup 中导入，导入时间（例如 akshare）不计入 run
+
+def _setup_back_trade(dataset, scale):
+    import fund_backtrade_util
+    if dataset == 'real':
+        portfolio_df = _real_portfolio()
+        panel_df = _real_panel(portfolio_df)
+    else:
+        panel_df = synthetic_nav_panel(*_panel_shape(scale))
+        portfolio_df = synthetic_portfolio(panel_df.columns)
+    return (portfolio_df, panel_df), panel_df.size
+
+
+def _run_back_trade(portfolio_df, panel_df):
+    from fund_backtrade_util import fund_portfolio_back_trade
+    fund_portfolio_back_trade(portfolio_df, panel_df, REBALANCE_DAYS)
+
+
+def _setup_max_dd(dataset, scale):
+    import fund_backtrade_util
+    if dataset == 'real':
+        panel_df = _real_panel(_real_portfolio())
+    else:
+        panel_df = synthetic_nav_panel(*_panel_shape(scale))
+    return (panel_df,), panel_df.size
+
+
+def _run_max_dd(panel_df):
+    from fund_backtrade_util import calculate_max_dd
+    calculate_max_dd(panel_df)
+
+
+def _setup_load_funds(dataset, scale):
+    ''' 合成数据写入临时目录中的净值存储，运行结束后删除 '''
+    import fund_nav_store
+    if dataset == 'real':
+        tickers = _real_portfolio().index
+        start_date, end_date = pd.to_datetime('2016-01-01'), pd.to_datetime('2024-04-22')
+        for ticker in tickers:
+            fund_nav_store.ensure_nav(ticker)
+    else:
+        panel_df = synthetic_nav_panel(*_panel_shape(scale))
+        store_dir = tempfile.mkdtemp(prefix='nav_store_')
+        fund_nav_store.DATA_PATH = store_dir
+        fund_nav_store.STORE_PATH = store_dir
+        for ticker in panel_df.columns:
+            fund_nav_store.write_nav(ticker, pd.DataFrame({'date': panel_df.index, 'net_value': panel_df[ticker].to_numpy()}))
+        tickers = pd.Index(panel_df.columns)
+        start_date, end_date = panel_df.index[0], panel_df.index[-1]
+    from fund_data_prepare_util import load_portfolio_funds_data
+    panel_df = load_portfolio_funds_data(tickers, start_date, end_date)  # 同时作为预热，打开 memory-mapped 文件
+    return (tickers, start_date, end_date), panel_df.size
+
+
+def _run_load_funds(tickers, start_date, end_date):
+    from fund_data_prepare_util import load_portfolio_funds_data
+    load_portfolio_funds_data(tickers, start_date, end_date)
+
+
+def _teardown_load_funds(dataset):
+    import fund_nav_store
+    if dataset != 'real':
+        shutil.rmtree(fund_nav_store.STORE_PATH, ignore_errors=True)
+
+
+def _setup_run_strategy(dataset, scale):
+    from bt_Monkey_spy_qqq import load_strategy_data
+    if dataset == 'real':
+        data_df = load_strategy_data('spy')
+    else:
+        data_df = synthetic_ohlc(SYNTHETIC_BARS * scale).drop(columns=['psar'])
+    return (data_df,), len(data_df)
+
+
+def _run_run_strategy(data_df):
+    from bt_Monkey_spy_qqq import run_strategy
+    from common import Loglevel
+    run_strategy(ticker='benchmark', start_date=data_df.index[0], end_date=data_df.index[-1], fear_greed=True, rsi=True, psar=True,
+                 follow_signals=True, loglevel=Loglevel.NONE, data_df=data_df)
+
+
+def _setup_event_study(dataset, scale):
+    from spy_qqq_analysis import load_analysis_data
+    if dataset == 'real':
+        data_df = load_analysis_data('qqq')
+    else:
+        data_df = synthetic_ohlc(SYNTHETIC_BARS * scale)
+    return (data_df,), len(data_df)
+
+
+def _run_event_study(data_df):
+    ''' spy_qqq_analysis.calc 的计算部分（calc 只是对 event_study 的包装），所有默认信号 × 4 个回看期 × 3 个持有期 '''
+    from spy_qqq_analysis import event_study, default_signals
+    years = (data_df.index[-1] - data_df.index[0]).days / 365
+    event_study(data_df, default_signals(data_df), years_options=[years / 8, years / 4, years / 2, years],
+                interval_options=[7, 22, 66], end_date=data_df.index[-1])
+
+
+# name -> (setup, run, teardown, 最大规模)。backtrader 逐根 bar 运行，1000x（500 万根 bar）需要很长时间，默认只跑到 100x
+BENCHMARKS = {
+    'back_trade': (_setup_back_trade, _run_back_trade, None, 1000),
+    'max_dd': (_setup_max_dd, _run_max_dd, None, 1000),
+    'load_funds': (_setup_load_funds, _run_load_funds, _teardown_load_funds, 1000),
+    'run_strategy': (_setup_run_strategy, _run_run_strategy, None, 100),
+    'event_study': (_setup_event_study, _run_event_study, None, 1000),
+}
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024  # macOS 为字节，Linux 为 KB
+
+
+def _run_case(case):
+    ''' 在子进程中运行一项基准：setup 不计时，run 重复 repeat 次 '''
+    name, dataset, scale, repeat = case
+    setup, run, teardown, _ = BENCHMARKS[name]
+    args, bars = setup(dataset, scale)
+    rss_before = _peak_rss_mb()
+    try:
+        wall_times = []
+        for _ in range(repeat):
+            start_time = time.perf_counter()
+            run(*args)
+            wall_times.append(time.perf_counter() - start_time)
+    finally:
+        if teardown is not None:
+            teardown(dataset)
+    peak_rss = _peak_rss_mb()
+    wall_time = statistics.median(wall_times)
+    return dict(name=name, dataset=dataset, scale=scale, bars=int(bars), repeat=repeat,
+                wall_time_s=wall_time, wall_time_min_s=min(wall_times),
+                bars_per_sec=bars / wall_time if wall_time > 0 else None,
+                peak_rss_mb=peak_rss, rss_growth_mb=None if peak_rss is None else peak_rss - rss_before)
+
+
+# 启动时间基准：在新的 Python 进程中只导入模块，记录导入耗时和被加载的重量级依赖。
+# 组合回测（fund_*）和参数扫描的每个子进程都要付出这部分开销
+STARTUP_MODULES = ['fund_backtrade_util', 'fund_data_prepare_util', 'fund_portfolio_back_trade_timing',
+                   'bt_Monkey_spy_qqq', 'spy_qqq_analysis', 'bt_qqq_simple']
+HEAVY_DEPENDENCIES = ['akshare', 'backtrader', 'matplotlib', 'seaborn']
+
+_STARTUP_SCRIPT = '''
+import json, sys, time
+start_time = time.perf_counter()
+import {module}
+import_s = time.perf_counter() - start_time
+print(json.dumps(dict(import_s=import_s, loaded=[name for name in {heavy!r} if name in sys.modules])))
+'''
+
+
+def startup_benchmark(modules=None, repeat: int = DEFAULT_REPEAT, progress: bool = True) -> list:
+    '''
+    每个模块在 repeat 个新进程中分别导入，返回每个模块一条记录：import_s（中位数）, import_min_s，
+    以及导入后已经加载的 HEAVY_DEPENDENCIES。
+    '''
+    results = []
+    for module in modules or STARTUP_MODULES:
+        script = _STARTUP_SCRIPT.format(module=module, heavy=HEAVY_DEPENDENCIES)
+        runs = [json.loads(subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                                          cwd=os.path.dirname(os.path.abspath(__file__))).stdout)
+                for _ in range(repeat)]
+        import_times = [run['import_s'] for run in runs]
+        result = dict(name=module, import_s=statistics.median(import_times), import_min_s=min(import_times),
+                      loaded=runs[0]['loaded'])
+        results.append(result)
+        if progress:
+            print('{name:<34} {import_s:8.3f}s  {loaded}'.format(**result), flush=True)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names=None, scales=DEFAULT_SCALES, real: bool = True, repeat: int = DEFAULT_REPEAT,
+                   all_scales: bool = False, progress: bool = True) -> dict:
+    '''
+    运行基准，返回可以直接保存为 JSON 的 dict：meta（运行环境）和 results（每项一条记录）。
+
+    Parameters:
+    - names: BENCHMARKS 中的名称列表，默认全部
+    - scales: 合成数据的规模列表，超过基准最大规模的组合会被跳过（all_scales 为 True 时不跳过）
+    - real: 是否包括 data/ 中的真实数据
+    '''
+    names = names or list(BENCHMARKS.keys())
+    cases = []
+    for name in names:
+        max_scale = BENCHMARKS[name][3]
+        if real:
+            cases.append((name, 'real', 1, repeat))
+        cases.extend((name, 'synthetic', scale, repeat) for scale in scales if all_scales or scale <= max_scale)
+
+    results = []
+    # spawn + 每个进程只运行一项，内存峰值和导入状态互不影响
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=1, maxtasksperchild=1) as pool:
+        for result in pool.imap(_run_case, cases):
+            results.append(result)
+            if progress:
+                print('{name:<14} {dataset:<9} {scale:>5}x  {bars:>10} bars  {wall_time_s:8.3f}s  {bars_per_sec:14,.0f} bars/s  '
+                      'peak {peak_rss_mb:8.1f} MB'.format(**result), flush=True)
+
+    meta = dict(timestamp=datetime.now().isoformat(timespec='seconds'), commit=_git_commit(),
+                python=platform.python_version(), numpy=np.__version__, pandas=pd.__version__,
+                platform=platform.platform(), cpu_count=os.cpu_count(), repeat=repeat)
+    return dict(meta=meta, results=results)
+
+
+def compare_to_baseline(report: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> pd.DataFrame:
+    '''
+    按 (name, dataset, scale) 和基准结果比较耗时和内存。
+    time_ratio 为 当前耗时 / 基准耗时，超过 1 + threshold 为 slower，低于 1 - threshold 为 faster。
+    '''
+    key_columns = ['name', 'dataset', 'scale']
+    current_df = pd.DataFrame(report['results'])
+    baseline_df = pd.DataFrame(baseline['results'])[key_columns + ['wall_time_s', 'peak_rss_mb']]
+    compare_df = current_df[key_columns + ['wall_time_s', 'peak_rss_mb']].merge(baseline_df, on=key_columns, how='left', suffixes=('', '_baseline'))
+    compare_df['time_ratio'] = compare_df['wall_time_s'] / compare_df['wall_time_s_baseline']
+    compare_df['rss_ratio'] = compare_df['peak_rss_mb'] / compare_df['peak_rss_mb_baseline']
+    compare_df['status'] = np.select([compare_df['time_ratio'].isna(), compare_df['time_ratio'] > 1 + threshold, compare_df['time_ratio'] < 1 - threshold],
+                                     ['new', 'slower', 'faster'], default='same')
+    return compare_df
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='回测热点路径的性能基准')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS.keys()), help='只运行这些基准')
+    parser.add_argument('--scales', nargs='*', type=int, default=DEFAULT_SCALES, help='合成数据的规模')
+    parser.add_argument('--no-real', action='store_true', help='不运行 data/ 中的真实数据')
+    parser.add_argument('--all-scales', action='store_true', help='不跳过超过基准最大规模的组合')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+    parser.add_argument('--output', help='结果保存为 JSON 文件')
+    parser.add_argument('--baseline', help='和保存的基准结果（--output 的文件）比较')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--startup', action='store_true', help='只运行启动时间基准（导入各模块的耗时）')
+    args = parser.parse_args()
+
+    if args.startup:
+        startup_results = startup_benchmark(repeat=args.repeat)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(dict(meta=dict(timestamp=datetime.now().isoformat(timespec='seconds'), commit=_git_commit(),
+                                         python=platform.python_version()), startup=startup_results), f, indent=2)
+        sys.exit(0)
+
+    report = run_benchmarks(names=args.only, scales=args.scales, real=not args.no_real, repeat=args.repeat, all_scales=args.all_scales)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare_df = compare_to_baseline(report, json.load(f), threshold=args.threshold)
+        print(compare_df.to_string(index=False, float_format='{:.3f}'.format))
+        if (compare_df['status'] == 'slower').any():
+            sys.exit(1)
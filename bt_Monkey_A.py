@@ -2,18 +2,22 @@ from datetime import datetime
 
 import backtrader as bt
 
-import matplotlib.pyplot as plt
-import akshare as ak
 import pandas as pd
 
-from common import prepare_cn_fund_data
+from common import prepare_cn_fund_data, Loglevel
+from headless import run_headless
 from fund_code import *
 import os
 
 class MonkeyStrategy(bt.Strategy):
+    params = (
+        ('loglevel', Loglevel.DETAIL),
+    )
 
     def log(self, txt, dt=None):
         ''' Logging function fot this strategy'''
+        if self.p.loglevel < Loglevel.DETAIL:
+            return
         dt = dt or self.datas[0].datetime.date(0)
         print('%s, %s' % (dt.isoformat(), txt))
         
@@ -101,7 +105,7 @@ class MonkeyStrategy(bt.Strategy):
         signal = self.check_signals()
         
         if signal == 1:
-            size = int(cerebro.broker.get_cash() / self.close_price[0]) -1
+            size = int(self.broker.get_cash() / self.close_price[0]) -1
             if size > 0:
                 self.log('Indicators for BUY: RSI: %.2f' % (self.rsi[0]))
                 self.log('BUY CREATE, Price = %.2f, Shares = %.2f' % (self.close_price[0], size))
@@ -113,6 +117,7 @@ class MonkeyStrategy(bt.Strategy):
 
     
 DATA_PATH='./data'
+HEADLESS = False  # True: 用 headless.run_headless 运行，不画图，只输出回测结果
 
 class CustomPandasData(bt.feeds.PandasData):
     lines = ('rsi',)
@@ -120,6 +125,7 @@ class CustomPandasData(bt.feeds.PandasData):
     plotinfo = {"plot": True, "subplot": True}
         
 if __name__ == '__main__':
+    import akshare as ak  # 只在下载数据时导入
     data_df = ak.stock_zh_index_daily_em(symbol="sh000300").iloc[:, :6]
     data_df.columns = [
     'date',
@@ -133,43 +139,46 @@ if __name__ == '__main__':
     # 把 date 作为日期索引，以符合 Backtrader 的要求
     data_df.index = pd.to_datetime(data_df['date'])
     
-    cerebro = bt.Cerebro()  # 初始化回测系统
-    # cerebro = bt.Cerebro(stdstats=False)
     start_date = datetime(2018, 11, 16)  # 回测开始时间
     end_date = datetime(2023, 11, 16)  # 回测结束时间
     
     data = CustomPandasData(dataname=data_df, fromdate=start_date, todate=end_date, rsi=5)
 
-    cerebro.adddata(data)
-    
-    cerebro.addstrategy(MonkeyStrategy)  # 将交易策略加载到回测系统中
     start_cash = 1000000
-    cerebro.broker.setcash(start_cash)  # 设置初始资本为 1,000,000
-    cerebro.broker.setcommission(commission=0.00012)  # 设置交易手续费为 万分之 1.2
-    cerebro.broker.set_coc(True) # 以订单创建日的收盘价成交 cheat-on-close
+    if HEADLESS:
+        print(run_headless(MonkeyStrategy, data, start_cash, commission=0.00012, coc=True, loglevel=Loglevel.NONE))
+    else:
+        cerebro = bt.Cerebro()  # 初始化回测系统
+        # cerebro = bt.Cerebro(stdstats=False)
+        cerebro.adddata(data)
+    
+        cerebro.addstrategy(MonkeyStrategy)  # 将交易策略加载到回测系统中
+        cerebro.broker.setcash(start_cash)  # 设置初始资本为 1,000,000
+        cerebro.broker.setcommission(commission=0.00012)  # 设置交易手续费为 万分之 1.2
+        cerebro.broker.set_coc(True) # 以订单创建日的收盘价成交 cheat-on-close
             
-    cerebro.addobserver(bt.observers.Value)
-    cerebro.addobserver(bt.observers.BuySell)
-    # cerebro.addobserver(bt.observers.DrawDown)
+        cerebro.addobserver(bt.observers.Value)
+        cerebro.addobserver(bt.observers.BuySell)
+        # cerebro.addobserver(bt.observers.DrawDown)
     
     
-    cerebro.run(stdstats=False)  # 运行回测系统
+        cerebro.run(stdstats=False)  # 运行回测系统
     
-    # assert(broker, bt.brokers.bbroker.BackBroker)    
+        # assert(broker, bt.brokers.bbroker.BackBroker)    
 
-    port_value = cerebro.broker.getvalue()  # 获取回测结束后的总资金
-    pnl = port_value - start_cash  # 盈亏统计
+        port_value = cerebro.broker.getvalue()  # 获取回测结束后的总资金
+        pnl = port_value - start_cash  # 盈亏统计
 
-    print(f"初始资金: {start_cash}\n回测期间: {start_date.strftime('%Y%m%d')} - {end_date.strftime('%Y%m%d')}")
-    print(f"总资金: {round(port_value, 2)}")
-    print(f"净收益: {round(pnl, 2)}")
+        print(f"初始资金: {start_cash}\n回测期间: {start_date.strftime('%Y%m%d')} - {end_date.strftime('%Y%m%d')}")
+        print(f"总资金: {round(port_value, 2)}")
+        print(f"净收益: {round(pnl, 2)}")
     
-    start_price = data_df['close'][start_date]
-    end_price = data_df['close'][end_date]
-    print('市场标普500, 起始日: {:.2f}, 结束日：{:.2f}, 涨幅：{:.2f}%  '.format(start_price, end_price, (end_price/start_price-1)*100))
+        start_price = data_df['close'][start_date]
+        end_price = data_df['close'][end_date]
+        print('市场标普500, 起始日: {:.2f}, 结束日：{:.2f}, 涨幅：{:.2f}%  '.format(start_price, end_price, (end_price/start_price-1)*100))
     
     
-    cerebro.plot()
+        cerebro.plot()
 
 
     
\ No newline at end of file
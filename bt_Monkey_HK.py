@@ -2,18 +2,20 @@ from datetime import datetime
 
 import backtrader as bt
 
-import matplotlib.pyplot as plt
-import akshare as ak
-import pandas as pd
-
-from common import prepare_cn_fund_data
+from common import prepare_cn_fund_data, Loglevel
+from headless import run_headless
+from data_cache import read_canonical
 from fund_code import *
-import os
 
 class MonkeyStrategy(bt.Strategy):
+    params = (
+        ('loglevel', Loglevel.DETAIL),
+    )
 
     def log(self, txt, dt=None):
         ''' Logging function fot this strategy'''
+        if self.p.loglevel < Loglevel.DETAIL:
+            return
         dt = dt or self.datas[0].datetime.date(0)
         print('%s, %s' % (dt.isoformat(), txt))
         
@@ -106,7 +108,7 @@ class MonkeyStrategy(bt.Strategy):
         
         # if self.fear_greed[0] < 25:
         if signal == 1:
-            size = int(cerebro.broker.get_cash() / self.close_price[0]) 
+            size = int(self.broker.get_cash() / self.close_price[0]) 
             if size > 0:
                 self.log('Indicators for BUY: RSI: %.2f' % (self.rsi[0]))
                 self.log('BUY CREATE, Price = %.2f, Shares = %.2f' % (self.close_price[0], size))
@@ -117,7 +119,7 @@ class MonkeyStrategy(bt.Strategy):
             self.order = self.sell(size=self.position.size)
 
     
-DATA_PATH='./data'
+HEADLESS = False  # True: 用 headless.run_headless 运行，不画图，只输出回测结果
 
 class CustomPandasData(bt.feeds.PandasData):
     lines = ('rsi',)
@@ -127,43 +129,44 @@ class CustomPandasData(bt.feeds.PandasData):
 if __name__ == '__main__':
     
     ticker = '3032.HK'
-    data_df = pd.read_csv(os.path.join(DATA_PATH, ticker + '.csv'))
-    data_df['date'] = pd.to_datetime(data_df['date'], format='%Y-%m-%d') 
-    data_df.set_index('date', inplace=True)
+    data_df = read_canonical(ticker + '.csv')
     
-    cerebro = bt.Cerebro()  # 初始化回测系统
-    # cerebro = bt.Cerebro(stdstats=False)
     start_date = datetime(2020, 9, 2)  # 回测开始时间
     end_date = datetime(2023, 11, 28)  # 回测结束时间
     
     data = CustomPandasData(dataname=data_df, fromdate=start_date, todate=end_date, rsi=6)
 
-    cerebro.adddata(data)
-    
-    cerebro.addstrategy(MonkeyStrategy)  # 将交易策略加载到回测系统中
     start_cash = 1000000
-    cerebro.broker.setcash(start_cash)  # 设置初始资本为 1,000,000
-    # cerebro.broker.setcommission(commission=0.00012)  # 设置交易手续费为 万分之 1.2
-    cerebro.broker.set_coc(True) # 以订单创建日的收盘价成交 cheat-on-close
+    if HEADLESS:
+        print(run_headless(MonkeyStrategy, data, start_cash, coc=True, loglevel=Loglevel.NONE))
+    else:
+        cerebro = bt.Cerebro()  # 初始化回测系统
+        # cerebro = bt.Cerebro(stdstats=False)
+        cerebro.adddata(data)
+    
+        cerebro.addstrategy(MonkeyStrategy)  # 将交易策略加载到回测系统中
+        cerebro.broker.setcash(start_cash)  # 设置初始资本为 1,000,000
+        # cerebro.broker.setcommission(commission=0.00012)  # 设置交易手续费为 万分之 1.2
+        cerebro.broker.set_coc(True) # 以订单创建日的收盘价成交 cheat-on-close
             
-    cerebro.addobserver(bt.observers.Value)
-    cerebro.addobserver(bt.observers.BuySell)    
+        cerebro.addobserver(bt.observers.Value)
+        cerebro.addobserver(bt.observers.BuySell)    
     
-    cerebro.run(stdstats=False)  # 运行回测系统
+        cerebro.run(stdstats=False)  # 运行回测系统
 
-    port_value = cerebro.broker.getvalue()  # 获取回测结束后的总资金
-    pnl = port_value - start_cash  # 盈亏统计
+        port_value = cerebro.broker.getvalue()  # 获取回测结束后的总资金
+        pnl = port_value - start_cash  # 盈亏统计
 
-    print(f"初始资金: {start_cash}\n回测期间: {start_date.strftime('%Y%m%d')} - {end_date.strftime('%Y%m%d')}")
-    print(f"总资金: {round(port_value, 2)}")
-    print(f"净收益: {round(pnl, 2)}")
+        print(f"初始资金: {start_cash}\n回测期间: {start_date.strftime('%Y%m%d')} - {end_date.strftime('%Y%m%d')}")
+        print(f"总资金: {round(port_value, 2)}")
+        print(f"净收益: {round(pnl, 2)}")
     
-    start_price = data_df['close'][start_date]
-    end_price = data_df['close'][end_date]
-    print('起始日: {:.2f}, 结束日：{:.2f}, 涨幅：{:.2f}%  '.format(start_price, end_price, (end_price/start_price-1)*100))
+        start_price = data_df['close'][start_date]
+        end_price = data_df['close'][end_date]
+        print('起始日: {:.2f}, 结束日：{:.2f}, 涨幅：{:.2f}%  '.format(start_price, end_price, (end_price/start_price-1)*100))
     
     
-    cerebro.plot()
+        cerebro.plot()
 
 
     
\ No newline at end of file
@@ -1,16 +1,17 @@
 import backtrader as bt
-import matplotlib.pyplot as plt
-import akshare as ak
 import pandas as pd
-import os
+import itertools
+import multiprocessing
+import time
 
 from datetime import datetime, timedelta
 from common import Signal, Loglevel
-from common import MyParabolicSAR, MyDrawDown
-from common import RsiFngPandasData, RsiFngObserver
-from common import ProfitLossAnalyzer, ValueRecorder
-
-DATA_PATH='./data'
+from common import MyParabolicSAR, EquityAnalyzer
+from common import RsiFngPandasData, RsiFngObserver, IndicatorPandasData, PrecomputedIndicator
+from indicator_cache import add_monkey_indicators
+from headless import run_headless
+from market_panel import load_panel
+from phase_timer import span, record, timing_enabled, init_worker_timing, drain_worker_spans, merge_worker_spans
 
 psar_s = pd.Series()  
 
@@ -25,6 +26,8 @@ class MonkeyStrategy(bt.Strategy):
         ('rsi_overbought', 70),
         ('psar', False),
         ('psar_sensitivity', 1),
+        ('follow_signals', False),  # False: 第一天全仓买入并持有；True: 之后根据指标信号买入/清仓
+        ('precomputed_indicators', False),  # True: 使用数据中预先计算好的 psar、rsi_safe、sma 列，见 IndicatorPandasData
         ('loglevel', Loglevel.SUMMARY)
     )
 
@@ -35,12 +38,20 @@ class MonkeyStrategy(bt.Strategy):
             print('%s, %s' % (dt.isoformat(), txt))        
         
     def __init__(self):
+        self.init_time = time.perf_counter()  # 数据已经预加载完成，run_strategy 用来划分计时阶段
+        self.stop_time = None
+        self.orders_completed = 0
         self.close_price = self.datas[0].close  # 指定价格序列
         self.fear_greed = self.datas[0].fear_greed    
-        self.psar = MyParabolicSAR(period=20, af = 0.015)
-        self.rsi = bt.indicators.RSI_Safe(self.data.close, period=14)
-        # self.rsi = self.datas[0].rsi
-        self.sma = bt.indicators.SimpleMovingAverage(self.data.close, period=50)
+        if self.p.precomputed_indicators:
+            self.psar = PrecomputedIndicator(self.datas[0].psar, period=20)
+            self.rsi = PrecomputedIndicator(self.datas[0].rsi_safe, period=14 + 1)
+            self.sma = PrecomputedIndicator(self.datas[0].sma, period=50)
+        else:
+            self.psar = MyParabolicSAR(period=20, af = 0.015)
+            self.rsi = bt.indicators.RSI_Safe(self.data.close, period=14)
+            # self.rsi = self.datas[0].rsi
+            self.sma = bt.indicators.SimpleMovingAverage(self.data.close, period=50)
         
         # To keep track of pending orders and buy price/commission
         self.order = None
@@ -61,6 +72,7 @@ class MonkeyStrategy(bt.Strategy):
         # Check if an order has been completed
         # Attention: broker could reject order if not enough cash
         if order.status in [order.Completed]:
+            self.orders_completed += 1
             if order.isbuy():
                 self.log(
                     'BUY EXECUTED, Price: %.2f, Shares: %.2f, Cost: %.2f, Comm %.2f' %
@@ -132,6 +144,9 @@ class MonkeyStrategy(bt.Strategy):
         if self.p.psar:
             signals.append(self.check_psar_indicator())
         
+        if not signals:  # 没有启用任何指标
+            return Signal.NO_SIGNAL
+        
         num_of_buy = signals.count(Signal.BUY_SIGNAL)
         if num_of_buy / len(signals) > 0.5:  # 如果大部分indicator提示买入
             return Signal.BUY_SIGNAL
@@ -173,12 +188,29 @@ class MonkeyStrategy(bt.Strategy):
             self.all_in()
             self.first_day = False
         
-        # signal = self.check_indicators()
+        if not self.p.follow_signals:
+            return
+        
+        signal = self.check_indicators()
         
-        # if signal == Signal.BUY_SIGNAL:            
-        #     self.all_in()
-        # elif signal == Signal.SELL_SIGNAL and self.position.size > 0:
-        #     self.close_position()
+        if signal == Signal.BUY_SIGNAL:            
+            self.all_in()
+        elif signal == Signal.SELL_SIGNAL and self.position.size > 0:
+            self.close_position()
+
+    def stop(self):
+        self.stop_time = time.perf_counter()
+
+
+def load_strategy_data(ticker: str = 'spy') -> pd.DataFrame:
+    '''
+    读取 ticker 的行情面板（见 market_panel）：data/<ticker>.csv 的各列，按日期对齐的恐贪指数 fear_greed，以及 psar。
+    数据为只读的 memory-mapped 数组，run_strategy 按区间切片后使用。
+    '''
+    with span('load_strategy_data.panel', ticker=ticker) as load_span:
+        data_df = load_panel(ticker)
+        load_span.set(rows=len(data_df))
+    return data_df
 
 
 def run_strategy(ticker: str = 'spy', 
@@ -192,38 +224,58 @@ def run_strategy(ticker: str = 'spy',
                  rsi_overbought: int = 70,
                  psar: bool = False,
                  psar_sensitivity: int = 1,
+                 follow_signals: bool = False,
                  plotting: bool = False,
-                 loglevel: int = Loglevel.SUMMARY):
-    
-    data_df = pd.read_csv(os.path.join(DATA_PATH, ticker + '.csv'))
-    data_df['date'] = pd.to_datetime(data_df['date'], format='%Y-%m-%d') 
-    data_df.set_index('date', inplace=True)
+                 loglevel: int = Loglevel.SUMMARY,
+                 data_df: pd.DataFrame = None,
+                 indicator_cache: bool = False,
+                 headless: bool = False):
+    '''
+    运行一次 MonkeyStrategy 回测。data_df 为 load_strategy_data 预先加载的数据，不传时从 CSV 读取。
+    indicator_cache 为 True 时，指标从 indicator_cache 的磁盘缓存中读取，同样的数据和参数只计算一次。
+    调用 phase_timer.enable_timing() 后，记录准备数据、预加载、逐根 bar 运行、分析器和画图各阶段的耗时。
+    headless 为 True 时用 headless.run_headless 运行：没有 observer、不画图、不输出，内存不随回测区间增长，用于参数扫描。
+
+    Returns:
+    - dict: return_percent（策略收益率）, max_drawdown_percent, benchmark_percent（同期持有不动的涨幅）
+    '''
+    if data_df is None:
+        data_df = load_strategy_data(ticker)
     
-    fear_greed_index_df = pd.read_csv(os.path.join(DATA_PATH, 'all_fng_csv.csv'))
-    fear_greed_index_df.rename(columns={'Date': 'date'}, inplace=True)
-    fear_greed_index_df['date'] = pd.to_datetime(fear_greed_index_df['date'], format='%Y-%m-%d') 
-    fear_greed_index_df.set_index('date', inplace=True)
+    with span('run_strategy.slice') as slice_span:
+        data_df = data_df[(data_df.index >= start_date) & (data_df.index <= end_date)]
+        slice_span.set(rows=len(data_df))
     
-    data_df['fear_greed'] = fear_greed_index_df['Fear Greed']    
+    if indicator_cache:
+        with span('run_strategy.indicator_cache', rows=len(data_df)):
+            indicators_df = add_monkey_indicators(ticker, data_df)
+        data = IndicatorPandasData(dataname=indicators_df, fromdate=start_date, todate=end_date, rsi=6, fear_greed=7)
+    else:
+        data = RsiFngPandasData(dataname=data_df, fromdate=start_date, todate=end_date, rsi=6, fear_greed=7)
     
+    strategy_params = dict(fear_greed = fear_greed,
+                           fear_greed_extreme_fear = fear_greed_extreme_fear,
+                           fear_greed_extreme_greed = fear_greed_extreme_greed,
+                           rsi = rsi,
+                           rsi_oversold = rsi_oversold,
+                           rsi_overbought = rsi_overbought,
+                           psar = psar,
+                           psar_sensitivity = psar_sensitivity,
+                           follow_signals = follow_signals,
+                           precomputed_indicators = indicator_cache,
+                           loglevel = loglevel)
+    start_cash = 1000000
+    benchmark_percent = (data_df['close'].iloc[-1] / data_df['close'].iloc[0] - 1) * 100
+    if headless:
+        with span('run_strategy.headless', bars=len(data_df)):
+            result = run_headless(MonkeyStrategy, data, start_cash, coc=True, **strategy_params)
+        return dict(return_percent=result['return_percent'],
+                    max_drawdown_percent=result['max_drawdown_percent'],
+                    benchmark_percent=benchmark_percent)
+
     cerebro = bt.Cerebro()  # 初始化回测系统
-    
-    data_df = data_df[(data_df.index >= start_date) & (data_df.index <= end_date)]
-    
-    data = RsiFngPandasData(dataname=data_df, fromdate=start_date, todate=end_date, rsi=6, fear_greed=7)
     cerebro.adddata(data)
-    
-    cerebro.addstrategy(MonkeyStrategy, 
-                        fear_greed = fear_greed,
-                        fear_greed_extreme_fear = fear_greed_extreme_fear,
-                        fear_greed_extreme_greed = fear_greed_extreme_greed,
-                        rsi = rsi,                                              
-                        rsi_oversold = rsi_oversold,
-                        rsi_overbought = rsi_overbought,
-                        psar = psar,
-                        psar_sensitivity = psar_sensitivity,
-                        loglevel = loglevel)  # 将交易策略加载到回测系统中
-    start_cash = 1000000
+    cerebro.addstrategy(MonkeyStrategy, **strategy_params)  # 将交易策略加载到回测系统中
     cerebro.broker.setcash(start_cash)  # 设置初始资本为 1,000,000
     # cerebro.broker.setcommission(commission=0.00012)  # 设置交易手续费为 万分之 1.2
     cerebro.broker.set_coc(True) # 以订单创建日的收盘价成交 cheat-on-close, 为了避免第二天开盘价格上涨，导致买入失败
@@ -231,15 +283,21 @@ def run_strategy(ticker: str = 'spy',
     cerebro.addobserver(bt.observers.Value)
     cerebro.addobserver(bt.observers.BuySell)
     cerebro.addobserver(RsiFngObserver)
-    # cerebro.addanalyzer(ProfitLossAnalyzer, _name='profit_loss')
-    cerebro.addanalyzer(bt.analyzers.DrawDown, _name='drawdown')
-    cerebro.addanalyzer(MyDrawDown, _name='mydrawdown')  
-    cerebro.addanalyzer(ValueRecorder, _name='value_recorder')
+    cerebro.addanalyzer(EquityAnalyzer, _name='equity')  # 资金曲线、最大回撤和交易记录
     
     
+    run_start_time = time.perf_counter()
     results = cerebro.run(stdstats=False)  # 运行回测系统
+    run_end_time = time.perf_counter()
     
     strat = results[0]    
+    # cerebro.run 内部的阶段：策略创建之前为数据预加载，strategy stop 之后为分析器、观察者的收尾
+    record('run_strategy.preload', strat.init_time - run_start_time, bars=len(data_df))
+    record('run_strategy.strategy_loop', strat.stop_time - strat.init_time, bars=len(strat), orders=strat.orders_completed)
+    record('run_strategy.finalize', run_end_time - strat.stop_time)
+    
+    with span('run_strategy.analyzers'):
+        mdd = strat.analyzers.equity.get_analysis()
     port_value = cerebro.broker.getvalue()  # 获取回测结束后的总资金
     pnl = port_value - start_cash  # 盈亏统计
 
@@ -247,10 +305,8 @@ def run_strategy(ticker: str = 'spy',
         print(f"初始资金: {start_cash}\n回测期间: {start_date.strftime('%Y%m%d')} - {end_date.strftime('%Y%m%d')}")
         print(f"总资金: {round(port_value, 2)}")
         print(f"净收益: {round(pnl, 2)}")
-        # results[0].analyzers.profit_loss.print_result()
-        # print('最大回撤: %.2f' % strat.analyzers.drawdown.get_analysis()['max']['drawdown'])
+        # strat.analyzers.equity.print_result()
         
-        mdd = strat.analyzers.mydrawdown.get_analysis()
         print('最大回撤：{:.2f}%, 开始日期 {}, 结束日期 {}'.format(mdd['max_drawdown']*100, mdd['max_drawdown_start'], mdd['max_drawdown_end']))
        
     
@@ -261,9 +317,74 @@ def run_strategy(ticker: str = 'spy',
         print('{}, 起始日: {:.2f}, 结束日：{:.2f}, 涨幅：{:.2f}%  '.format(ticker, start_price, end_price, (end_price/start_price-1)*100))
     
     if plotting:
-        cerebro.plot()
+        with span('run_strategy.plot'):
+            cerebro.plot()
     
-    # return round(pnl/10000, 2), round((end_price/start_price-1)*start_cash/10000, 2)
+    return dict(return_percent=pnl/start_cash*100, 
+                max_drawdown_percent=mdd['max_drawdown']*100, 
+                benchmark_percent=benchmark_percent)
+
+
+# 参数扫描时，每个子进程在初始化时拿到一份预先加载的数据
+_sweep_data_df = None
+
+
+_sweep_ticker = None
+
+
+def _init_sweep_worker(data_df, ticker, timing):
+    global _sweep_data_df, _sweep_ticker
+    _sweep_data_df = data_df
+    _sweep_ticker = ticker
+    init_worker_timing(timing)
+
+
+def _run_sweep_task(task):
+    index, period_name, start_date, end_date, params = task
+    result = run_strategy(ticker=_sweep_ticker, start_date=start_date, end_date=end_date, loglevel=Loglevel.NONE, 
+                          data_df=_sweep_data_df, indicator_cache=True, headless=True, **params)
+    return index, dict(period=period_name, start_date=start_date, end_date=end_date, **params, **result), drain_worker_spans()
+
+
+def sweep_strategy(param_grid: dict, periods, ticker: str = 'spy', processes: int = None, progress: bool = True) -> pd.DataFrame:
+    '''
+    对 MonkeyStrategy 做参数扫描：param_grid 中各参数取值的所有组合 × 每个回测期间，用进程池并行运行。
+    数据只加载一次，每个子进程在初始化时收到一份；指标从磁盘缓存读取，只改变阈值时不会重新计算指标。
+    每个任务以 headless 模式运行，子进程的内存不随回测区间增长。
+    主进程开启了 phase_timer 计时时，子进程的计时记录会合并到主进程的记录器中。
+
+    Parameters:
+    - param_grid (dict): run_strategy 的参数名 -> 取值列表，例如 {'fear_greed': [True], 'fear_greed_extreme_fear': [20, 25, 30]}
+      没有指定 follow_signals 时默认为 True，即按信号交易。
+    - periods: (start_date, end_date) 列表，或者 期间名称 -> (start_date, end_date) 的 dict
+
+    Returns:
+    - pd.DataFrame: 每个 (期间, 参数组合) 一行，包括参数、return_percent, max_drawdown_percent, benchmark_percent
+    '''
+    if not isinstance(periods, dict):
+        periods = {'{}-{}'.format(start.strftime('%Y%m%d'), end.strftime('%Y%m%d')): (start, end) for start, end in periods}
+    param_grid = {'follow_signals': [True], **param_grid}
+    param_names = list(param_grid.keys())
+    param_combinations = [dict(zip(param_names, values)) for values in itertools.product(*param_grid.values())]
+    tasks = [(i, name, start, end, params) for i, ((name, (start, end)), params) 
+             in enumerate(itertools.product(periods.items(), param_combinations))]
+
+    data_df = load_strategy_data(ticker)
+    results = [None] * len(tasks)
+    start_time = time.time()
+    report_every = max(1, len(tasks) // 20)
+    with multiprocessing.Pool(processes=processes or multiprocessing.cpu_count(), 
+                              initializer=_init_sweep_worker, initargs=(data_df, ticker, timing_enabled())) as pool:
+        for done, (index, result, spans) in enumerate(pool.imap_unordered(_run_sweep_task, tasks), start=1):
+            results[index] = result
+            merge_worker_spans(spans)
+            if progress and (done % report_every == 0 or done == len(tasks)):
+                elapsed = time.time() - start_time
+                print('进度 {}/{}，已用时 {:.1f}s，预计剩余 {:.1f}s'.format(done, len(tasks), elapsed, elapsed / done * (len(tasks) - done)))
+
+    results_df = pd.DataFrame(results)
+    results_df.insert(0, 'ticker', ticker)
+    return results_df
 
 def run_backtrade():
     spy_bull_period = (datetime(2020,3,16), datetime(2022,1,4))
@@ -282,6 +403,13 @@ def run_backtrade():
     
     run_strategy(ticker='spy', start_date=last_5_years[0], end_date=last_5_years[1], psar=True, loglevel=Loglevel.DETAIL, plotting=True)
     
+    # 参数扫描：恐贪指数阈值在牛市、熊市、震荡市的表现
+    # results_df = sweep_strategy({'fear_greed': [True], 
+    #                              'fear_greed_extreme_fear': [t[0] for t in fng_thresholds], 
+    #                              'fear_greed_extreme_greed': [t[1] for t in fng_thresholds]}, 
+    #                             {'牛市': spy_bull_period, '熊市': spy_bear_period, '震荡市': spy_volatile_period})
+    # print(results_df)
+    
     pass
     
 if __name__ == '__main__':
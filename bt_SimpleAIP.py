@@ -2,18 +2,26 @@ from datetime import datetime
 
 import backtrader as bt
 
-import matplotlib.pyplot as plt
-import akshare as ak
 import pandas as pd
 
-from common import prepare_cn_fund_data
+from common import prepare_cn_fund_data, Loglevel
 from fund_code import *
+from trading_calendar import TradingCalendar
+from headless import run_headless, feed_calendar
+
+HEADLESS = False  # True: 用 headless.run_headless 运行，不画图，只输出回测结果
 
 
 class SimpleAIPStrategy(bt.Strategy):   # Automatic investment plan (SIP) 基金定投，每个月的第一个交易日买入
+    params = (
+        ('calendar', None),  # TradingCalendar，不传时用预加载的数据建立；数据没有预加载时（headless 模式）必须传入
+        ('loglevel', Loglevel.DETAIL),
+    )
 
     def log(self, txt, dt=None):
         ''' Logging function fot this strategy'''
+        if self.p.loglevel < Loglevel.DETAIL:
+            return
         dt = dt or self.datas[0].datetime.date(0)
         print('%s, %s' % (dt.isoformat(), txt))
 
@@ -27,6 +35,7 @@ class SimpleAIPStrategy(bt.Strategy):   # Automatic investment plan (SIP) 基金
         
         self.cash_per_month = 1000.0
         self.counter = 0
+        self.calendar = self.p.calendar if self.p.calendar is not None else TradingCalendar.from_feed(self.datas[0])
         
         self.rsi = bt.indicators.RSI_SMA(self.data.close, period=14)
  
@@ -69,7 +78,7 @@ class SimpleAIPStrategy(bt.Strategy):   # Automatic investment plan (SIP) 基金
         
         assert(self.rsi, bt.indicators.rsi.RSI_SMA)
         if (self.rsi > 30):
-            print(self.rsi)
+            self.log('RSI: %.2f' % self.rsi[0])
         
         
         if self.counter == 12 and self.position:
@@ -79,10 +88,8 @@ class SimpleAIPStrategy(bt.Strategy):   # Automatic investment plan (SIP) 基金
 
         
             
-        today = self.datas[0].datetime.date(ago=0)
-        yesterday = self.datas[0].datetime.date(ago=-1)
-        
-        if (today < yesterday) or (today.month != yesterday.month):  # 是否为第一个日期，或者每月第一个交易日，实际上交易是第二个交易日的净值
+        i = len(self.datas[0]) - 1
+        if i == 0 or self.calendar.is_first_trading_day(i):  # 是否为第一个日期，或者每月第一个交易日，实际上交易是第二个交易日的净值
             number_of_shares = self.cash_per_month / self.dataclose[0]
             self.log('BUY CREATE, Price = %.2f, Shares = %.2f' % (self.dataclose[0], number_of_shares))
             # self.order = self.buy(size=number_of_shares, exectype=bt.Order.Close)  # exectype=bt.Order.Close 以第二天的收盘价买入/卖出
@@ -93,6 +100,7 @@ class SimpleAIPStrategy(bt.Strategy):   # Automatic investment plan (SIP) 基金
 
 if __name__ == '__main__':
 
+    import akshare as ak  # 只在下载数据时导入
     hs300_index_data_df = ak.stock_zh_index_daily_em(symbol="sh000300").iloc[:, :6]
     hs300_index_data_df.columns = [
     'date',
@@ -107,31 +115,34 @@ if __name__ == '__main__':
     hs300_index_data_df.index = pd.to_datetime(hs300_index_data_df['date'])
     
 
-    cerebro = bt.Cerebro()  # 初始化回测系统
     start_date = datetime(2022, 11, 1)  # 回测开始时间
     end_date = datetime(2023, 11, 1)  # 回测结束时间
     data = bt.feeds.PandasData(dataname=hs300_index_data_df, fromdate=start_date, todate=end_date)  # 加载数据
-
-    cerebro.adddata(data)  # 将数据传入回测系统
-    cerebro.addstrategy(SimpleAIPStrategy)  # 将交易策略加载到回测系统中
     start_cash = 240000
-    cerebro.broker.setcash(start_cash)  # 设置初始资本为 100000
-    cerebro.broker.setcommission(commission=0.00012)  # 设置交易手续费为 万分之 1.2
-    # cerebro.broker.set_coc(True) # 以订单创建日的收盘价成交 cheat-on-close
-    # cerebro.broker.set_checksubmit(False) # 防止下单时现金不够被拒绝。只在执行时检查现金够不够。
+
+    if HEADLESS:
+        calendar = feed_calendar(hs300_index_data_df, start_date, end_date)  # 不预加载数据，日历需要预先建立
+        print(run_headless(SimpleAIPStrategy, data, start_cash, commission=0.00012, calendar=calendar, loglevel=Loglevel.NONE))
+    else:
+        cerebro = bt.Cerebro()  # 初始化回测系统
+        cerebro.adddata(data)  # 将数据传入回测系统
+        cerebro.addstrategy(SimpleAIPStrategy)  # 将交易策略加载到回测系统中
+        cerebro.broker.setcash(start_cash)  # 设置初始资本为 100000
+        cerebro.broker.setcommission(commission=0.00012)  # 设置交易手续费为 万分之 1.2
+        # cerebro.broker.set_coc(True) # 以订单创建日的收盘价成交 cheat-on-close
+        # cerebro.broker.set_checksubmit(False) # 防止下单时现金不够被拒绝。只在执行时检查现金够不够。
     
-    cerebro.run()  # 运行回测系统
+        cerebro.run()  # 运行回测系统
 
-    port_value = cerebro.broker.getvalue()  # 获取回测结束后的总资金
-    pnl = port_value - start_cash  # 盈亏统计
+        port_value = cerebro.broker.getvalue()  # 获取回测结束后的总资金
+        pnl = port_value - start_cash  # 盈亏统计
 
-    print(f"初始资金: {start_cash}\n回测期间: {start_date.strftime('%Y%m%d')} - {end_date.strftime('%Y%m%d')}")
-    print(f"总资金: {round(port_value, 2)}")
-    print(f"净收益: {round(pnl, 2)}")
+        print(f"初始资金: {start_cash}\n回测期间: {start_date.strftime('%Y%m%d')} - {end_date.strftime('%Y%m%d')}")
+        print(f"总资金: {round(port_value, 2)}")
+        print(f"净收益: {round(pnl, 2)}")
     
-    cerebro.plot()
+        cerebro.plot()
 
     # 结合PE
     # 结合RSI
-    # 结合SAR
-    
\ No newline at end of file
+    # 结合SAR
\ No newline at end of file
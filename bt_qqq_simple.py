@@ -1,16 +1,17 @@
 import backtrader as bt
-import matplotlib.pyplot as plt
-import akshare as ak
 import pandas as pd
-import os
+import numpy as np
 
 from datetime import datetime, timedelta
 from common import Loglevel
-from common import MyDrawDown
+from trading_calendar import TradingCalendar
+from data_cache import read_canonical
 
-DATA_PATH='./data'
 
 class MyStrategy(bt.Strategy):
+    params = (
+        ('calendar', None),  # TradingCalendar，不传时用预加载的数据建立
+    )
 
     def log(self, txt, dt=None):
         ''' Logging function fot this strategy'''
@@ -26,6 +27,7 @@ class MyStrategy(bt.Strategy):
         self.buycomm = None
         
         self.cash_per_month = 100000
+        self.calendar = self.p.calendar if self.p.calendar is not None else TradingCalendar.from_feed(self.datas[0])
         
     def notify_order(self, order):
         if order.status in [order.Submitted, order.Accepted]:
@@ -72,13 +74,7 @@ class MyStrategy(bt.Strategy):
     
     
     def isFirstTradingDay(self):
-        today = self.datas[0].datetime.date(ago=0)
-        yesterday = self.datas[0].datetime.date(ago=-1)
-        
-        if (today > yesterday) and (today.month != yesterday.month):  # 是否为每月第一个交易日
-            return True
-        else:
-            return False    
+        return self.calendar.is_first_trading_day(len(self.datas[0]) - 1)  # 是否为每月第一个交易日
     
     
     def next(self):
@@ -97,68 +93,96 @@ def calc_rate(positions, cash_per_month, last_price):
     return profit_rate
 
 def run_strategy(ticker: str, start_date, end_date):
-    data_df = pd.read_csv(os.path.join(DATA_PATH, ticker + '.csv'))
-    data_df['date'] = pd.to_datetime(data_df['date'], format='%Y-%m-%d') 
+    data_df = read_canonical(ticker + '.csv').reset_index()
     data_df = data_df[(data_df.date >= start_date) & (data_df.date <= end_date)]
     dates = data_df['date'].to_list()
     closes = data_df['close'].to_list()
     
     print('{} - {}:\t'.format(start_date.strftime('%Y%m%d'), end_date.strftime('%Y%m%d')), end="")
     
-    cash_per_month = 10000
-    profit_rates = []
-    
-    # 每月第一天
-    # positions = []
-    # for i in range(1, len(dates)):
-    #     today = dates[i]
-    #     yesterday = dates[i-1]
-    #     if (today.month != yesterday.month): 
-    #         positions.append(cash_per_month/closes[i])
-    # profit_rates.append(calc_rate(positions, cash_per_month, closes[-1]))
-    
-    # 每月第二天
-    # positions = []
-    # for i in range(2, len(dates)):
-    #     today = dates[i]
-    #     yesteraday = dates[i-1]
-    #     the_day_before_yesterday = dates[i-2]
-    #     if (today.month == yesteraday.month) and (yesteraday.month != the_day_before_yesterday.month): 
-    #         positions.append(cash_per_month/closes[i])
-    # profit_rates.append(calc_rate(positions, cash_per_month, closes[-1]))
-    
-    # # 每月最后一天
-    # positions = []
-    # for j in range(0, len(dates)-1):
-    #     today = dates[j]
-    #     tomorrow = dates[j+1]
-    #     if (today.month != tomorrow.month):
-    #         positions.append(cash_per_month/closes[j])
-    # profit_rates.append(calc_rate(positions, cash_per_month, closes[-1]))
-    
-    # 每月倒数第二天
-    # positions = []
-    # for j in range(0, len(dates)-2):
-    #     today = dates[j]
-    #     tomorrow = dates[j+1]
-    #     the_day_after_tomorrow = dates[j+2]
-    #     if (today.month == tomorrow.month) and (tomorrow.month != the_day_after_tomorrow.month):
-    #         positions.append(cash_per_month/closes[j])
-    # profit_rates.append(calc_rate(positions, cash_per_month, closes[-1]))
-    
-    
-    # print("\t".join("{:.2f}".format(x) for x in profit_rates))
-    # print("{:.2f}\t{:.2f}\t{:.2f}".format(profit_rates[0],profit_rates[1],profit_rates[1] - profit_rates[0]))
-  
+    # 每月第一天、第二天、最后一天、倒数第二天定投，原来逐个策略循环的写法见 dca_profit_rates
+    rates_df = dca_profit_rates(data_df.set_index('date'), [(start_date, end_date)], 
+                                offsets=[('start', 0), ('start', 1), ('end', 0), ('end', 1)])
+    profit_rates = rates_df.iloc[0].to_list()
+    print("\t".join("{:.2f}".format(x) for x in profit_rates))
+    
+    
+def dca_profit_rates(data_df: pd.DataFrame, windows, offsets=None, max_offset: int = 5, calendar: TradingCalendar = None) -> pd.DataFrame:
+    '''
+    每月定投同样金额、到区间最后一天的收益率（同 calc_rate），对所有 (区间, 每月买入日) 组合一次算完。
+
+    每月买入日 ('start', k) 为每月第 k+1 个交易日，('end', k) 为每月倒数第 k+1 个交易日，买入日必须和月初（月末）在同一个月。
+    和原来逐日比较月份的写法一样，区间第一天不算作月初，区间最后一天不算作月末。
+
+    calc_rate 和每月金额无关：收益率 = 最后价格 × mean(1 / 买入价格) - 1，
+    每个买入日在哪些区间中有效是一段连续的范围，用 1 / 买入价格的前缀和直接得到每个区间的结果。
+
+    Parameters:
+    - data_df (pd.DataFrame): 以日期为 index，包含 'close' 列
+    - windows: (start_date, end_date) 列表，区间包括两端
+    - offsets: (anchor, k) 列表，默认为 ('start', 0..max_offset) 和 ('end', 0..max_offset)
+    - calendar: data_df 的 TradingCalendar，不传时新建
+
+    Returns:
+    - pd.DataFrame: 每个区间一行（index 为 start_date, end_date），每个买入日一列（'start+k' / 'end-k'），
+      值为收益率（百分比），没有买入的区间为 nan
+    '''
+    if offsets is None:
+        offsets = [('start', k) for k in range(max_offset + 1)] + [('end', k) for k in range(max_offset + 1)]
+    dates = data_df.index
+    closes = data_df['close'].to_numpy(dtype=np.float64)
+    calendar = calendar if calendar is not None else TradingCalendar(dates)
+    month_starts, month_ends = calendar.first_days('month'), calendar.last_days('month')
+    next_starts = np.append(month_starts[1:], len(closes))  # 下一个月初，用来判断买入日是否还在同一个月
+    prev_ends = np.insert(month_ends[:-1], 0, -1)
+
+    window_starts = np.searchsorted(dates, pd.to_datetime([start for start, _ in windows]), side='left')
+    window_ends = np.searchsorted(dates, pd.to_datetime([end for _, end in windows]), side='right') - 1
+    last_prices = closes[np.clip(window_ends, 0, len(closes) - 1)]
+
+    rates = np.full((len(windows), len(offsets)), np.nan)
+    for column, (anchor, k) in enumerate(offsets):
+        if anchor == 'start':
+            valid = month_starts + k < next_starts
+            buy_days = month_starts[valid] + k
+            latest_window_start = month_starts[valid] - 1      # 区间第一天不能晚于月初的前一天
+            earliest_window_end = buy_days
+        elif anchor == 'end':
+            valid = month_ends - k > prev_ends
+            buy_days = month_ends[valid] - k
+            latest_window_start = buy_days
+            earliest_window_end = month_ends[valid] + 1        # 区间最后一天不能早于月末的后一天
+        else:
+            raise ValueError('anchor 只能是 start 或 end: {}'.format(anchor))
+
+        # 买入日按时间排序，两个边界也是递增的，所以每个区间的买入日是连续的一段 [first, last)
+        first = np.searchsorted(latest_window_start, window_starts, side='left')
+        last = np.searchsorted(earliest_window_end, window_ends, side='right')
+        counts = np.maximum(last - first, 0)
+        cumulative = np.concatenate([[0.0], np.cumsum(1.0 / closes[buy_days])])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_inverse = (cumulative[np.maximum(last, first)] - cumulative[first]) / counts
+        rates[:, column] = np.where(counts > 0, (last_prices * mean_inverse - 1) * 100, np.nan)
+
+    columns = ['{}{}{}'.format(anchor, '+' if anchor == 'start' else '-', k) for anchor, k in offsets]
+    index = pd.MultiIndex.from_tuples([(pd.Timestamp(start), pd.Timestamp(end)) for start, end in windows], names=['start_date', 'end_date'])
+    return pd.DataFrame(rates, index=index, columns=columns)
+    
+    
+def rolling_windows(end_date, years: int, count: int, step_days: int = 365):
+    ''' 从 end_date 开始每次向前移动 step_days 天，共 count 个长度为 years 年的区间 '''
+    windows = []
+    for i in range(count):
+        window_end = end_date - timedelta(days=i*step_days)
+        windows.append((window_end - timedelta(days=years*365), window_end))
+    return windows
     
     
 def run_backtrade():
     end_date = datetime(2023,11,24)
     start_date = datetime(2013,11,24)
     
-    data_df = pd.read_csv(os.path.join(DATA_PATH, 'qqq.csv'))
-    data_df['date'] = pd.to_datetime(data_df['date'], format='%Y-%m-%d') 
-    # data_df['date'] = pd.to_datetime(data_df['date'], format='%Y/%m/%d')
+    data_df = read_canonical('qqq.csv').reset_index()
     
     data_df = data_df[(data_df.date >= start_date) & (data_df.date <= end_date)]
     dates = data_df['date'].to_list()
@@ -175,20 +199,17 @@ def run_backtrade():
     
     
     
-    gap = []
-    for i in range(1, len(dates)):
-        today = dates[i]
-        yesterday = dates[i-1]
-        if (today.month != yesterday.month): 
-            month_head = closes[i+4] - closes[i-1]
-            month_tail = closes[i] - closes[i-5]
-            gap.append(month_head - month_tail)
-            # gap.append(month_tail)
+    # 每月前 5 个交易日的涨幅减去上月最后 5 个交易日的涨幅
+    closes = np.array(closes)
+    month_starts = TradingCalendar(dates).first_days('month')
+    month_starts = month_starts[(month_starts >= 5) & (month_starts + 4 < len(closes))]
+    month_head = closes[month_starts + 4] - closes[month_starts - 1]
+    month_tail = closes[month_starts] - closes[month_starts - 5]
+    gap = month_head - month_tail
+    # gap = month_tail
     
-    positives =  [x for x in gap if x > 0]     
-    negatives =  [x for x in gap if x < 0]     
-    print(len(positives))
-    print(len(negatives))
+    print((gap > 0).sum())
+    print((gap < 0).sum())
        
        
     # for i in range(0, 18):
@@ -196,6 +217,11 @@ def run_backtrade():
     #     start_date = end_date - timedelta(days=2*365)
     #     run_strategy(ticker='qqq', start_date=start_date, end_date=end_date)
     
+    # 上面的循环一次算完：每个 2 年区间 × 每月的前/后 6 个交易日
+    # full_df = read_canonical('qqq.csv')
+    # rates_df = dca_profit_rates(full_df, rolling_windows(end_date, years=2, count=18))
+    # print(rates_df.round(2).to_string())
+    
     
 if __name__ == '__main__':
     run_backtrade()
@@ -1,9 +1,11 @@
-import akshare as ak
+import numpy as np
 import pandas as pd
+from collections import deque
 from enum import IntEnum
 import backtrader as bt
 
 def prepare_cn_fund_data(fundcode):
+    import akshare as ak  # 只在下载数据时导入，akshare 的导入需要 1 秒左右
     fund_data_df = ak.fund_open_fund_info_em(fund=fundcode, indicator="累计净值走势")
     fund_data_df.columns = [
         'date',
@@ -23,6 +25,7 @@ class Signal(IntEnum):
     NO_SIGNAL = 0
 
 class Loglevel(IntEnum):
+    NONE = 0  # 不输出，用于参数扫描
     SUMMARY = 1
     DETAIL = 2
 
@@ -32,39 +35,28 @@ class MyParabolicSAR(bt.indicators.ParabolicSAR):
         psar=dict(color='green', markersize='1')  # 将PSAR指标的颜色设置为红色
     )
 
-class MyDrawDown(bt.Analyzer):
-    def __init__(self):
-        self.drawdown = 0.0
-        self.max_drawdown = 0.0
-        self.drawdown_start = None
-        self.max_drawdown_start = None
-        self.max_drawdown_end = None
-        self.peak = None
-
-    def next(self):
-        current_value = self.strategy.broker.get_value()
-        self.peak = max(self.peak, current_value) if self.peak is not None else current_value
-
-        self.drawdown = (self.peak - current_value) / self.peak
-        if self.drawdown > self.max_drawdown:
-            self.max_drawdown = self.drawdown
-            self.max_drawdown_start = self.drawdown_start
-            self.max_drawdown_end = self.data.datetime.date()
-
-        if self.drawdown == 0:
-            self.drawdown_start = self.data.datetime.date()
-
-    def get_analysis(self):
-        return dict(max_drawdown=self.max_drawdown,
-                    max_drawdown_start=self.max_drawdown_start,
-                    max_drawdown_end=self.max_drawdown_end)
-
-
 class RsiFngPandasData(bt.feeds.PandasData):
     lines = ('rsi', 'fear_greed')
     params = (('rsi', -1), ('fear_greed', -1))
     plotinfo = {"plot": True, "subplot": True}
     
+class IndicatorPandasData(RsiFngPandasData):
+    ''' 在 RsiFngPandasData 的基础上，加入预先计算好的指标列（见 indicator_cache.add_monkey_indicators） '''
+    lines = ('psar', 'rsi_safe', 'sma')
+    params = (('psar', -1), ('rsi_safe', -1), ('sma', -1))
+
+
+class PrecomputedIndicator(bt.Indicator):
+    ''' 把数据中预先计算好的一列包装成指标，period 为原指标的预热期，策略的 minperiod 因此和直接计算指标时相同 '''
+    lines = ('value',)
+    params = (('period', 1),)
+    plotinfo = dict(plot=False)
+
+    def __init__(self):
+        self.lines.value = self.data
+        self.addminperiod(self.p.period)
+
+
 class RsiFngObserver(bt.Observer):
     lines = ('rsi', 'fear_greed',)
     plotinfo = dict(plot=True, subplot=True)
@@ -73,33 +65,175 @@ class RsiFngObserver(bt.Observer):
         self.lines.fear_greed[0] = self.datas[0].fear_greed[0]
         
         
-class ProfitLossAnalyzer(bt.Analyzer):
-    def __init__(self):
-        self.trades = []
+# backtrader 的日期数值为公历序数（0001-01-01 为 1），1970-01-01 的序数
+_UNIX_EPOCH_ORDINAL = 719163
 
-    def notify_order(self, order):
-        if order.status in [order.Completed]:
-            if order.isbuy():
-                self.buyprice = order.executed.price
-            elif order.issell():
-                sellprice = order.executed.price
-                profit = sellprice - self.buyprice
-                self.trades.append(profit)
 
-    def print_result(self):
-        positive_profit_list = [i for i in self.trades if i >= 0]    
-        negative_profit_list = [i for i in self.trades if i < 0] 
-        print('一共交易 {} 次，其中 {} 次为盈利，{} 次为亏损'.format(len(self.trades), len(positive_profit_list), len(negative_profit_list)))
+def num2datetime64(nums) -> np.ndarray:
+    ''' 把 backtrader 的日期数值数组转换为 datetime64[us]，精度和 bt.num2date 相同（微秒） '''
+    nums = np.asarray(nums, dtype=np.float64)
+    return np.round((nums - _UNIX_EPOCH_ORDINAL) * 86400e6).astype(np.int64).astype('datetime64[us]')
+
+
+class _GrowableArray:
+    ''' 按行追加的二维 float64 数组，预先分配容量，不够时容量加倍 '''
+    __slots__ = ('data', 'size')
+
+    def __init__(self, capacity: int, columns: int):
+        self.data = np.empty((max(capacity, 16), columns))
+        self.size = 0
+
+    def append(self, row):
+        if self.size == len(self.data):
+            grown = np.empty((2 * len(self.data), self.data.shape[1]))
+            grown[:self.size] = self.data
+            self.data = grown
+        self.data[self.size] = row
+        self.size += 1
+
+    def view(self) -> np.ndarray:
+        return self.data[:self.size]
+
+
+class _Lot:
+    ''' 一笔还没有平仓的持仓，size 为正数是多头，负数是空头 '''
+    __slots__ = ('size', 'price', 'dt', 'comm_per_unit')
+
+    def __init__(self, size, price, dt, comm_per_unit):
+        self.size = size
+        self.price = price
+        self.dt = dt
+        self.comm_per_unit = comm_per_unit
 
 
-class ValueRecorder(bt.Analyzer):
+class _RunningDrawdown:
+    ''' 逐根 bar 在线计算最大回撤，规则同 EquityAnalyzer.stop()，只保存几个标量 '''
+    __slots__ = ('peak', 'peak_num', 'max_drawdown', 'max_drawdown_start', 'max_drawdown_end')
+
     def __init__(self):
-        self.values = {}
+        self.peak = None
+        self.peak_num = None  # 最后一个没有回撤的日子
+        self.max_drawdown = 0.0
+        self.max_drawdown_start = None
+        self.max_drawdown_end = None
+
+    def update(self, num, value):
+        if self.peak is None or value >= self.peak:
+            self.peak = value
+            self.peak_num = num
+            return
+        drawdown = (self.peak - value) / self.peak
+        if drawdown > self.max_drawdown:
+            self.max_drawdown = drawdown
+            self.max_drawdown_start = self.peak_num
+            self.max_drawdown_end = num
+
+
+class EquityAnalyzer(bt.Analyzer):
+    '''
+    一个 analyzer 同时记录资金曲线、回撤和交易（代替原来的 ValueRecorder、MyDrawDown、ProfitLossAnalyzer）。
+
+    每根 bar 只把 (日期, 总价值, 现金, 持仓) 写入预先分配的数组，回撤在 stop() 中一次性用数组计算；
+    成交按先进先出（FIFO）和之前的持仓配对，每次配对记为一笔完整交易（round trip），盈亏扣除双方的手续费。
+
+    - get_analysis(): max_drawdown, max_drawdown_start, max_drawdown_end（含义和原来的 MyDrawDown 相同），以及交易次数
+    - arrays(): 各列的 numpy 数组
+    - to_dataframe(): 以日期为索引的 DataFrame，列为 value, cash, position, drawdown
+    - round_trips_dataframe(): 每笔完整交易一行
+
+    record=False 时不保存每根 bar 的数组，只在线计算最大回撤，内存不随回测长度增长（用于 headless.run_headless），
+    这时 arrays() 和 to_dataframe() 没有数据。
+    '''
+    params = (('record', True),)
+
+    COLUMNS = ('datetime', 'value', 'cash', 'position')
+    ROUND_TRIP_COLUMNS = ('entry_datetime', 'exit_datetime', 'size', 'entry_price', 'exit_price', 'pnl')
+
+    def start(self):
+        # 预加载时 buflen() 就是全部 bar 数，不需要扩容
+        self._records = _GrowableArray(self.data.buflen() if self.p.record else 0, len(self.COLUMNS))
+        self._running = None if self.p.record else _RunningDrawdown()
+        self._lots = deque()
+        self._round_trips = []
+        self._drawdown = np.empty(0)
+        self._summary = dict(max_drawdown=0.0, max_drawdown_start=None, max_drawdown_end=None)
 
     def next(self):
-        date = self.data.datetime.date()
-        value = self.strategy.broker.getvalue()
-        self.values[date] = value
+        broker = self.strategy.broker
+        if self._running is not None:
+            self._running.update(self.data.datetime[0], broker.getvalue())
+            return
+        self._records.append((self.data.datetime[0], broker.getvalue(), broker.getcash(), self.strategy.getposition(self.data).size))
+
+    def notify_order(self, order):
+        if order.status != order.Completed:
+            return
+        size = order.executed.size
+        price = order.executed.price
+        dt = order.executed.dt
+        comm_per_unit = order.executed.comm / abs(size) if size else 0.0
+        # 和方向相反的持仓按先进先出配对
+        while size and self._lots and (self._lots[0].size > 0) != (size > 0):
+            lot = self._lots[0]
+            direction = 1 if lot.size > 0 else -1
+            matched = min(abs(size), abs(lot.size))
+            pnl = direction * matched * (price - lot.price) - matched * (lot.comm_per_unit + comm_per_unit)
+            self._round_trips.append((lot.dt, dt, direction * matched, lot.price, price, pnl))
+            lot.size -= direction * matched
+            size += direction * matched
+            if lot.size == 0:
+                self._lots.popleft()
+        if size:
+            self._lots.append(_Lot(size, price, dt, comm_per_unit))
+
+    def stop(self):
+        running = self._running
+        if running is not None:
+            if running.max_drawdown > 0:
+                self._summary = dict(max_drawdown=running.max_drawdown,
+                                     max_drawdown_start=bt.num2date(running.max_drawdown_start).date(),
+                                     max_drawdown_end=bt.num2date(running.max_drawdown_end).date())
+            return
+        values = self._records.view()[:, 1]
+        if len(values) == 0:
+            return
+        running_peak = np.maximum.accumulate(values)
+        self._drawdown = (running_peak - values) / running_peak
+        end = int(np.argmax(self._drawdown))  # 第一次达到最大回撤的那天
+        if self._drawdown[end] > 0:
+            # 回撤开始于最大回撤之前最后一个没有回撤的日子
+            at_peak = np.flatnonzero(self._drawdown[:end] == 0)
+            nums = self._records.view()[:, 0]
+            self._summary = dict(max_drawdown=float(self._drawdown[end]),
+                                 max_drawdown_start=bt.num2date(nums[at_peak[-1]]).date(),
+                                 max_drawdown_end=bt.num2date(nums[end]).date())
 
     def get_analysis(self):
-        return self.values
\ No newline at end of file
+        pnls = [round_trip[-1] for round_trip in self._round_trips]
+        return dict(**self._summary,
+                    round_trips=len(pnls),
+                    winning_round_trips=sum(1 for pnl in pnls if pnl >= 0),
+                    losing_round_trips=sum(1 for pnl in pnls if pnl < 0))
+
+    def arrays(self) -> dict:
+        ''' 列名 -> 数组，datetime 为 datetime64[us] '''
+        records = self._records.view()
+        columns = {column: records[:, i] for i, column in enumerate(self.COLUMNS)}
+        columns['datetime'] = num2datetime64(columns['datetime'])
+        columns['drawdown'] = self._drawdown
+        return columns
+
+    def to_dataframe(self) -> pd.DataFrame:
+        columns = self.arrays()
+        return pd.DataFrame(columns, index=pd.DatetimeIndex(columns.pop('datetime'), name='date'))
+
+    def round_trips_dataframe(self) -> pd.DataFrame:
+        round_trips_df = pd.DataFrame(self._round_trips, columns=list(self.ROUND_TRIP_COLUMNS))
+        for column in ['entry_datetime', 'exit_datetime']:
+            round_trips_df[column] = num2datetime64(round_trips_df[column].to_numpy())
+        round_trips_df['return_percent'] = round_trips_df['pnl'] / (round_trips_df['size'].abs() * round_trips_df['entry_price']) * 100
+        return round_trips_df
+
+    def print_result(self):
+        analysis = self.get_analysis()
+        print('一共交易 {} 次，其中 {} 次为盈利，{} 次为亏损'.format(analysis['round_trips'], analysis['winning_round_trips'], analysis['losing_round_trips']))
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+# data/ 中的 CSV 来自不同的来源，格式各不相同：
+#   date,net_value / 净值日期,累计净值（基金净值）、date,open,high,...（yfinance 行情）、Date,Fear Greed（恐贪指数）、
+#   hs300.csv（带 BOM，日期为 2005/4/8 格式）、标普500 / 沪深300 PE-TTM 导出（中文表头，日期倒序，格式不统一）。
+# read_canonical() 把每个文件规范化一次：列名统一、日期为 datetime64[ns] 索引（升序）、其他列全部为 float64，
+# 结果保存在 data/canonical/ 中。文件内容（sha1）不变时直接读取规范化的结果，不再解析 CSV。
+
+DATA_PATH = './data'
+CACHE_PATH = os.path.join(DATA_PATH, 'canonical')
+MANIFEST_PATH = os.path.join(CACHE_PATH, 'manifest.json')  # 源文件 -> (大小, 修改时间, 内容 hash)，大小和修改时间不变时不重新计算 hash
+
+SCHEMA_VERSION = 1  # 规范化规则改变时加 1，所有缓存随之失效
+
+# 各数据源中出现过的列名 -> 规范列名，不在其中的列名保持不变（例如 open, close, adj close）
+COLUMN_NAMES = {
+    'Date': 'date',
+    '日期': 'date',
+    '净值日期': 'date',
+    '累计净值': 'net_value',
+    'Fear Greed': 'fear_greed',
+    '收盘点位': 'close',
+    '全收益收盘点位(元)': 'total_return_close',
+    '市值(元)': 'market_cap',
+    '市值(美元)': 'market_cap',
+    '流通市值(元)': 'float_market_cap',
+    'PE-TTM市值加权': 'pe_ttm',
+    'PE-TTM 分位点': 'pe_ttm_percentile',
+    'PE-TTM 80%分位点': 'pe_ttm_80',
+    'PE-TTM 50%分位点': 'pe_ttm_50',
+    'PE-TTM 20%分位点': 'pe_ttm_20',
+}
+
+DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d']  # 依次尝试，整列使用同一种格式
+DATE_PATTERN = r'^\d{4}[-/]\d{1,2}[-/]\d{1,2}$'  # 日期列不符合的行（例如 PE-TTM 导出末尾的“数据来源于...”）被丢弃
+
+_manifest = None
+_manifest_lock = threading.Lock()  # sync_funds_data 在多个线程中读取 CSV，manifest 的读取、修改和写入需要串行
+
+
+def source_path(name: str) -> str:
+    ''' 文件名（例如 spy.csv）在 data/ 中查找，已经存在的路径直接使用 '''
+    return name if os.path.exists(name) else os.path.join(DATA_PATH, name)
+
+
+def _parse_dates(values: pd.Series) -> pd.DatetimeIndex:
+    for date_format in DATE_FORMATS:
+        try:
+            return pd.DatetimeIndex(pd.to_datetime(values, format=date_format), name='date').astype('datetime64[ns]')
+        except ValueError:
+            continue
+    raise ValueError('无法识别的日期格式: {}'.format(values.iloc[0] if len(values) else None))
+
+
+def normalize_csv(path: str) -> pd.DataFrame:
+    ''' 解析一个 CSV：去掉 BOM、统一列名，日期作为升序的 datetime64[ns] 索引，其他列转换为 float64 '''
+    data_df = pd.read_csv(path, encoding='utf-8-sig', dtype=str)
+    data_df = data_df.rename(columns=lambda column: COLUMN_NAMES.get(column.strip(), column.strip()))
+    if 'date' not in data_df.columns:
+        raise ValueError('{} 没有日期列: {}'.format(path, list(data_df.columns)))
+    data_df = data_df[data_df['date'].str.strip().str.match(DATE_PATTERN, na=False)]
+    index = _parse_dates(data_df.pop('date').str.strip())
+    data_df = data_df.apply(pd.to_numeric, errors='raise').astype(np.float64)
+    data_df.index = index
+    return data_df.sort_index(kind='stable')
+
+
+def _load_manifest() -> dict:
+    global _manifest
+    if _manifest is None:
+        try:
+            with open(MANIFEST_PATH) as f:
+                _manifest = json.load(f)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+
+def _tmp_path(path: str) -> str:
+    ''' 临时文件名包含进程和线程，多个进程、同一进程的多个线程不会写同一个临时文件 '''
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+def _save_manifest():
+    ''' 调用时需要持有 _manifest_lock '''
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    tmp_path = _tmp_path(MANIFEST_PATH)
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(_manifest), f, indent=1, ensure_ascii=False)
+    os.replace(tmp_path, MANIFEST_PATH)
+
+
+def content_hash(path: str) -> str:
+    ''' 文件内容的 sha1；大小和修改时间和上次相同时直接使用 manifest 中记录的结果 '''
+    key = os.path.abspath(path)
+    stat = os.stat(path)
+    with _manifest_lock:
+        entry = _load_manifest().get(key)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['hash']
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    with _manifest_lock:
+        _load_manifest()[key] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, hash=sha.hexdigest())
+        _save_manifest()
+    return sha.hexdigest()
+
+
+def cache_file(path: str) -> str:
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CACHE_PATH, '{}.v{}.{}.pkl'.format(name, SCHEMA_VERSION, content_hash(path)[:16]))
+
+
+def read_canonical(name: str) -> pd.DataFrame:
+    '''
+    读取规范化后的数据，内容没有变化时不解析 CSV。返回的是新的 DataFrame，调用方可以直接修改。
+
+    Parameters:
+    - name: data/ 中的文件名（例如 'spy.csv'、'hs300.csv'），或者 CSV 的路径
+    '''
+    path = source_path(name)
+    cached_path = cache_file(path)
+    if os.path.exists(cached_path):
+        return pd.read_pickle(cached_path)
+
+    data_df = normalize_csv(path)
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    tmp_path = _tmp_path(cached_path)  # 多个进程、线程可能同时规范化同一个文件
+    data_df.to_pickle(tmp_path)
+    os.replace(tmp_path, cached_path)
+    # 删除同一个源文件的旧版本
+    prefix = os.path.splitext(os.path.basename(path))[0] + '.v'
+    for file_name in os.listdir(CACHE_PATH):
+        if file_name.startswith(prefix) and file_name.endswith('.pkl') and os.path.join(CACHE_PATH, file_name) != cached_path:
+            try:
+                os.remove(os.path.join(CACHE_PATH, file_name))
+            except FileNotFoundError:  # 另一个线程已经删除
+                pass
+    return data_df
+
+
+def read_fear_greed() -> pd.Series:
+    ''' 恐贪指数，日期索引 '''
+    return read_canonical('all_fng_csv.csv')['fear_greed']
+
+
+def normalize_all(path: str = DATA_PATH) -> pd.DataFrame:
+    ''' 规范化目录下所有 CSV，返回每个文件的行数、列和日期范围，用于检查 '''
+    rows = []
+    for file_name in sorted(os.listdir(path)):
+        if file_name.endswith('.csv'):
+            data_df = read_canonical(os.path.join(path, file_name))
+            rows.append(dict(file=file_name, rows=len(data_df), start=data_df.index.min(), end=data_df.index.max(),
+                             columns=', '.join(data_df.columns)))
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    print(normalize_all().to_string())
@@ -1,50 +1,516 @@
+import numpy as np
 import pandas as pd
 
-def calculate_max_dd(value_series: pd.Series):  
-    ''' 计算最大回撤 '''
-    start_date = value_series.index[0]
+from phase_timer import span
+
+DRAWDOWN_COLUMNS = ['max_dd', 'dd_peak_date', 'dd_bottom_date', 'dd_peak_value', 'dd_bottom_value']
+
+
+def calculate_max_dd(value_data):
+    ''' 
+    计算最大回撤，基于 cummax 向量化计算。
+
+    Parameters:
+    - value_data (pd.Series | pd.DataFrame): 价值/净值序列，日期为索引；DataFrame 时对每一列分别计算。
+
+    Returns:
+    - pd.Series 时: (max_dd, dd_peak_date, dd_bottom_date, dd_peak_value, dd_bottom_value)
+    - pd.DataFrame 时: 每列一行的 DataFrame，列为 DRAWDOWN_COLUMNS
+    '''
+    values = value_data.to_numpy(dtype=np.float64)
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    columns = np.arange(values.shape[1])
+
+    running_peak = np.fmax.accumulate(values, axis=0)
+    drawdown = np.nan_to_num(running_peak - values, nan=-np.inf)
+    bottom_index = np.argmax(drawdown, axis=0)  # 相同回撤取最早出现的一次
+    peak_value = running_peak[bottom_index, columns]
+    peak_index = np.argmax(running_peak >= peak_value, axis=0)  # 第一次达到该峰值的日期
+
+    dates = value_data.index
+    result = pd.DataFrame({'max_dd': peak_value - values[bottom_index, columns],
+                           'dd_peak_date': dates[peak_index], 
+                           'dd_bottom_date': dates[bottom_index], 
+                           'dd_peak_value': peak_value, 
+                           'dd_bottom_value': values[bottom_index, columns]}, 
+                          columns=DRAWDOWN_COLUMNS)
     
-    dd_peak_date_candidate = dd_peak_date = value_series.index[0]
-    dd_bottom_date_candidate = dd_bottom_date = dd_peak_date
-    dd_peak_value_candidate = dd_peak_value = value_series.iloc[0]
-    dd_bottom_value_candidate = dd_bottom_value = dd_peak_value
-    max_dd_candidate = max_dd = dd_peak_value - dd_bottom_value
+    if isinstance(value_data, pd.Series):
+        return tuple(result.iloc[0])
+    result.index = value_data.columns
+    return result
+
+
+def _series_drawdown_episodes(value_series: pd.Series, top_n):
+    values = value_series.to_numpy(dtype=np.float64)
+    running_peak = np.fmax.accumulate(values)
+    drawdown = running_peak - values
+
+    # 每创一次新高开始一个新的下跌周期，同一周期内 running_peak 不变
+    new_high = np.empty(len(values), dtype=bool)
+    new_high[0] = True
+    new_high[1:] = running_peak[1:] > running_peak[:-1]
+    episode_id = np.cumsum(new_high) - 1
+    episode_start = np.flatnonzero(new_high)
     
-    for date, value in value_series.items():
-        if date == start_date:  # 第一个日期，直接跳过，因为回撤为0，并且没有下跌周期开始和结束的日期。
-            continue
-        
-        if (value > dd_peak_value):  # 一个下跌周期计算结束            
-            max_dd = dd_peak_value - dd_bottom_value
-            if (max_dd > max_dd_candidate): # 当前的回撤更高
-                dd_peak_date_candidate = dd_peak_date
-                dd_bottom_date_candidate = dd_bottom_date
-                dd_peak_value_candidate = dd_peak_value
-                dd_bottom_value_candidate = dd_bottom_value
-                max_dd_candidate = max_dd
-                
-            # 新的可能的下跌周期开始
-            dd_peak_date = dd_bottom_date = date
-            dd_peak_value = dd_bottom_value = value
-                    
-        elif (value < dd_bottom_value):  # 继续下跌
-            dd_bottom_date = date
-            dd_bottom_value = value
+    episode_bottom = pd.Series(drawdown).groupby(episode_id).idxmax().to_numpy()
+    episode_dd = drawdown[episode_bottom]
+    order = np.argsort(-episode_dd, kind='stable')[:top_n]
+    order = order[episode_dd[order] > 0]
+
+    dates = value_series.index
+    rows = []
+    for episode in order:
+        peak_index = episode_start[episode]
+        bottom_index = episode_bottom[episode]
+        peak_value = running_peak[peak_index]
+        recovered = np.flatnonzero(values[bottom_index:] >= peak_value)  # 回到前高即为修复
+        rows.append([episode_dd[episode], 
+                     dates[peak_index], 
+                     dates[bottom_index], 
+                     dates[bottom_index + recovered[0]] if len(recovered) > 0 else pd.NaT, 
+                     peak_value, 
+                     values[bottom_index]])
+    episodes_df = pd.DataFrame(rows, columns=DRAWDOWN_COLUMNS[:3] + ['dd_recovery_date'] + DRAWDOWN_COLUMNS[3:])
+    episodes_df['max_dd_percent'] = episodes_df['max_dd'] / episodes_df['dd_peak_value'] * 100
+    return episodes_df
+
+
+def calculate_drawdown_episodes(value_data, top_n=5):
+    '''
+    列出回撤最大的 top_n 个互不重叠的下跌周期（从创新高开始，到回到前高为止）。
+
+    Returns:
+    - pd.DataFrame: 每个下跌周期一行，按回撤从大到小排列，列包括 DRAWDOWN_COLUMNS，dd_recovery_date（未修复时为 NaT）和 max_dd_percent。
+      value_data 为 DataFrame 时，索引为 (列名, 排名) 的 MultiIndex。
+    '''
+    if isinstance(value_data, pd.Series):
+        return _series_drawdown_episodes(value_data, top_n)
+    return pd.concat({column: _series_drawdown_episodes(value_data[column], top_n) for column in value_data.columns})
+
+
+TOTAL_INVESTMENT = 100.0
+
+
+def rebalance_day_indices(num_days: int, rebalance_period: int) -> np.ndarray:
+    ''' 重平衡发生的行号：第 0 行为建仓日，此后每 rebalance_period 个交易日重平衡一次 '''
+    return np.arange(0, num_days, rebalance_period)
+
+
+def back_trade_arrays(net_values: np.ndarray, target_percents: np.ndarray, rebalance_period: int):
+    '''
+    基于 NumPy 数组的组合回测核心。
+
+    Parameters:
+    - net_values (np.ndarray): (days × funds) 的累计净值矩阵，不能有空值。
+    - target_percents (np.ndarray): 每个基金的目标比例（百分比），长度为 funds。
+    - rebalance_period (int): 每多少个交易日重平衡一次。
+
+    Returns:
+    - portfolio_values (np.ndarray): 每天的组合整体价值，长度为 days。
+    - shares (np.ndarray): (days × funds) 每天收盘后的持有份额（重平衡当天为调整后的份额）。
+    - fund_values (np.ndarray): (days × funds) 每天收盘后的基金持仓价值。
+    '''
+    net_values = np.asarray(net_values, dtype=np.float64)
+    weights = np.asarray(target_percents, dtype=np.float64) / 100
+    num_days, num_funds = net_values.shape
+
+    shares = np.empty((num_days, num_funds))
+    portfolio_values = np.empty(num_days)
+
+    # 在两个重平衡日之间份额保持不变，组合价值直接用 净值矩阵 @ 份额向量 计算
+    current_shares = TOTAL_INVESTMENT * weights / net_values[0]
+    rebalance_days = rebalance_day_indices(num_days, rebalance_period)
+    for start, end in zip(rebalance_days, np.append(rebalance_days[1:], num_days)):
+        if start > 0:  # 重平衡当天按当天收盘后的组合价值重新分配份额，重平衡前后组合价值不变
+            current_shares = (net_values[start] @ current_shares) * weights / net_values[start]
+        shares[start:end] = current_shares
+        portfolio_values[start:end] = net_values[start:end] @ current_shares
+
+    fund_values = net_values * shares
+    return portfolio_values, shares, fund_values
+
+
+def fund_portfolio_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_period):
+    '''
+    组合回测：按 target_percent 建仓，每 rebalance_period 个交易日重平衡一次。
+
+    Returns:
+    - portfolio_value_series (pd.Series): 每天的组合整体价值，日期为索引。
+    - funds_value_dict (dict): ticker -> DataFrame，列包括 date, net_value, shares, fund_value。
+    '''
+    tickers = portfolio_df.index
+    net_values = portfolio_funds_data_df[tickers].to_numpy(dtype=np.float64)
+    with span('back_trade.arrays', days=len(net_values), funds=len(tickers), 
+              rebalances=len(rebalance_day_indices(len(net_values), rebalance_period))):
+        portfolio_values, shares, fund_values = back_trade_arrays(net_values, portfolio_df['target_percent'].to_numpy(), rebalance_period)
+    assert np.isclose(portfolio_values[0], TOTAL_INVESTMENT)  # 初始化时，portfolio value 应该等于 TOTAL_INVESTMENT，也就是100
+
+    with span('back_trade.frames', funds=len(tickers)):
+        dates = portfolio_funds_data_df.index
+        portfolio_value_series = pd.Series(portfolio_values, index=dates)
+        funds_value_dict = {}
+        for i, ticker in enumerate(tickers):
+            funds_value_dict[ticker] = pd.DataFrame({'date': dates, 
+                                                     'net_value': net_values[:, i], 
+                                                     'shares': shares[:, i], 
+                                                     'fund_value': fund_values[:, i]})
     
-    # 计算最后一个周期
-    max_dd = dd_peak_value - dd_bottom_value      
-    if (max_dd > max_dd_candidate): # 当前的回撤更高 查看最后一个
-        dd_peak_date_candidate = dd_peak_date
-        dd_bottom_date_candidate = dd_bottom_date
-        dd_peak_value_candidate = dd_peak_value
-        dd_bottom_value_candidate = dd_bottom_value
-        max_dd_candidate = max_dd   
+    return portfolio_value_series, funds_value_dict
+
+
+TRADING_DAYS_PER_YEAR = 250  # 计算年化波动率时使用
+
+
+def period_portfolio_values(net_values, weights, rebalance_period):
+    '''
+    (... × days × funds) 的净值和 (funds × K) 的权重，返回 (... × days × K) 的组合价值，重平衡规则和 back_trade_arrays 相同。
+    每个重平衡周期内的价值 = 周期开始时的组合价值 × Σ 权重 × 当天净值 / 周期开始日净值。
+    前面的维度可以是多条净值路径（例如 bootstrap 生成的模拟路径），各自独立计算。
+    '''
+    num_days = net_values.shape[-2]
+    offsets = np.arange(num_days)
+    period_index = np.maximum(offsets - 1, 0) // rebalance_period  # 重平衡当天的价值属于上一个周期的末尾
+    growth = (net_values / net_values[..., period_index * rebalance_period, :]) @ weights
+    period_start_values = np.ones(growth.shape[:-2] + (period_index[-1] + 1, weights.shape[-1])) * TOTAL_INVESTMENT
+    period_start_values[..., 1:, :] *= np.cumprod(growth[..., rebalance_period:num_days:rebalance_period, :], axis=-2)[..., :period_index[-1], :]
+    return period_start_values[..., period_index, :] * growth
+
+
+def max_dd_percents(values, axis=0):
+    ''' 沿 axis（时间）计算最大回撤比例（%）：和 calculate_max_dd 相同，取绝对回撤最大的一次，再换算为比例 '''
+    running_peak = np.maximum.accumulate(values, axis=axis)
+    bottom = np.expand_dims(np.argmax(running_peak - values, axis=axis), axis)
+    return ((1 - np.take_along_axis(values, bottom, axis) / np.take_along_axis(running_peak, bottom, axis)) * 100).squeeze(axis)
+
+
+def _window_net_values(raw_net_values, filled_net_values, next_valid_rows, starts, ends, max_length):
+    '''
+    取出一批窗口的净值，得到 (windows × max_length × funds) 的数组，和逐个窗口 ffill().bfill() 的结果相同：
+    窗口内先用前值填补，窗口开头的空值用窗口内第一个有效值填补。超出窗口长度的部分重复窗口最后一天。
+    '''
+    offsets = np.arange(max_length)
+    rows = np.minimum(starts[:, np.newaxis] + offsets, ends[:, np.newaxis] - 1)
+    net_values = filled_net_values[rows]
+
+    first_valid = next_valid_rows[starts]  # (windows × funds) 窗口开始后第一个有效值所在的行
+    funds = np.arange(raw_net_values.shape[1])
+    leading_values = np.where(first_valid < ends[:, np.newaxis], 
+                              raw_net_values[np.minimum(first_valid, len(raw_net_values) - 1), funds], np.nan)
+    is_leading = offsets[np.newaxis, :, np.newaxis] < (first_valid - starts[:, np.newaxis])[:, np.newaxis, :]
+    return np.where(is_leading, leading_values[:, np.newaxis, :], net_values)
+
+
+def rolling_windows_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_period, windows, chunk_size=256) -> pd.DataFrame:
+    '''
+    一次向量化计算多个 (start_date, end_date) 窗口的回测结果，每个窗口的重平衡规则和 fund_portfolio_back_trade 相同。
+
+    每个窗口内第 k 个重平衡周期的组合价值 = 周期开始时的组合价值 × Σ 权重 × 当天净值 / 周期开始日净值，
+    周期开始时的组合价值是之前各周期增长倍数的累乘，所以所有窗口可以用同一批数组一起计算，不需要逐个窗口模拟。
+    窗口按 chunk_size 分批计算，以控制内存。
+
+    Parameters:
+    - portfolio_funds_data_df (pd.DataFrame): load_portfolio_funds_data 返回的面板，不需要预先填补空值，需要覆盖所有窗口。
+    - windows: (start_date, end_date) 列表。
+
+    Returns:
+    - pd.DataFrame: 每个窗口一行，列包括 start_date, end_date, annualized_return（%），max_dd_percent（%），volatility（年化，%）
+    '''
+    raw_net_values = portfolio_funds_data_df[portfolio_df.index].to_numpy(dtype=np.float64)
+    filled_net_values = pd.DataFrame(raw_net_values).ffill().to_numpy()
+    num_days = len(raw_net_values)
+    row_numbers = np.where(np.isnan(raw_net_values), num_days, np.arange(num_days)[:, np.newaxis])
+    next_valid_rows = np.minimum.accumulate(row_numbers[::-1], axis=0)[::-1]
+    weights = portfolio_df['target_percent'].to_numpy(dtype=np.float64) / 100
+
+    dates = portfolio_funds_data_df.index.to_numpy(dtype='datetime64[ns]')
+    start_dates = pd.DatetimeIndex([pd.Timestamp(start) for start, _ in windows])
+    end_dates = pd.DatetimeIndex([pd.Timestamp(end) for _, end in windows])
+    all_starts = np.searchsorted(dates, start_dates.to_numpy(dtype='datetime64[ns]'), side='left')
+    all_ends = np.searchsorted(dates, end_dates.to_numpy(dtype='datetime64[ns]'), side='right')
     
-    return max_dd_candidate, dd_peak_date_candidate, dd_bottom_date_candidate, dd_peak_value_candidate, dd_bottom_value_candidate  
-        
+    end_values = np.full(len(windows), np.nan)
+    max_drawdowns = np.full(len(windows), np.nan)
+    volatilities = np.full(len(windows), np.nan)
+    for chunk_start in range(0, len(windows), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        starts, ends = all_starts[chunk], all_ends[chunk]
+        lengths = ends - starts
+        valid = lengths > 0
+        if not valid.any():
+            continue
+        starts, ends, lengths = starts[valid], ends[valid], lengths[valid]
+        max_length = lengths.max()
 
-def fund_portfolio_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_period):
-    TOTAL_INVESTMENT = 100.0
+        with span('rolling_windows_back_trade.chunk', windows=len(starts), days=int(max_length)):
+            net_values = _window_net_values(raw_net_values, filled_net_values, next_valid_rows, starts, ends, max_length)
+            portfolio_values = period_portfolio_values(net_values, weights[:, np.newaxis], rebalance_period)[..., 0]
+            chunk_end_values = portfolio_values[np.arange(len(starts)), lengths - 1]
+            chunk_max_dd_percents = max_dd_percents(portfolio_values, axis=1)  # 窗口之后重复最后一天的价值，不影响回撤
+
+            offsets = np.arange(max_length)
+            daily_returns = portfolio_values[:, 1:] / portfolio_values[:, :-1] - 1
+            in_window = offsets[np.newaxis, 1:] < lengths[:, np.newaxis]
+            counts = in_window.sum(axis=1)
+            means = np.where(in_window, daily_returns, 0).sum(axis=1) / np.maximum(counts, 1)
+            variances = np.where(in_window, (daily_returns - means[:, np.newaxis]) ** 2, 0).sum(axis=1) / np.maximum(counts - 1, 1)
+            chunk_volatilities = np.where(counts > 1, np.sqrt(variances * TRADING_DAYS_PER_YEAR) * 100, np.nan)
+
+            chunk_indices = np.arange(chunk_start, min(chunk_start + chunk_size, len(windows)))[valid]
+            end_values[chunk_indices] = chunk_end_values
+            max_drawdowns[chunk_indices] = chunk_max_dd_percents
+            volatilities[chunk_indices] = chunk_volatilities
+
+    years = (end_dates - start_dates).days.to_numpy() / 365.0
+    annualized_returns = ((end_values / TOTAL_INVESTMENT) ** (1 / years) - 1) * 100
+    return pd.DataFrame({'start_date': start_dates, 'end_date': end_dates, 
+                         'annualized_return': annualized_returns, 
+                         'max_dd_percent': max_drawdowns, 
+                         'volatility': volatilities})
+
+
+def batch_back_trade(portfolio_funds_data_df, target_percents, rebalance_period, chunk_size=1024) -> pd.DataFrame:
+    '''
+    在同一个净值面板上一次回测 K 组不同的目标比例，每组的重平衡规则和 fund_portfolio_back_trade 相同。
+    K 组按 chunk_size 分批计算，每批只保存 (days × chunk_size) 的组合价值，内存和 K 无关。
+
+    Parameters:
+    - portfolio_funds_data_df (pd.DataFrame): 已经填补空值的净值面板（同 fund_portfolio_back_trade）。
+    - target_percents (pd.DataFrame | np.ndarray): (K × funds) 的目标比例（百分比），每行一个组合。
+      DataFrame 的列为 ticker，索引作为结果的索引；np.ndarray 的列和 portfolio_funds_data_df 的列一一对应。
+
+    Returns:
+    - pd.DataFrame: 每个组合一行，列为 end_value, annualized_return（%），max_dd_percent（%），volatility（年化，%），
+      以及每年的收益率 return_<年份>（%，同 fund_portfolio_back_trade_basic：当年最后一天相对当年第一天）。
+    '''
+    if isinstance(target_percents, pd.DataFrame):
+        index = target_percents.index
+        net_values = portfolio_funds_data_df[target_percents.columns].to_numpy(dtype=np.float64)
+        target_percents = target_percents.to_numpy(dtype=np.float64)
+    else:
+        target_percents = np.atleast_2d(np.asarray(target_percents, dtype=np.float64))
+        index = pd.RangeIndex(len(target_percents))
+        net_values = portfolio_funds_data_df.to_numpy(dtype=np.float64)
+    num_portfolios = len(target_percents)
+
+    dates = portfolio_funds_data_df.index
+    years = dates.year.to_numpy()
+    year_starts = np.flatnonzero(np.append(True, years[1:] != years[:-1]))
+    year_ends = np.append(year_starts[1:], len(dates)) - 1
+
+    end_values = np.empty(num_portfolios)
+    max_drawdowns = np.empty(num_portfolios)
+    volatilities = np.empty(num_portfolios)
+    year_returns = np.empty((num_portfolios, len(year_starts)))
+    for chunk_start in range(0, num_portfolios, chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        weights = target_percents[chunk].T / 100
+        with span('batch_back_trade.chunk', portfolios=weights.shape[1], days=len(net_values)):
+            portfolio_values = period_portfolio_values(net_values, weights, rebalance_period)
+            end_values[chunk] = portfolio_values[-1]
+
+            max_drawdowns[chunk] = max_dd_percents(portfolio_values, axis=0)
+
+            daily_returns = portfolio_values[1:] / portfolio_values[:-1] - 1
+            volatilities[chunk] = np.std(daily_returns, axis=0, ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR) * 100 \
+                if len(daily_returns) > 1 else np.nan
+            year_returns[chunk] = (portfolio_values[year_ends] / portfolio_values[year_starts] - 1).T * 100
+
+    period_years = (dates[-1] - dates[0]).days / 365.0
+    metrics_df = pd.DataFrame({'end_value': end_values, 
+                               'annualized_return': ((end_values / TOTAL_INVESTMENT) ** (1 / period_years) - 1) * 100, 
+                               'max_dd_percent': max_drawdowns, 
+                               'volatility': volatilities}, index=index)
+    year_returns_df = pd.DataFrame(year_returns, index=index, columns=['return_{}'.format(year) for year in years[year_starts]])
+    return pd.concat([metrics_df, year_returns_df], axis=1)
+
+
+REBALANCE_CALENDARS = ['M', 'Q', 'Y']  # 每月、每季度、每年的第一个交易日
+DRIFT_SEARCH_DAYS = 64  # 查找偏离超限的日子时，第一次检查的天数，之后每次加倍
+
+
+def calendar_rebalance_rows(dates: pd.DatetimeIndex, calendar) -> np.ndarray:
+    '''
+    日历重平衡的行号，不含第 0 行（建仓日）。
+
+    Parameters:
+    - calendar: int 表示每多少个交易日（同 rebalance_period），'M' / 'Q' / 'Y' 表示每月 / 季度 / 年的第一个交易日，None 表示没有日历重平衡
+    '''
+    if calendar is None:
+        return np.empty(0, dtype=np.int64)
+    if isinstance(calendar, (int, np.integer)):
+        return rebalance_day_indices(len(dates), calendar)[1:]
+    if calendar not in REBALANCE_CALENDARS:
+        raise ValueError('未知的日历重平衡规则: {}'.format(calendar))
+    years = dates.year.to_numpy()
+    keys = {'M': years * 12 + dates.month.to_numpy(), 'Q': years * 4 + dates.quarter.to_numpy(), 'Y': years}[calendar]
+    return np.flatnonzero(keys[1:] != keys[:-1]) + 1
+
+
+def _first_drift(net_values, weights, start, rows, drift_band):
+    '''
+    从 start 日重平衡之后，rows 中第一个有基金的比例偏离目标超过 drift_band 的行，没有时返回 None。
+    比例只由 净值 / start 日净值 决定，所以可以一次检查一批日子；检查的天数逐次加倍，找到后不再计算之后的日子。
+    '''
+    checked = 0
+    block = DRIFT_SEARCH_DAYS
+    while checked < len(rows):
+        block_rows = rows[checked:checked + block]
+        ratios = net_values[block_rows] / net_values[start]
+        fund_weights = weights * ratios / (ratios @ weights)[:, np.newaxis]
+        drifted = np.flatnonzero(np.abs(fund_weights - weights).max(axis=1) > drift_band)
+        if len(drifted) > 0:
+            return block_rows[drifted[0]]
+        checked += block
+        block *= 2
+    return None
+
+
+def event_back_trade_arrays(net_values: np.ndarray, target_percents: np.ndarray, calendar_rows: np.ndarray,
+                            drift_band: float = None, combine: str = 'or'):
+    '''
+    按事件重平衡的组合回测核心，重平衡当天的处理和 back_trade_arrays 相同（收盘后按当天的组合价值重新分配份额）。
+
+    两次重平衡之间份额不变，组合价值 = 上次重平衡后的价值 × Σ 目标比例 × 净值 / 上次重平衡日净值，
+    所以每次直接计算到下一个事件，不逐日模拟；查找偏离超限的日子也是用这个比值批量计算（见 _first_drift）。
+
+    Parameters:
+    - net_values (np.ndarray): (days × funds) 的累计净值矩阵，不能有空值。
+    - calendar_rows (np.ndarray): 日历重平衡的行号（calendar_rebalance_rows）。
+    - drift_band (float): 任何一个基金的比例和目标比例相差超过 drift_band（百分点）时重平衡，None 表示不检查。
+    - combine: 同时有日历和 drift_band 时，'or' 表示日历日和偏离超限时都重平衡，'and' 表示只在日历日检查，偏离超限才重平衡。
+
+    Returns:
+    - portfolio_values (np.ndarray): 每天的组合整体价值。
+    - events (np.ndarray): 每次重平衡一行，(行号, 是否日历日, 是否偏离超限, 重平衡前最大偏离（百分点）, 换手率（%，单边，即买入的金额占组合价值的比例）)
+    '''
+    if combine not in ('or', 'and'):
+        raise ValueError('未知的组合方式: {}'.format(combine))
+    net_values = np.asarray(net_values, dtype=np.float64)
+    weights = np.asarray(target_percents, dtype=np.float64) / 100
+    calendar_rows = np.asarray(calendar_rows, dtype=np.int64)
+    band = None if drift_band is None else drift_band / 100
+    num_days = len(net_values)
+
+    portfolio_values = np.empty(num_days)
+    events = []
+    start, start_value = 0, TOTAL_INVESTMENT
+    while True:
+        remaining_calendar = calendar_rows[np.searchsorted(calendar_rows, start, side='right'):]
+        next_calendar = int(remaining_calendar[0]) if len(remaining_calendar) > 0 else num_days
+        if band is None:
+            event = next_calendar
+        elif combine == 'or':
+            drift_row = _first_drift(net_values, weights, start, range(start + 1, next_calendar), band)
+            event = next_calendar if drift_row is None else drift_row
+        else:
+            drift_row = _first_drift(net_values, weights, start, remaining_calendar, band)
+            event = num_days if drift_row is None else int(drift_row)
+
+        end = min(event, num_days - 1)
+        growth = (net_values[start:end + 1] / net_values[start]) @ weights
+        portfolio_values[start:end + 1] = start_value * growth
+        if event >= num_days:
+            break
+        fund_weights = weights * net_values[event] / net_values[start] / growth[-1]
+        drift = np.abs(fund_weights - weights)
+        on_calendar = event in calendar_rows
+        drifted = band is not None and drift.max() > band
+        events.append((event, on_calendar, drifted, drift.max() * 100, drift.sum() / 2 * 100))
+        start, start_value = event, portfolio_values[event]
+
+    return portfolio_values, np.array(events, dtype=np.float64).reshape(-1, 5)
+
+
+def fund_portfolio_event_back_trade(portfolio_df, portfolio_funds_data_df, calendar=None, drift_band=None, combine='or'):
+    '''
+    组合回测：按 target_percent 建仓，按日历（calendar）和/或偏离（drift_band）重平衡，参数见 event_back_trade_arrays。
+    calendar 为 int 且没有 drift_band 时，结果和 fund_portfolio_back_trade(rebalance_period=calendar) 相同。
+
+    Returns:
+    - portfolio_value_series (pd.Series): 每天的组合整体价值，日期为索引。
+    - events_df (pd.DataFrame): 每次重平衡一行，列为 date, reason（'calendar'、'drift'，日历日同时偏离超限时为 'calendar+drift'，combine='and' 时都是这种），max_drift_percent, turnover_percent
+    '''
+    dates = portfolio_funds_data_df.index
+    net_values = portfolio_funds_data_df[portfolio_df.index].to_numpy(dtype=np.float64)
+    calendar_rows = calendar_rebalance_rows(dates, calendar)
+    with span('event_back_trade.arrays', days=len(net_values), funds=len(portfolio_df)) as event_span:
+        portfolio_values, events = event_back_trade_arrays(net_values, portfolio_df['target_percent'].to_numpy(),
+                                                           calendar_rows, drift_band, combine)
+        event_span.set(events=len(events))
+    event_rows = events[:, 0].astype(np.int64)
+    events_df = pd.DataFrame({'date': dates[event_rows],
+                              'reason': np.select([(events[:, 1] > 0) & (events[:, 2] > 0), events[:, 1] > 0], ['calendar+drift', 'calendar'], 'drift'),
+                              'max_drift_percent': events[:, 3],
+                              'turnover_percent': events[:, 4]})
+    return pd.Series(portfolio_values, index=dates), events_df
+
+
+def _policy_label(calendar, drift_band, combine) -> str:
+    labels = [str(calendar)] if calendar is not None else []
+    if drift_band is not None:
+        labels.append('band {:g}'.format(drift_band))
+    return (' | ' if combine == 'or' else ' & ').join(labels) if labels else 'buy and hold'
+
+
+def compare_rebalance_policies(portfolio_df, portfolio_funds_data_df, policies) -> pd.DataFrame:
+    '''
+    在同一个净值面板上比较多个重平衡规则。
+
+    Parameters:
+    - policies: dict 的列表，每个 dict 为 fund_portfolio_event_back_trade 的参数（calendar, drift_band, combine）。
+
+    Returns:
+    - pd.DataFrame: 每个规则一行，索引为规则的说明（例如 'Q | band 5'），列为 end_value, annualized_return（%），max_dd_percent（%），
+      volatility（年化，%），events（重平衡次数），turnover_percent（累计单边换手率，%），annual_turnover_percent
+    '''
+    dates = portfolio_funds_data_df.index
+    net_values = portfolio_funds_data_df[portfolio_df.index].to_numpy(dtype=np.float64)
+    target_percents = portfolio_df['target_percent'].to_numpy()
+    years = (dates[-1] - dates[0]).days / 365.0
+
+    labels, rows = [], []
+    values = np.empty((len(dates), len(policies)))
+    for i, policy in enumerate(policies):
+        calendar, drift_band, combine = policy.get('calendar'), policy.get('drift_band'), policy.get('combine', 'or')
+        values[:, i], events = event_back_trade_arrays(net_values, target_percents, calendar_rebalance_rows(dates, calendar), drift_band, combine)
+        labels.append(_policy_label(calendar, drift_band, combine))
+        rows.append(dict(events=len(events), turnover_percent=events[:, 4].sum()))
+    summary_df = pd.DataFrame(rows, index=pd.Index(labels, name='policy'))
+
+    max_dd_df = calculate_max_dd(pd.DataFrame(values, index=dates))
+    daily_returns = values[1:] / values[:-1] - 1
+    summary_df.insert(0, 'end_value', values[-1])
+    summary_df.insert(1, 'annualized_return', ((values[-1] / TOTAL_INVESTMENT) ** (1 / years) - 1) * 100)
+    summary_df.insert(2, 'max_dd_percent', (max_dd_df['max_dd'] / max_dd_df['dd_peak_value']).to_numpy() * 100)
+    summary_df.insert(3, 'volatility', np.std(daily_returns, axis=0, ddof=1) * np.sqrt(TRADING_DAYS_PER_YEAR) * 100)
+    summary_df['annual_turnover_percent'] = summary_df['turnover_percent'] / years
+    return summary_df
+
+
+def check_back_trade_parity(portfolio_df, portfolio_funds_data_df, rebalance_period, rtol=1e-9):
+    ''' 校验 fund_portfolio_back_trade 与 fund_portfolio_back_trade_legacy 的结果一致，返回不一致的项目列表 '''
+    value_series, funds_value_dict = fund_portfolio_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_period)
+    legacy_value_series, legacy_funds_value_dict = fund_portfolio_back_trade_legacy(portfolio_df, portfolio_funds_data_df, rebalance_period)
+
+    mismatches = []
+    if not value_series.index.equals(legacy_value_series.index) or \
+            not np.allclose(value_series.to_numpy(), legacy_value_series.to_numpy(dtype=np.float64), rtol=rtol):
+        mismatches.append('portfolio_value_series')
+    for ticker in portfolio_df.index:
+        fund_value_df = funds_value_dict[ticker]
+        legacy_fund_value_df = legacy_funds_value_dict[ticker]
+        if not (fund_value_df['date'].to_numpy() == legacy_fund_value_df['date'].to_numpy()).all():
+            mismatches.append(ticker + ':date')
+        for column in ['net_value', 'shares', 'fund_value']:
+            if not np.allclose(fund_value_df[column].to_numpy(), legacy_fund_value_df[column].to_numpy(dtype=np.float64), rtol=rtol):
+                mismatches.append(ticker + ':' + column)
+    return mismatches
+
+
+def fund_portfolio_back_trade_legacy(portfolio_df, portfolio_funds_data_df, rebalance_period):
+    ''' 逐日逐基金 pd.concat 的原始实现，保留用于和 fund_portfolio_back_trade 做一致性校验 '''
     start_date = portfolio_funds_data_df.index[0] # 第一个日期，即开始日期
     
     funds_value_dict = {}  # map of fund ticker to fund_value_df  对应与excel中，每个fund一个sheet，每个sheet记录 date，net_value（当天的基金单位净值），shares（持有份额），fund_value（基金持仓价值）
@@ -100,3 +566,38 @@ def fund_portfolio_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_p
     
     return portfolio_value_series, funds_value_dict
 
+
+if __name__ == "__main__":
+    # 在 data/ 中的基金数据上，校验新旧两种实现的结果一致
+    import fund_code
+    from fund_data_prepare_util import load_portfolio_funds_data
+
+    portfolio_df = pd.DataFrame(fund_code.Portfolio_LaoHuangNiu, columns=fund_code.Portfolio_Columns)
+    portfolio_df.set_index('ticker', inplace=True)
+    portfolio_funds_data_df = load_portfolio_funds_data(portfolio_df.index, pd.to_datetime('2016-01-01'), pd.to_datetime('2024-04-22')).ffill().bfill()
+
+    for rebalance_days in [1, 20, 220, len(portfolio_funds_data_df)]:
+        mismatches = check_back_trade_parity(portfolio_df, portfolio_funds_data_df, rebalance_days)
+        print("rebalance_days {}: {}".format(rebalance_days, "一致" if not mismatches else "不一致 " + ", ".join(mismatches)))
+
+    # 批量回测和逐个回测的结果一致
+    rng = np.random.default_rng(0)
+    batch_percents = pd.DataFrame(rng.dirichlet(np.ones(len(portfolio_df)), size=1000) * 100, columns=portfolio_df.index)
+    batch_percents.iloc[0] = portfolio_df['target_percent']
+    batch_df = batch_back_trade(portfolio_funds_data_df, batch_percents, 220)
+    for k in [0, 1, 999]:
+        single_df = portfolio_df.assign(target_percent=batch_percents.iloc[k])
+        value_series, _ = fund_portfolio_back_trade(single_df, portfolio_funds_data_df, 220)
+        max_dd, _, _, dd_peak_value, _ = calculate_max_dd(value_series)
+        consistent = np.isclose(batch_df['end_value'].iloc[k], value_series.iloc[-1]) and \
+            np.isclose(batch_df['max_dd_percent'].iloc[k], max_dd / dd_peak_value * 100)
+        print("batch {}: {}".format(k, "一致" if consistent else "不一致"))
+
+    # 按事件重平衡：日历为交易日数时和 fund_portfolio_back_trade 一致；比较不同的重平衡规则
+    for rebalance_days in [20, 220]:
+        value_series, _ = fund_portfolio_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_days)
+        event_value_series, _ = fund_portfolio_event_back_trade(portfolio_df, portfolio_funds_data_df, calendar=rebalance_days)
+        print("event rebalance_days {}: {}".format(rebalance_days, "一致" if np.allclose(value_series, event_value_series) else "不一致"))
+    policies = [dict(calendar=220), dict(calendar='M'), dict(calendar='Q'), dict(calendar='Y'), dict(), 
+                dict(drift_band=3), dict(drift_band=5), dict(calendar='Q', drift_band=5), dict(calendar='M', drift_band=3, combine='and')]
+    print(compare_rebalance_policies(portfolio_df, portfolio_funds_data_df, policies).round(2).to_string())
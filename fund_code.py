@@ -41,4 +41,10 @@ Portfolio_LaoHuangNiu = [
 #     ['004388', '鹏华债券', 8, TYPE_FIXED], 
 #     ['000032', '易方达信用债', 8, TYPE_FIXED],
 #     ['000187', '华泰博瑞', 8, TYPE_FIXED]
-# ]
\ No newline at end of file
+# ]
+
+# 优化组合权重时（fund_optimizer），每个类型合计比例的上限（百分比）
+Portfolio_Type_Caps = {
+    TYPE_EQUITY: 60,
+    TYPE_FIXED: 100
+}
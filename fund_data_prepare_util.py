@@ -1,40 +1,136 @@
-import akshare as ak
+import numpy as np
 import pandas as pd
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import fund_code 
+import fund_nav_store
+from data_cache import read_canonical
+from phase_timer import span
 
 
 DATA_PATH='./data'
 
-def download_fund_data(ticker: str):
+PANEL_CACHE_MAX_BYTES = 256 * 1024 * 1024  # 面板缓存默认内存上限
+
+def download_fund_data(ticker: str, export_csv: bool = True):
     """ 
-    利用 akshare 下载基金累计净值数据， 并且存放到data/<ticker>.csv文件中 
+    利用 akshare 下载基金累计净值数据， 并且存放到列式存储 data/nav_store/<ticker>/ 中。
+    export_csv 为 True 时，同时导出一份 data/<ticker>.csv 
     """
+    import akshare as ak  # 只在下载时导入，回测和读取本地数据不需要 akshare
     data = ak.fund_open_fund_info_em(fund=ticker, indicator="累计净值走势")
     data.columns = ['date', 'net_value']  # 重命名列名，以符合我们的习惯
-    filename = ticker + '.csv'
-    data.to_csv(os.path.join(DATA_PATH, filename), index=False)
+    if export_csv:  # 先写 CSV 再写存储，使存储比 CSV 新，load_fund_data 不会再重复导入
+        data.to_csv(fund_nav_store.csv_path(ticker), index=False)
+    fund_nav_store.write_nav(ticker, data)
     print("fund ticker {}, downloaded from date {}, to date {}".format(ticker, data.date.min(), data.date.max()))
 
 
+class AkshareFundNavSource:
+    """ 通过 akshare 获取基金累计净值。接口只能返回全部历史，since 之后的数据在本地过滤 """
+
+    def fetch(self, ticker: str, since=None) -> pd.DataFrame:
+        import akshare as ak
+        data = ak.fund_open_fund_info_em(fund=ticker, indicator="累计净值走势")
+        data.columns = ['date', 'net_value']  # 重命名列名，以符合我们的习惯
+        return _rows_after(data, since)
+
+
+class CsvFundNavSource:
+    """ 从一个目录下的 <ticker>.csv 读取基金累计净值，用于离线运行和测试，代替网络数据源 """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def fetch(self, ticker: str, since=None) -> pd.DataFrame:
+        data = read_canonical(os.path.join(self.path, ticker + '.csv')).reset_index()
+        return _rows_after(data, since)
+
+
+def _rows_after(data: pd.DataFrame, since) -> pd.DataFrame:
+    if since is None:
+        return data
+    return data[pd.to_datetime(data['date']) > pd.Timestamp(since)]
+
+
+def sync_fund_data(ticker: str, source=None, export_csv: bool = True, retries: int = 3, backoff: float = 1.0) -> int:
+    """
+    增量同步一个基金的累计净值：只获取存储中最后一个日期之后的数据并追加。
+    失败时重试 retries 次，每次等待 backoff, 2*backoff, 4*backoff ... 秒。
+
+    Returns:
+    - int: 新增的行数
+    """
+    source = source or AkshareFundNavSource()
+    fund_nav_store.ensure_nav(ticker)  # 已有 CSV 但还没有导入存储时，先导入
+    since = fund_nav_store.last_nav_date(ticker)
+    
+    for attempt in range(retries + 1):
+        try:
+            data = source.fetch(ticker, since)
+            break
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print("fund ticker {}, fetch failed ({}), retry in {:.1f}s".format(ticker, e, backoff * 2 ** attempt))
+            time.sleep(backoff * 2 ** attempt)
+
+    if len(data) == 0:
+        return 0
+    
+    if export_csv:  # 先写 CSV 再写存储，使存储比 CSV 新
+        path = fund_nav_store.csv_path(ticker)
+        if since is not None and os.path.exists(path):
+            data.to_csv(path, mode='a', header=False, index=False)
+        else:
+            data.to_csv(path, index=False)
+    fund_nav_store.append_nav(ticker, data)
+    print("fund ticker {}, synced {} rows, to date {}".format(ticker, len(data), data['date'].max()))
+    return len(data)
+
+
+def sync_funds_data(tickers, source=None, max_workers: int = 4, **kwargs) -> dict:
+    """
+    用有上限的线程池并发地增量同步多个基金，参数同 sync_fund_data。
+
+    Returns:
+    - dict: ticker -> 新增行数；同步失败的基金对应的是异常对象
+    """
+    source = source or AkshareFundNavSource()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {ticker: executor.submit(sync_fund_data, ticker, source, **kwargs) for ticker in tickers}
+        for ticker, future in futures.items():
+            try:
+                results[ticker] = future.result()
+            except Exception as e:
+                print("fund ticker {}, sync failed: {}".format(ticker, e))
+                results[ticker] = e
+    return results
+
+
 def load_fund_data(ticker, start_date, end_date) -> pd.DataFrame:
     ''' 
-    从 csv 文件中读取加载基金累计净值数据，并且只截取 [start_date, end_date] 区间的数据
+    从列式存储中读取加载基金累计净值数据，只读取 [start_date, end_date] 区间的数据。
+    存储中还没有该基金时，先从 data/<ticker>.csv 导入。
     
     Returns:
     pd.DataFrame: index是date, 列包括'net_value'
     '''
     
-    data_df = pd.read_csv(os.path.join(DATA_PATH, ticker + '.csv'))
-    data_df['date'] = pd.to_datetime(data_df['date'])   
-    data_sliced_df = data_df[(data_df['date'] >= start_date) & (data_df['date'] <= end_date)]
-    data_sliced_df.set_index('date', inplace=True)
+    with span('load_fund_data', ticker=ticker) as load_span:
+        fund_nav_store.ensure_nav(ticker)
+        dates, values = fund_nav_store.read_nav(ticker, start_date, end_date)
+        data_sliced_df = pd.DataFrame({'net_value': values}, index=pd.DatetimeIndex(dates, name='date'))
+        load_span.set(rows=len(values))
     
     return data_sliced_df
 
 
-def load_portfolio_funds_data(ticker_series: pd.Series, start_date, end_date) -> pd.DataFrame:
+def load_portfolio_funds_data(ticker_series: pd.Series, start_date, end_date, cache=None) -> pd.DataFrame:
     """
     获取portfolio 中每个基金的累计净值数据。
 
@@ -42,6 +138,7 @@ def load_portfolio_funds_data(ticker_series: pd.Series, start_date, end_date) ->
     - ticker_series (pd.Series): 基金代码序列。
     - start_date: 开始日期。
     - end_date: 结束日期。
+    - cache (FundPanelCache): 可选，传入时从缓存的全历史面板中切片，而不是重新读取。
 
     Returns:
     - DataFrame: 各基金累计净值数据，日期为索引。
@@ -53,27 +150,95 @@ def load_portfolio_funds_data(ticker_series: pd.Series, start_date, end_date) ->
     2023-10-28  2.1225  3.3480  1.6984  1.5129
     """
     
-    # 收集各基金的 DataFrame 列表
-    funds_data_frames = []
-    for ticker in ticker_series:
-        fund_data_df = load_fund_data(ticker, start_date, end_date)  # 暂时不填补非交易日数据，后续再考虑如何填补非交易日数据
-        fund_data_df = fund_data_df.rename(columns={'net_value': ticker})
-        funds_data_frames.append(fund_data_df)
-
-    # 使用 concat 一次性合并所有 DataFrame
-    if funds_data_frames:
-        portfolio_funds_data_df = pd.concat(funds_data_frames, axis=1)
-    else:
-        portfolio_funds_data_df = pd.DataFrame()
-
-    portfolio_funds_data_df = portfolio_funds_data_df.rename_axis('date')
+    if cache is not None:
+        return cache.get_panel(ticker_series, start_date, end_date)
+    
+    # 直接从各基金的日期/净值数组拼出对齐后的矩阵，避免逐个构造 DataFrame 再 concat
+    with span('load_funds.read') as read_span:
+        funds_arrays = []
+        for ticker in ticker_series:
+            fund_nav_store.ensure_nav(ticker)
+            funds_arrays.append(fund_nav_store.read_nav(ticker, start_date, end_date))  # 暂时不填补非交易日数据，后续再考虑如何填补非交易日数据
+        read_span.set(funds=len(funds_arrays), rows=sum(len(dates) for dates, _ in funds_arrays))
+
+    with span('load_funds.align') as align_span:
+        all_dates = np.unique(np.concatenate([dates for dates, _ in funds_arrays])) if funds_arrays else np.array([], dtype='datetime64[ns]')
+        net_values = np.full((len(all_dates), len(funds_arrays)), np.nan)
+        for i, (dates, values) in enumerate(funds_arrays):
+            net_values[np.searchsorted(all_dates, dates), i] = values
+        align_span.set(days=len(all_dates))
+
+    portfolio_funds_data_df = pd.DataFrame(net_values, index=pd.DatetimeIndex(all_dates, name='date'), columns=list(ticker_series))
     return portfolio_funds_data_df
 
 
+class FundPanelCache:
+    """
+    进程内的基金净值面板缓存。
+
+    每组基金代码只加载一次全部历史，对齐成一个面板，之后不同 [start_date, end_date] 的请求都从面板中切片。
+    基金数据文件的修改时间变化时重新加载；缓存总大小超过 max_bytes 时，淘汰最久没有使用的面板（LRU）。
+    """
+
+    def __init__(self, max_bytes: int = PANEL_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._panels = OrderedDict()  # tuple(tickers) -> (mtimes, panel_df, nbytes)
+        self._total_bytes = 0
+
+    def _file_mtimes(self, tickers):
+        mtimes = []
+        for ticker in tickers:
+            fund_nav_store.ensure_nav(ticker)  # CSV 比存储新时会重新导入，存储的修改时间随之变化
+            mtimes.append(fund_nav_store.store_mtime(ticker))
+        return tuple(mtimes)
+
+    def _drop(self, key):
+        _, _, nbytes = self._panels.pop(key)
+        self._total_bytes -= nbytes
+
+    def get_panel(self, ticker_series, start_date, end_date) -> pd.DataFrame:
+        with span('panel_cache.get') as cache_span:
+            key = tuple(ticker_series)
+            mtimes = self._file_mtimes(key)
+            
+            entry = self._panels.get(key)
+            if entry is not None and entry[0] == mtimes:
+                self.hits += 1
+                self._panels.move_to_end(key)
+                cache_span.set(hits=1, misses=0)
+            else:
+                self.misses += 1
+                cache_span.set(hits=0, misses=1)
+                if entry is not None:
+                    self._drop(key)
+                panel_df = load_portfolio_funds_data(key, None, None)
+                nbytes = int(panel_df.memory_usage(index=True).sum())
+                entry = self._panels[key] = (mtimes, panel_df, nbytes)
+                self._total_bytes += nbytes
+                while self._total_bytes > self.max_bytes and len(self._panels) > 1:  # 至少保留刚加载的面板
+                    self._drop(next(iter(self._panels)))
+                    self.evictions += 1
+
+            panel_df = entry[1]
+            window_df = panel_df.loc[pd.Timestamp(start_date):pd.Timestamp(end_date)].copy()
+            cache_span.set(rows=len(window_df))
+            return window_df
+
+    def clear(self):
+        self._panels.clear()
+        self._total_bytes = 0
+
+    def stats(self) -> dict:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, 
+                    panels=len(self._panels), total_bytes=self._total_bytes, max_bytes=self.max_bytes)
+
+
 if __name__ == "__main__":
     
-    for item in fund_code.Portfolio_LaoHuangNiu:
-        download_fund_data(item[0])
+    sync_funds_data([item[0] for item in fund_code.Portfolio_LaoHuangNiu])
         
         
     
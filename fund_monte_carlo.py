@@ -0,0 +1,98 @@
+import numpy as np
+import pandas as pd
+
+from fund_backtrade_util import period_portfolio_values, max_dd_percents, TOTAL_INVESTMENT, TRADING_DAYS_PER_YEAR
+from phase_timer import span, starmap_with_spans
+
+# 用 block bootstrap 模拟组合的结果分布，代替只用几十个互相重叠的历史窗口：
+# 从净值面板的日收益率（每天一个各基金收益率组成的向量，保留基金之间的相关性）中随机抽取连续 block_size 天的片段，
+# 拼成 path_days 天的模拟净值路径，再按 fund_portfolio_back_trade 的重平衡规则计算组合价值。
+#
+# 路径按 chunk_size 分批生成和计算，每批只保存 (chunk_size × path_days × funds) 的数组，峰值内存和路径总数无关；
+# 每批只留下每条路径的期末价值、年化收益率和最大回撤。
+# 每批的随机数种子由 SeedSequence(seed).spawn() 生成，结果只取决于 seed 和 chunk_size，和使用多少个进程无关。
+
+BLOCK_SIZE = 20  # 每个片段的交易日数，保留收益率的短期自相关
+CHUNK_SIZE = 250
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def daily_returns(net_values: np.ndarray) -> np.ndarray:
+    ''' (days × funds) 的净值 -> (days - 1 × funds) 的每日净值比（1 + 收益率） '''
+    return net_values[1:] / net_values[:-1]
+
+
+def bootstrap_net_values(returns: np.ndarray, num_paths: int, path_days: int, block_size: int, rng: np.random.Generator) -> np.ndarray:
+    '''
+    随机抽取 block_size 天的连续片段拼成模拟路径（moving block bootstrap），返回 (num_paths × path_days × funds) 的净值，第一天为 1。
+    '''
+    num_blocks = -(-(path_days - 1) // block_size)
+    block_starts = rng.integers(0, len(returns) - block_size + 1, size=(num_paths, num_blocks))
+    rows = (block_starts[:, :, np.newaxis] + np.arange(block_size)).reshape(num_paths, -1)[:, :path_days - 1]
+    net_values = np.ones((num_paths, path_days, returns.shape[1]))
+    np.cumprod(returns[rows], axis=1, out=net_values[:, 1:])
+    return net_values
+
+
+def _simulate_chunk(returns, weights, rebalance_period, num_paths, path_days, block_size, seed_sequence):
+    ''' 一批模拟路径的期末价值和最大回撤（%） '''
+    with span('monte_carlo.chunk', paths=num_paths, days=path_days):
+        rng = np.random.default_rng(seed_sequence)
+        net_values = bootstrap_net_values(returns, num_paths, path_days, block_size, rng)
+        portfolio_values = period_portfolio_values(net_values, weights[:, np.newaxis], rebalance_period)[..., 0]
+    return portfolio_values[:, -1], max_dd_percents(portfolio_values, axis=1)
+
+
+def bootstrap_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_period, num_paths=20000, path_days=None,
+                         block_size=BLOCK_SIZE, chunk_size=CHUNK_SIZE, seed=0, processes=1) -> pd.DataFrame:
+    '''
+    用 block bootstrap 生成 num_paths 条模拟净值路径，按 target_percent 和 rebalance_period 回测每条路径。
+
+    Parameters:
+    - portfolio_funds_data_df (pd.DataFrame): 已经填补空值的净值面板，日收益率从中抽取。
+    - path_days: 每条路径的交易日数（含第一天），默认和面板相同。
+    - seed: 随机数种子，相同的 seed 和 chunk_size 得到相同的结果。
+    - processes: 大于 1 时，各批路径交给进程池并行计算。
+
+    Returns:
+    - pd.DataFrame: 每条路径一行，列为 end_value, annualized_return（%，按每年 TRADING_DAYS_PER_YEAR 个交易日），max_dd_percent（%）
+    '''
+    returns = daily_returns(portfolio_funds_data_df[portfolio_df.index].to_numpy(dtype=np.float64))
+    weights = portfolio_df['target_percent'].to_numpy(dtype=np.float64) / 100
+    path_days = len(portfolio_funds_data_df) if path_days is None else path_days
+    if len(returns) < block_size:
+        raise ValueError('净值面板只有 {} 个日收益率，少于 block_size {}'.format(len(returns), block_size))
+
+    chunk_paths = [min(chunk_size, num_paths - start) for start in range(0, num_paths, chunk_size)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_paths))
+    args = [(returns, weights, rebalance_period, paths, path_days, block_size, seed_sequence)
+            for paths, seed_sequence in zip(chunk_paths, seed_sequences)]
+    results = starmap_with_spans(_simulate_chunk, args, processes)
+
+    end_values = np.concatenate([end_value for end_value, _ in results])
+    years = (path_days - 1) / TRADING_DAYS_PER_YEAR
+    return pd.DataFrame({'end_value': end_values,
+                         'annualized_return': ((end_values / TOTAL_INVESTMENT) ** (1 / years) - 1) * 100,
+                         'max_dd_percent': np.concatenate([max_dd_percent for _, max_dd_percent in results])})
+
+
+def percentile_bands(paths_df: pd.DataFrame, percentiles=PERCENTILES) -> pd.DataFrame:
+    ''' 每个指标的分位数，索引为百分位，列同 paths_df '''
+    return pd.DataFrame(np.percentile(paths_df.to_numpy(), percentiles, axis=0),
+                        index=pd.Index(percentiles, name='percentile'), columns=paths_df.columns)
+
+
+if __name__ == "__main__":
+    import time
+    import fund_code
+    from fund_data_prepare_util import load_portfolio_funds_data
+
+    portfolio_df = pd.DataFrame(fund_code.Portfolio_LaoHuangNiu, columns=fund_code.Portfolio_Columns)
+    portfolio_df.set_index('ticker', inplace=True)
+    portfolio_funds_data_df = load_portfolio_funds_data(portfolio_df.index, pd.to_datetime('2015-01-02'), pd.to_datetime('2024-04-22')).ffill().bfill()
+
+    # 和 fund_portfolio_back_trade_timing 相同：持有 5 年，每 220 个交易日重平衡一次
+    start_time = time.perf_counter()
+    paths_df = bootstrap_back_trade(portfolio_df, portfolio_funds_data_df, 220, path_days=5 * TRADING_DAYS_PER_YEAR + 1)
+    print("{} 条路径，耗时 {:.2f} 秒".format(len(paths_df), time.perf_counter() - start_time))
+    print(percentile_bands(paths_df).round(2).to_string())
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+import os
+
+from data_cache import read_canonical
+
+DATA_PATH = './data'
+STORE_PATH = os.path.join(DATA_PATH, 'nav_store')  # 列式存储目录，每个基金一个子目录，每列一个 .npy 文件
+
+DATE_COLUMN = 'date'
+VALUE_COLUMN = 'net_value'
+
+_mmap_columns = {}  # 已打开的 memory-mapped 列，path -> (mtime, array)，文件被替换后重新打开
+
+
+def ticker_store_path(ticker: str) -> str:
+    return os.path.join(STORE_PATH, ticker)
+
+
+def csv_path(ticker: str) -> str:
+    return os.path.join(DATA_PATH, ticker + '.csv')
+
+
+def _column_path(ticker: str, column: str) -> str:
+    return os.path.join(ticker_store_path(ticker), column + '.npy')
+
+
+def _save_column(ticker: str, column: str, values: np.ndarray):
+    ''' 先写临时文件再替换，避免读到写了一半的文件 '''
+    path = _column_path(ticker, column)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, values)
+    os.replace(tmp_path, path)
+
+
+def write_nav(ticker: str, data_df: pd.DataFrame):
+    '''
+    把基金累计净值写入列式存储。
+
+    Parameters:
+    - data_df (pd.DataFrame): 包含 'date' 和 'net_value' 两列，按日期排序。
+    '''
+    os.makedirs(ticker_store_path(ticker), exist_ok=True)
+    for column in [DATE_COLUMN, VALUE_COLUMN]:  # 先关闭已打开的映射，Windows 下被映射的文件不能被替换
+        _mmap_columns.pop(_column_path(ticker, column), None)
+    dates = pd.to_datetime(data_df[DATE_COLUMN]).to_numpy(dtype='datetime64[ns]')
+    values = data_df[VALUE_COLUMN].to_numpy(dtype=np.float64)
+    order = np.argsort(dates, kind='stable')
+    # 先写 net_value，最后写 date：date 文件的修改时间即为整个存储的更新时间
+    _save_column(ticker, VALUE_COLUMN, values[order])
+    _save_column(ticker, DATE_COLUMN, dates[order])
+
+
+def append_nav(ticker: str, data_df: pd.DataFrame):
+    ''' 追加最后一个存储日期之后的数据，早于或等于该日期的行会被忽略 '''
+    if not has_nav(ticker):
+        write_nav(ticker, data_df)
+        return
+    dates, values = read_nav(ticker, mmap=False)
+    new_dates = pd.to_datetime(data_df[DATE_COLUMN]).to_numpy(dtype='datetime64[ns]')
+    is_new = new_dates > dates[-1] if len(dates) > 0 else np.ones(len(new_dates), dtype=bool)
+    write_nav(ticker, pd.DataFrame({DATE_COLUMN: np.concatenate([dates, new_dates[is_new]]), 
+                                    VALUE_COLUMN: np.concatenate([values, data_df[VALUE_COLUMN].to_numpy(dtype=np.float64)[is_new]])}))
+
+
+def last_nav_date(ticker: str):
+    ''' 存储中最后一行的日期，没有数据时返回 None '''
+    if not has_nav(ticker):
+        return None
+    dates = _open_column(ticker, DATE_COLUMN)
+    return pd.Timestamp(dates[-1]) if len(dates) > 0 else None
+
+
+def store_mtime(ticker: str) -> float:
+    ''' 存储的更新时间，不存在时返回 0 '''
+    path = _column_path(ticker, DATE_COLUMN)
+    return os.path.getmtime(path) if os.path.exists(path) else 0.0
+
+
+def has_nav(ticker: str) -> bool:
+    return store_mtime(ticker) > 0
+
+
+def import_csv(ticker: str, path: str = None):
+    ''' 从 data/<ticker>.csv 导入到列式存储，CSV 的两列为日期和累计净值（列名可以是 净值日期,累计净值，由 data_cache 统一） '''
+    data_df = read_canonical(path or csv_path(ticker))
+    write_nav(ticker, pd.DataFrame({DATE_COLUMN: data_df.index, VALUE_COLUMN: data_df[VALUE_COLUMN].to_numpy()}))
+
+
+def export_csv(ticker: str, path: str = None):
+    ''' 把列式存储中的数据导出为 data/<ticker>.csv 格式 '''
+    dates, values = read_nav(ticker)
+    data_df = pd.DataFrame({DATE_COLUMN: pd.DatetimeIndex(dates).strftime('%Y-%m-%d'), VALUE_COLUMN: values})
+    data_df.to_csv(path or csv_path(ticker), index=False)
+
+
+def ensure_nav(ticker: str):
+    ''' 存储不存在，或者 CSV 比存储更新时（例如手工编辑过 CSV），重新从 CSV 导入 '''
+    path = csv_path(ticker)
+    if os.path.exists(path) and os.path.getmtime(path) > store_mtime(ticker):
+        import_csv(ticker, path)
+
+
+def _open_column(ticker: str, column: str) -> np.ndarray:
+    path = _column_path(ticker, column)
+    mtime = os.path.getmtime(path)
+    cached = _mmap_columns.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _mmap_columns[path] = (mtime, np.load(path, mmap_mode='r'))
+    return cached[1]
+
+
+def read_nav(ticker: str, start_date=None, end_date=None, mmap: bool = True):
+    '''
+    读取 [start_date, end_date] 区间的数据。日期列是排好序的，用二分查找定位区间，
+    memory-mapped 模式下只有区间内的数据会被真正读入内存。
+
+    Returns:
+    - dates (np.ndarray): datetime64[ns] 日期数组
+    - values (np.ndarray): float64 累计净值数组
+    '''
+    if mmap:
+        dates = _open_column(ticker, DATE_COLUMN)
+        values = _open_column(ticker, VALUE_COLUMN)
+    else:
+        dates = np.load(_column_path(ticker, DATE_COLUMN))
+        values = np.load(_column_path(ticker, VALUE_COLUMN))
+
+    start = 0 if start_date is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(start_date), 'ns'), side='left')
+    end = len(dates) if end_date is None else np.searchsorted(dates, np.datetime64(pd.Timestamp(end_date), 'ns'), side='right')
+    return np.array(dates[start:end]), np.array(values[start:end])
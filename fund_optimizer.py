@@ -0,0 +1,325 @@
+import numpy as np
+import pandas as pd
+
+import fund_code
+from fund_backtrade_util import rebalance_day_indices, TRADING_DAYS_PER_YEAR
+from phase_timer import span, starmap_with_spans
+
+# 组合优化：在每个重平衡日，用之前 lookback 个交易日的日收益率估计年化收益率和协方差，求解
+#   min_variance  最小方差
+#   max_sharpe    最大夏普比率（有效前沿上夏普比率最高的点）
+#   risk_parity   风险平价（每个基金的风险贡献相同；某类基金超过上限时，二分查找该类基金风险预算的缩放倍数，使该类型恰好达到上限）
+# 以及有效前沿上的 frontier_points 个点。约束为：权重非负、合计 100%，每个类型（fund_code.TYPE_EQUITY / TYPE_FIXED）的合计不超过上限。
+#
+# 所有重平衡日的收益率和协方差用累积和一次算出，每个重平衡日只估计一次，由最小方差、有效前沿、最大夏普比率和风险平价共用。
+# 所有重平衡日、所有前沿点作为一批同时求解（投影梯度法，约束集上的投影有解析解），重平衡日按 chunk_size 分批，
+# 可以交给进程池并行计算。
+
+LOOKBACK_DAYS = 250  # 估计收益率和协方差使用的交易日数
+FRONTIER_POINTS = 20
+MAX_ITERATIONS = 5000  # 投影梯度法的最大迭代次数
+TOLERANCE = 1e-9  # 两次迭代之间权重的最大变化小于该值时结束
+MIN_LOG_SCALE = -20.0  # 风险平价中一个类型风险预算倍数的下限 e^-20
+
+
+def estimate_moments(net_values: np.ndarray, rows: np.ndarray, lookback: int = LOOKBACK_DAYS):
+    '''
+    用 rows 每一行（含）之前 lookback 个日收益率，估计年化收益率和年化协方差。
+
+    Parameters:
+    - net_values (np.ndarray): (days × funds) 的累计净值，不能有空值。
+    - rows (np.ndarray): 重平衡日的行号，需要 >= lookback。
+
+    Returns:
+    - means (np.ndarray): (len(rows) × funds)
+    - covs (np.ndarray): (len(rows) × funds × funds)
+    '''
+    returns = net_values[1:] / net_values[:-1] - 1  # 第 k 行为第 k+1 天的收益率
+    sums = np.concatenate([np.zeros((1, returns.shape[1])), np.cumsum(returns, axis=0)])
+    products = np.concatenate([np.zeros((1,) + returns.shape[1:] * 2),
+                               np.cumsum(returns[:, :, np.newaxis] * returns[:, np.newaxis, :], axis=0)])
+    window_sums = sums[rows] - sums[rows - lookback]
+    window_products = products[rows] - products[rows - lookback]
+    means = window_sums / lookback
+    covs = (window_products - lookback * means[:, :, np.newaxis] * means[:, np.newaxis, :]) / (lookback - 1)
+    return means * TRADING_DAYS_PER_YEAR, covs * TRADING_DAYS_PER_YEAR
+
+
+def type_constraints(fund_types, type_caps: dict = None):
+    '''
+    Parameters:
+    - fund_types: 每个基金的类型（portfolio_df['type']）。
+    - type_caps (dict): 类型 -> 该类型合计比例的上限（百分比），默认为 fund_code.Portfolio_Type_Caps，没有列出的类型不限制。
+
+    Returns:
+    - fund_groups (np.ndarray): 每个基金所属类型的编号
+    - caps (np.ndarray): 每个类型的上限（比例，1 表示不限制）
+    '''
+    type_caps = fund_code.Portfolio_Type_Caps if type_caps is None else type_caps
+    types, fund_groups = np.unique(np.asarray(fund_types), return_inverse=True)
+    caps = np.array([min(type_caps.get(fund_type, 100), 100) / 100 for fund_type in types])
+    if caps.sum() < 1:
+        raise ValueError('各类型的上限合计不到 100%: {}'.format(dict(zip(types, caps * 100))))
+    return fund_groups, caps
+
+
+def _sum_threshold(values, scales, target):
+    ''' 求 θ 使 Σ max(values - scales × θ, 0) = target（target > 0），scales 为 0 的项不参与 '''
+    breakpoints = np.where(scales > 0, values / np.where(scales > 0, scales, 1), -np.inf)
+    order = np.argsort(-breakpoints, axis=-1)
+    ordered = np.take_along_axis(breakpoints, order, axis=-1)
+    value_sums = np.cumsum(np.take_along_axis(np.where(scales > 0, values, 0), order, axis=-1), axis=-1)
+    scale_sums = np.cumsum(np.take_along_axis(scales, order, axis=-1), axis=-1)
+    # 排序后满足条件的是前若干项，θ 由这些项决定
+    active = np.maximum((np.isfinite(ordered) & (ordered * scale_sums - value_sums + target > 0)).sum(axis=-1), 1)[..., np.newaxis] - 1
+    return ((np.take_along_axis(value_sums, active, axis=-1) - target) / np.take_along_axis(scale_sums, active, axis=-1))[..., 0]
+
+
+def project_weights(values, fund_groups, caps, scales=None):
+    '''
+    把 values（... × funds）投影到约束集：权重非负、合计为 1、每个类型的合计不超过上限。
+    距离为 Σ (w - values)² / scales（scales 默认全部为 1，即欧氏距离），用于对角预条件的投影梯度法。
+
+    投影的解为 w = max(values - scales × max(λ, θ_类型), 0)：θ_类型 使该类型恰好达到上限，λ 使合计为 1。
+    合计是 λ 的分段线性函数，转折点只在 values / scales 和 θ 处，所以在转折点上求值后线性插值即得到精确的 λ。
+    '''
+    scales = np.ones(values.shape) if scales is None else np.broadcast_to(scales, values.shape)
+    thresholds = np.full(values.shape[:-1] + (len(caps),), -np.inf)
+    for group, cap in enumerate(caps):
+        if cap < 1:
+            thresholds[..., group] = _sum_threshold(values, np.where(fund_groups == group, scales, 0), cap)
+    fund_thresholds = thresholds[..., fund_groups]
+
+    breakpoints = values / scales
+    group_scales = np.stack([scales[..., fund_groups == group].sum(axis=-1) for group in range(len(caps))], axis=-1)
+    lowest = breakpoints.min(axis=-1, keepdims=True) - 1 / group_scales.min(axis=-1, keepdims=True)  # 在这里每个类型的合计都 >= 1
+    candidates = np.sort(np.concatenate([breakpoints, np.where(np.isfinite(thresholds), thresholds, lowest), lowest], axis=-1), axis=-1)
+    totals = np.maximum(values[..., np.newaxis, :] - scales[..., np.newaxis, :] * np.maximum(candidates[..., :, np.newaxis], 
+                                                                                             fund_thresholds[..., np.newaxis, :]), 0).sum(axis=-1)
+    # 合计随 λ 递减，第一个 < 1 的转折点；上限合计恰好为 100% 时 lowest 处的合计可能因为舍入略小于 1，至少取第二个
+    upper = np.clip((totals >= 1).sum(axis=-1, keepdims=True), 1, candidates.shape[-1] - 1)
+    lambda0, lambda1 = np.take_along_axis(candidates, upper - 1, axis=-1), np.take_along_axis(candidates, upper, axis=-1)
+    total0, total1 = np.take_along_axis(totals, upper - 1, axis=-1), np.take_along_axis(totals, upper, axis=-1)
+    lambdas = lambda0 + np.where(total0 > total1, (total0 - 1) / np.where(total0 > total1, total0 - total1, 1), 0) * (lambda1 - lambda0)
+    return np.maximum(values - scales * np.maximum(lambdas, fund_thresholds), 0)
+
+
+def solve_quadratic(covs, linear, fund_groups, caps, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+    '''
+    批量求解 min ½ w'Σw - linear'w，w 满足 project_weights 的约束。
+
+    使用加速投影梯度法（FISTA），以 1 / 方差为对角预条件：股票和债券的方差相差上千倍，不做预条件时需要上千次迭代。
+    目标函数上升时重置动量（adaptive restart）。
+
+    Parameters:
+    - covs (np.ndarray): (... × funds × funds)，和 linear 按 numpy 的规则广播，例如 (dates × 1 × funds × funds) 的协方差
+      配合 (dates × points × funds) 的 linear，同一个重平衡日的所有前沿点共用一个协方差矩阵。
+    - linear (np.ndarray): (... × funds)
+    '''
+    covs = np.asarray(covs, dtype=np.float64)
+    linear = np.asarray(linear, dtype=np.float64)
+    scales = 1 / np.maximum(np.diagonal(covs, axis1=-2, axis2=-1), 1e-12)
+    root_scales = np.sqrt(scales)
+    scaled_covs = covs * root_scales[..., :, np.newaxis] * root_scales[..., np.newaxis, :]
+    steps = 1 / np.maximum(np.linalg.eigvalsh(scaled_covs)[..., -1:], 1e-12)  # 1 / 预条件后梯度的 Lipschitz 常数
+    shape = np.broadcast_shapes(covs.shape[:-1], linear.shape)
+    scales = np.broadcast_to(scales, shape)
+
+    weights = project_weights(np.zeros(shape), fund_groups, caps, scales)
+    momentum_weights = weights
+    t = np.ones(shape[:-1] + (1,))
+    for _ in range(max_iterations):
+        gradients = np.matmul(covs, momentum_weights[..., np.newaxis])[..., 0] - linear
+        next_weights = project_weights(momentum_weights - steps * scales * gradients, fund_groups, caps, scales)
+        next_t = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        restart = ((momentum_weights - next_weights) * (next_weights - weights) / scales).sum(axis=-1, keepdims=True) > 0
+        next_t = np.where(restart, 1, next_t)
+        momentum_weights = next_weights + np.where(restart, 0, (t - 1) / next_t) * (next_weights - weights)
+        converged = np.abs(next_weights - weights).max() < tolerance
+        weights, t = next_weights, next_t
+        if converged:
+            break
+    return weights
+
+
+def min_variance_weights(covs, fund_groups, caps):
+    return solve_quadratic(covs, np.zeros(covs.shape[:-1]), fund_groups, caps)
+
+
+def _risk_aversions(means, covs, points):
+    ''' 每个重平衡日的 points 个收益率系数 τ（min ½ w'Σw - τ μ'w），从 0（最小方差）到接近最高收益 '''
+    spreads = np.maximum(means.max(axis=-1) - means.min(axis=-1), 1e-12)
+    largest = 10 * np.linalg.eigvalsh(covs)[..., -1] / spreads
+    scales = np.concatenate([[0], np.geomspace(1e-3, 1, points - 1)])
+    return largest[:, np.newaxis] * scales
+
+
+def frontier_weights(means, covs, fund_groups, caps, risk_aversions):
+    ''' (dates × points × funds) 的有效前沿，risk_aversions 为 (dates × points) 的 τ，同一个重平衡日的协方差矩阵只有一份 '''
+    return solve_quadratic(covs[:, np.newaxis], risk_aversions[..., np.newaxis] * means[:, np.newaxis, :], fund_groups, caps)
+
+
+def portfolio_statistics(weights, means, covs, risk_free=0.0):
+    ''' weights (dates × ... × funds) 的年化收益率、年化波动率（比例）和夏普比率，risk_free 为年化无风险收益率（比例） '''
+    extra_dims = weights.ndim - means.ndim
+    means = means.reshape(means.shape[:1] + (1,) * extra_dims + means.shape[1:])
+    covs = covs.reshape(covs.shape[:1] + (1,) * extra_dims + covs.shape[1:])
+    returns = (weights * means).sum(axis=-1)
+    variances = (np.matmul(covs, weights[..., np.newaxis])[..., 0] * weights).sum(axis=-1)
+    volatilities = np.sqrt(np.maximum(variances, 0))
+    sharpes = np.where(volatilities > 0, (returns - risk_free) / np.where(volatilities > 0, volatilities, 1), np.nan)
+    return returns, volatilities, sharpes
+
+
+def max_sharpe_weights(means, covs, fund_groups, caps, risk_free=0.0, points=FRONTIER_POINTS, refinements=2,
+                       frontier=None, risk_aversions=None):
+    '''
+    有效前沿上夏普比率最高的点：先在 points 个前沿点中取最高的，再在它两侧的区间内细分 refinements 次。
+    已经算好的前沿（frontier, risk_aversions）可以直接传入，不再重新求解。
+    '''
+    if frontier is None:
+        risk_aversions = _risk_aversions(means, covs, points)
+        frontier = frontier_weights(means, covs, fund_groups, caps, risk_aversions)
+    dates = np.arange(len(means))
+    for refinement in range(refinements + 1):
+        _, _, sharpes = portfolio_statistics(frontier, means, covs, risk_free)
+        best = np.nanargmax(np.where(np.isnan(sharpes), -np.inf, sharpes), axis=1)
+        best_weights = frontier[dates, best]
+        if refinement == refinements:
+            break
+        low = risk_aversions[dates, np.maximum(best - 1, 0)]
+        high = risk_aversions[dates, np.minimum(best + 1, risk_aversions.shape[1] - 1)]
+        risk_aversions = low[:, np.newaxis] + (high - low)[:, np.newaxis] * np.linspace(0, 1, points)
+        frontier = frontier_weights(means, covs, fund_groups, caps, risk_aversions)
+    return best_weights
+
+
+def _risk_budget_weights(covs, budgets, max_sweeps=500, tolerance=TOLERANCE):
+    ''' 风险贡献 w_i (Σw)_i 和 budgets 成比例的权重（不考虑类型上限），逐个坐标求解 min ½ y'Σy - Σ b log y 后归一化 '''
+    variances = np.maximum(np.diagonal(covs, axis1=-2, axis2=-1), 1e-12)
+    weights = budgets / np.sqrt(variances)
+    for _ in range(max_sweeps):
+        previous = weights.copy()
+        for i in range(weights.shape[-1]):
+            others = (covs[..., i, :] * weights).sum(axis=-1) - variances[..., i] * weights[..., i]
+            # y_i = (√(o² + 4σ²b) - o) / 2σ²；o > 0 时写成 2b / (√(o² + 4σ²b) + o)，预算很小时不会因为相减而变成 0
+            magnitudes = np.sqrt(others * others + 4 * variances[..., i] * budgets[..., i]) + np.abs(others)
+            weights[..., i] = np.where(others > 0, 2 * budgets[..., i] / magnitudes, magnitudes / (2 * variances[..., i]))
+        if (np.abs(weights - previous) / np.maximum(weights, 1e-12)).max() < tolerance:
+            break
+    return weights / weights.sum(axis=-1, keepdims=True)
+
+
+def risk_parity_weights(covs, fund_groups, caps, max_passes=10, bisections=60, tolerance=1e-6):
+    '''
+    风险平价：每个基金的风险贡献相同。某个类型超过上限时，把该类型基金的风险预算乘以同一个倍数（类型内仍然相同），
+    该类型的合计随倍数单调递增，所以在 [e^MIN_LOG_SCALE, 当前倍数] 上对 log 倍数二分查找，取合计不超过上限的一侧，
+    使该类型恰好达到上限，其他基金的风险贡献仍然相同。降低一个类型会提高其他类型，所以逐个类型重复到都不超过上限。
+
+    和其他基金负相关的基金即使风险预算接近 0 也保留一定权重，倍数降到下限仍然超过上限时，
+    最后按比例投影到约束集（投影距离以权重为 scales，超过上限的类型等比例缩小，其他类型等比例放大），不会把基金压成 0。
+    '''
+    budgets = np.ones(covs.shape[:-1]) / covs.shape[-1]
+    log_scales = np.zeros(covs.shape[:-2] + (len(caps),))  # 每个类型风险预算的 log 倍数
+    weights = _risk_budget_weights(covs, budgets)
+    for _ in range(max_passes):
+        totals = np.stack([weights[..., fund_groups == group].sum(axis=-1) for group in range(len(caps))], axis=-1)
+        over = (totals > caps + tolerance) & (log_scales > MIN_LOG_SCALE)
+        if not over.any():
+            break
+        for group in np.flatnonzero(over.reshape(-1, len(caps)).any(axis=0)):
+            members = fund_groups == group
+            upper = log_scales[..., group].copy()
+            lower = np.where(over[..., group], MIN_LOG_SCALE, upper)  # 只调整超过上限的日子
+            for _ in range(bisections):
+                log_scales[..., group] = (lower + upper) / 2
+                group_totals = _risk_budget_weights(covs, budgets * np.exp(log_scales[..., fund_groups]))[..., members].sum(axis=-1)
+                lower = np.where(group_totals > caps[group], lower, log_scales[..., group])
+                upper = np.where(group_totals > caps[group], log_scales[..., group], upper)
+                if (upper - lower).max() < tolerance:
+                    break
+            log_scales[..., group] = lower
+        weights = _risk_budget_weights(covs, budgets * np.exp(log_scales[..., fund_groups]))
+    return project_weights(weights, fund_groups, caps, weights)
+
+
+def _optimize_chunk(means, covs, fund_groups, caps, risk_free, points):
+    ''' 一批重平衡日的全部优化结果，所有方法共用同一份收益率和协方差估计 '''
+    with span('optimizer.chunk', dates=len(means), points=points):
+        risk_aversions = _risk_aversions(means, covs, points)
+        frontier = frontier_weights(means, covs, fund_groups, caps, risk_aversions)
+        methods = dict(min_variance=frontier[:, 0],  # τ = 0 的前沿点即为最小方差
+                       max_sharpe=max_sharpe_weights(means, covs, fund_groups, caps, risk_free, points,
+                                                     frontier=frontier, risk_aversions=risk_aversions),
+                       risk_parity=risk_parity_weights(covs, fund_groups, caps))
+    return methods, frontier
+
+
+def optimize_portfolio(portfolio_df, portfolio_funds_data_df, rebalance_period, lookback=LOOKBACK_DAYS, type_caps=None,
+                       risk_free=0.0, frontier_points=FRONTIER_POINTS, chunk_size=64, processes=1):
+    '''
+    在每个重平衡日（同 fund_portfolio_back_trade，有足够历史数据的日子）求解最小方差、最大夏普比率、风险平价的权重和有效前沿。
+
+    Parameters:
+    - portfolio_df (pd.DataFrame): ticker 为索引，包括 type 列。
+    - portfolio_funds_data_df (pd.DataFrame): 已经填补空值的净值面板。
+    - type_caps (dict): 类型 -> 上限（百分比），默认为 fund_code.Portfolio_Type_Caps。
+    - risk_free: 年化无风险收益率（百分比）。
+    - processes: 大于 1 时，各批重平衡日交给进程池并行计算。
+
+    Returns:
+    - weights_df (pd.DataFrame): 索引为 (date, method)，列为各基金的权重（百分比）、expected_return、volatility（年化，%）、sharpe
+    - frontier_df (pd.DataFrame): 索引为 (date, point)，列同上，point 0 为最小方差
+    '''
+    tickers = portfolio_df.index
+    net_values = portfolio_funds_data_df[tickers].to_numpy(dtype=np.float64)
+    rows = rebalance_day_indices(len(net_values), rebalance_period)
+    rows = rows[rows >= lookback]
+    fund_groups, caps = type_constraints(portfolio_df['type'], type_caps)
+    with span('optimizer.moments', dates=len(rows), funds=len(tickers)):
+        means, covs = estimate_moments(net_values, rows, lookback)
+
+    chunks = [slice(start, start + chunk_size) for start in range(0, len(rows), chunk_size)]
+    args = [(means[chunk], covs[chunk], fund_groups, caps, risk_free / 100, frontier_points) for chunk in chunks]
+    results = starmap_with_spans(_optimize_chunk, args, processes)
+
+    dates = portfolio_funds_data_df.index[rows]
+    method_names = list(results[0][0]) if results else []
+    method_weights = np.stack([np.concatenate([methods[name] for methods, _ in results]) for name in method_names], axis=1) \
+        if results else np.empty((0, 0, len(tickers)))
+    frontier = np.concatenate([frontier for _, frontier in results]) if results else np.empty((0, frontier_points, len(tickers)))
+
+    def to_frame(weights, labels, level):
+        returns, volatilities, sharpes = portfolio_statistics(weights, means, covs, risk_free / 100)
+        frame = pd.DataFrame(weights.reshape(-1, len(tickers)) * 100, columns=tickers,
+                             index=pd.MultiIndex.from_product([dates, labels], names=['date', level]))
+        frame['expected_return'] = returns.ravel() * 100
+        frame['volatility'] = volatilities.ravel() * 100
+        frame['sharpe'] = sharpes.ravel()
+        return frame
+
+    return to_frame(method_weights, method_names, 'method'), to_frame(frontier, range(frontier.shape[1]), 'point')
+
+
+if __name__ == "__main__":
+    import time
+    from fund_data_prepare_util import load_portfolio_funds_data
+
+    portfolio_df = pd.DataFrame(fund_code.Portfolio_LaoHuangNiu, columns=fund_code.Portfolio_Columns)
+    portfolio_df.set_index('ticker', inplace=True)
+    portfolio_funds_data_df = load_portfolio_funds_data(portfolio_df.index, pd.to_datetime('2015-01-01'), pd.to_datetime('2024-04-22')).ffill().bfill()
+
+    pd.set_option('display.width', 200)
+    # 默认上限之外再用一个会约束风险平价的上限（固收不超过 30%）
+    for type_caps in [fund_code.Portfolio_Type_Caps, {fund_code.TYPE_FIXED: 30}]:
+        start_time = time.perf_counter()
+        weights_df, frontier_df = optimize_portfolio(portfolio_df, portfolio_funds_data_df, rebalance_period=20, type_caps=type_caps)
+        print("类型上限 {}：{} 个重平衡日，{} 个前沿点，耗时 {:.2f} 秒".format(
+            type_caps, len(weights_df.index.levels[0]), len(frontier_df), time.perf_counter() - start_time))
+        # 每个方法在每个重平衡日都不超过类型上限
+        type_totals = weights_df[portfolio_df.index].T.groupby(portfolio_df['type']).sum().T
+        for fund_type, cap in type_caps.items():
+            if fund_type in type_totals:
+                over_df = type_totals.loc[type_totals[fund_type] > cap + 1e-6, fund_type]
+                assert over_df.empty, '{} 超过上限 {}%:\n{}'.format(fund_type, cap, over_df)
+        print(weights_df.groupby(level='method').mean().round(2).to_string())
@@ -1,13 +1,9 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 
 import fund_code
 
 from fund_data_prepare_util import load_portfolio_funds_data
-from fund_backtrade_util import calculate_max_dd, fund_portfolio_back_trade
-
-plt.rcParams["font.sans-serif"] = ["SimHei"]  # 设置字体
-plt.rcParams["axes.unicode_minus"] = False    # 该语句解决图像中的“-”负号的乱码问题
+from fund_backtrade_util import calculate_max_dd, calculate_drawdown_episodes, fund_portfolio_back_trade
 
 DATA_PATH='./data'
 
@@ -37,6 +33,11 @@ if __name__ == "__main__":
     print("最大回撤开始日期: {}, 结束日期: {}, 持续 {} 天".format(dd_peak_date.strftime('%Y-%m-%d'), dd_bottom_date.strftime('%Y-%m-%d'), (dd_bottom_date-dd_peak_date).days))
     print("最大回撤: {:.2f} - {:.2f} = {:.2f}, 回撤比例: {:.2f}%".format(dd_peak_value, dd_bottom_value, max_dd, max_dd_percent))
     
+    print("\n回撤最大的 5 个下跌周期")
+    for _, episode in calculate_drawdown_episodes(portfolio_value_series, top_n=5).iterrows():
+        recovery_date = episode['dd_recovery_date'].strftime('%Y-%m-%d') if pd.notna(episode['dd_recovery_date']) else '未修复'
+        print("{} - {}, 修复日期: {}, 回撤比例: {:.2f}%".format(episode['dd_peak_date'].strftime('%Y-%m-%d'), episode['dd_bottom_date'].strftime('%Y-%m-%d'), recovery_date, episode['max_dd_percent']))
+    
     print("\n投资组合每年收益率")
     for year, year_df in portfolio_value_series.groupby(portfolio_value_series.index.year):
         year_profit_percent = (year_df.iloc[-1] - year_df.iloc[0])/year_df.iloc[0] * 100
@@ -56,13 +57,13 @@ if __name__ == "__main__":
     
         
     print("\n组合成员独立行情")
+    funds_max_dd_df = calculate_max_dd(portfolio_funds_data_df)  # 一次计算所有基金的最大回撤
     for ticker in portfolio_funds_data_df.columns:
         start_value = portfolio_funds_data_df[ticker].iloc[0]
         end_value = portfolio_funds_data_df[ticker].iloc[-1]
         profit_percent = (end_value - start_value)/start_value * 100
         annaulized_profit_percent = ((1 + profit_percent/100) ** (1/years) - 1) * 100
-        max_dd, dd_peak_date, dd_bottom_date, dd_peak_value, dd_bottom_value = calculate_max_dd(portfolio_funds_data_df[ticker])
-        max_dd_percent = max_dd/dd_peak_value*100
+        max_dd_percent = funds_max_dd_df.loc[ticker, 'max_dd']/funds_max_dd_df.loc[ticker, 'dd_peak_value']*100
         print("{} {}: 利润 {:.2f}%, 年化：{:.2f}%, 最大回撤：{:.2f}%".format(ticker, portfolio_df.loc[ticker, 'name'], profit_percent, annaulized_profit_percent, max_dd_percent))
     
     
@@ -70,6 +71,9 @@ if __name__ == "__main__":
     
        
     # 展示曲线图
+    import matplotlib.pyplot as plt  # 只在画图时导入
+    plt.rcParams["font.sans-serif"] = ["SimHei"]  # 设置字体
+    plt.rcParams["axes.unicode_minus"] = False    # 该语句解决图像中的“-”负号的乱码问题
     plt_data_df = portfolio_funds_data_df
     
     # remove the FIXED TYPE funds from the plot data, as we are not interested in their performance in the backtest.
@@ -1,28 +1,63 @@
-import matplotlib.pyplot as plt
 import pandas as pd
 import multiprocessing
 import statistics
+import os
 
 import fund_code
-from fund_data_prepare_util import load_portfolio_funds_data
-from fund_backtrade_util import calculate_max_dd, fund_portfolio_back_trade
+from fund_data_prepare_util import load_portfolio_funds_data, FundPanelCache
+from fund_backtrade_util import calculate_max_dd, fund_portfolio_back_trade, back_trade_arrays, rolling_windows_back_trade
+from fund_shared_panel import SharedNavPanel
+from phase_timer import span, enable_timing, timing_enabled, init_worker_timing, call_with_spans, merge_worker_spans
 
-import matplotlib.pyplot as plt
-import seaborn as sns
 import numpy as np
 
 DATA_PATH = './data'
 
-def backtrade(portfolio_df, start_date, end_date):
-    rebalance_days = 220  # 每 220 个交易日 rebalance 一次
-    portfolio_funds_data_df = load_portfolio_funds_data(portfolio_df.index, start_date, end_date).ffill().bfill()  # 使用 bfill() 是为了防止第一行数据出现空值
-    portfolio_value_series = fund_portfolio_back_trade(portfolio_df, portfolio_funds_data_df, rebalance_days)
+REBALANCE_DAYS = 220  # 每 220 个交易日 rebalance 一次
+
+# 'batch': 所有窗口一次向量化计算；'shared': 进程池，净值面板通过共享内存交给子进程，每个任务只传递窗口日期；
+# 'pool': 进程池，每个任务各自加载数据并回测
+SWEEP_MODE = 'batch'
+
+TIMING = False  # True: 记录加载数据、回测等各阶段的耗时（包括子进程），结束时打印汇总并写入 timing.jsonl
+
+panel_cache = FundPanelCache()  # 每个进程一个缓存，同一进程处理多个窗口时只加载一次净值数据
 
-    portfolio_profit_percent = (portfolio_value_series.iloc[-1] - portfolio_value_series.iloc[0]) / portfolio_value_series.iloc[0] * 100
+# 共享内存模式下，每个子进程在初始化时 attach 一次
+_worker_panel = None
+_worker_target_percents = None
+
+
+def annualized_profit_percent(start_value, end_value, start_date, end_date):
+    portfolio_profit_percent = (end_value - start_value) / start_value * 100
     years = (end_date - start_date).days / 365.0
-    portfolio_profit_annual = ((1 + portfolio_profit_percent / 100) ** (1 / years) - 1) * 100
+    return ((1 + portfolio_profit_percent / 100) ** (1 / years) - 1) * 100
+
+
+def backtrade(portfolio_df, start_date, end_date):
+    portfolio_funds_data_df = load_portfolio_funds_data(portfolio_df.index, start_date, end_date, cache=panel_cache).ffill().bfill()  # 使用 bfill() 是为了防止第一行数据出现空值
+    portfolio_value_series, _ = fund_portfolio_back_trade(portfolio_df, portfolio_funds_data_df, REBALANCE_DAYS)
     
-    return portfolio_profit_annual
+    return annualized_profit_percent(portfolio_value_series.iloc[0], portfolio_value_series.iloc[-1], start_date, end_date)
+
+
+def init_shared_worker(panel_spec, target_percents, timing=False):
+    global _worker_panel, _worker_target_percents
+    _worker_panel = SharedNavPanel.attach(panel_spec)
+    _worker_target_percents = target_percents
+    init_worker_timing(timing)
+
+
+def backtrade_shared(start_date, end_date):
+    ''' 和 backtrade 相同的计算，净值数据来自共享内存中的面板 '''
+    with span('backtrade_shared.window') as window_span:
+        _, net_values = _worker_panel.window(start_date, end_date)
+        net_values = pd.DataFrame(net_values).ffill().bfill().to_numpy()  # 每个窗口单独填补空值，和 backtrade 保持一致
+        window_span.set(days=len(net_values))
+    with span('back_trade.arrays', days=len(net_values), funds=net_values.shape[1]):
+        portfolio_values, _, _ = back_trade_arrays(net_values, _worker_target_percents, REBALANCE_DAYS)
+    
+    return annualized_profit_percent(portfolio_values[0], portfolio_values[-1], start_date, end_date)
 
 
 def print_statistics(profits):
@@ -51,6 +86,9 @@ def print_statistics(profits):
     
 
 def plot_data(profits):
+    import matplotlib.pyplot as plt  # 画图的依赖只在画图时导入，进程池的子进程不需要
+    import seaborn as sns
+
      # 绘制直方图
     plt.figure(figsize=(10, 6))
     plt.subplot(2, 1, 1)  # 第一个子图
@@ -81,16 +119,40 @@ if __name__ == "__main__":
     
     profits = []
     
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        args = [(portfolio_df, start, end_date) for start in start_dates]
-        results = pool.starmap(backtrade, args)
-        profits.extend(results)
+    if TIMING:
+        timing_recorder = enable_timing(os.path.join(DATA_PATH, 'timing.jsonl'))
+    
+    if SWEEP_MODE == 'batch':
+        panel_df = load_portfolio_funds_data(portfolio_df.index, start_dates[0], end_date)
+        windows_df = rolling_windows_back_trade(portfolio_df, panel_df, REBALANCE_DAYS, [(start, end_date) for start in start_dates])
+        profits.extend(windows_df['annualized_return'].to_list())
+    elif SWEEP_MODE == 'shared':
+        panel_df = load_portfolio_funds_data(portfolio_df.index, start_dates[0], end_date)
+        with SharedNavPanel.publish(panel_df) as shared_panel, \
+                multiprocessing.Pool(processes=multiprocessing.cpu_count(), initializer=init_shared_worker, 
+                                     initargs=(shared_panel.spec, portfolio_df['target_percent'].to_numpy(), timing_enabled())) as pool:
+            results = pool.starmap(call_with_spans, [(backtrade_shared, start, end_date) for start in start_dates])
+            for profit, spans in results:
+                profits.append(profit)
+                merge_worker_spans(spans)
+    else:
+        with multiprocessing.Pool(processes=multiprocessing.cpu_count(), 
+                                  initializer=init_worker_timing, initargs=(timing_enabled(),)) as pool:
+            args = [(backtrade, portfolio_df, start, end_date) for start in start_dates]
+            results = pool.starmap(call_with_spans, args)
+            for profit, spans in results:
+                profits.append(profit)
+                merge_worker_spans(spans)
+    
+    if TIMING:
+        print(timing_recorder.report().to_string())
     
     print(profits)
     
     # profits = [6.282227734317503, 6.3695159855199135, 7.333433509488629, 9.063016346018028, 9.234762387440988, 9.272264245218853, 8.286978345165629, 8.893005106364061, 9.018246759828008, 10.1979223393182, 9.621327708363815, 8.998675737023643, 9.135995312534817, 9.620974744372068, 8.884194431507764, 8.743410852862322, 8.764684383336885, 8.69146870070412, 8.884666291006326, 8.591481310047367, 9.095467412866821, 8.230604555903586, 8.065008995677637, 8.10448707002367, 7.679704608326143, 7.656467061575012, 7.500406266843784, 7.363767543028876, 7.266452028578585, 6.409890091787918, 6.469891038283793, 6.999464575569703, 6.824571802061152, 7.07628035067005, 7.371276380742886, 8.01553538297508, 8.230958534502841, 8.155532466912675, 8.528355386938792, 8.378583218790547, 8.318633083065041, 7.94531375813845, 8.210982709875925, 8.40468549412956, 9.089577994038823, 8.596534515115707, 8.363944441491643, 8.549198344628927]
     
     # 以 start_dates 为x轴，profits 为 y轴，通过 matplot lib 绘制折线图，并添加标题和标签。
+    import matplotlib.pyplot as plt
     plt.plot(start_dates, profits, marker='o')  # 绘制折线图，并使用圆形标记点
     plt.show()
     
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+
+
+def _attach_shared_memory(name: str) -> shared_memory.SharedMemory:
+    ''' 子进程只是使用者，不负责释放共享内存。进程池的子进程和主进程共用同一个 resource_tracker，重复登记没有影响 '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedNavPanel:
+    '''
+    放在共享内存中的基金净值面板。
+
+    主进程用 publish() 把对齐好的面板写入共享内存一次，子进程通过 spec 用 attach() 零拷贝地访问，
+    每个任务只需要传递窗口的开始和结束日期。
+    '''
+
+    def __init__(self, dates_shm, values_shm, num_days, columns, owner):
+        self._dates_shm = dates_shm
+        self._values_shm = values_shm
+        self._owner = owner
+        self.columns = list(columns)
+        self.dates = np.ndarray((num_days,), dtype='datetime64[ns]', buffer=dates_shm.buf)
+        self.net_values = np.ndarray((num_days, len(self.columns)), dtype=np.float64, buffer=values_shm.buf)
+
+    @classmethod
+    def publish(cls, panel_df: pd.DataFrame):
+        ''' 把 load_portfolio_funds_data 返回的面板复制到共享内存中 '''
+        num_days, num_funds = panel_df.shape
+        # 共享内存的大小不能为 0
+        dates_shm = shared_memory.SharedMemory(create=True, size=max(num_days * 8, 1))
+        values_shm = shared_memory.SharedMemory(create=True, size=max(num_days * num_funds * 8, 1))
+        panel = cls(dates_shm, values_shm, num_days, panel_df.columns, owner=True)
+        panel.dates[:] = panel_df.index.to_numpy(dtype='datetime64[ns]')
+        panel.net_values[:] = panel_df.to_numpy(dtype=np.float64)
+        return panel
+
+    @property
+    def spec(self) -> dict:
+        ''' 传给子进程的描述信息，可以 pickle，不包含数据本身 '''
+        return dict(dates_name=self._dates_shm.name, values_name=self._values_shm.name,
+                    num_days=len(self.dates), columns=self.columns)
+
+    @classmethod
+    def attach(cls, spec: dict):
+        return cls(_attach_shared_memory(spec['dates_name']), _attach_shared_memory(spec['values_name']),
+                   spec['num_days'], spec['columns'], owner=False)
+
+    def window(self, start_date, end_date):
+        ''' [start_date, end_date] 区间的日期和净值，返回的是共享内存上的视图 '''
+        start = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(start_date), 'ns'), side='left')
+        end = np.searchsorted(self.dates, np.datetime64(pd.Timestamp(end_date), 'ns'), side='right')
+        return self.dates[start:end], self.net_values[start:end]
+
+    def window_frame(self, start_date, end_date) -> pd.DataFrame:
+        ''' 和 load_portfolio_funds_data(tickers, start_date, end_date) 相同格式的 DataFrame（数据为复制） '''
+        dates, net_values = self.window(start_date, end_date)
+        return pd.DataFrame(net_values, index=pd.DatetimeIndex(dates, name='date'), columns=self.columns)
+
+    def close(self):
+        # 先释放 numpy 视图，否则共享内存无法关闭
+        self.dates = self.net_values = None
+        self._dates_shm.close()
+        self._values_shm.close()
+        if self._owner:
+            self._dates_shm.unlink()
+            self._values_shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
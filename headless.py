@@ -0,0 +1,72 @@
+from datetime import datetime
+
+import backtrader as bt
+import numpy as np
+import pandas as pd
+
+from common import EquityAnalyzer
+from trading_calendar import TradingCalendar
+
+# 不画图的批量回测（参数扫描等）使用的运行方式：
+# - 不加 observer，不保存画图需要的数据；
+# - exactbars=1，数据、指标、策略的 line 只保留计算需要的最近几根 bar，不预加载数据，也不使用 runonce；
+# - 资金曲线只在线计算最大回撤（EquityAnalyzer(record=False)），返回一个很小的 dict。
+# 这样每次回测占用的内存是固定的，和回测区间的长短无关。
+#
+# 没有预加载时策略不能从数据源取得全部日期，需要交易日历的策略（例如 SimpleAIPStrategy）用 feed_calendar() 建立日历，
+# 通过策略的 calendar 参数传入。
+
+HEADLESS_EXACTBARS = 1
+
+
+def feed_calendar(data_df: pd.DataFrame, start_date: datetime = None, end_date: datetime = None) -> TradingCalendar:
+    ''' 和 PandasData(dataname=data_df, fromdate=start_date, todate=end_date) 的 bar 一一对应的交易日历 '''
+    days = data_df.index.normalize()
+    selected = np.ones(len(data_df), dtype=bool)
+    if start_date is not None:
+        selected &= days >= pd.Timestamp(start_date).normalize()
+    if end_date is not None:
+        selected &= days <= pd.Timestamp(end_date).normalize()
+    return TradingCalendar(data_df.index[selected])
+
+
+def run_headless(strategy,
+                 data: bt.feeds.DataBase,
+                 start_cash: float,
+                 commission: float = None,
+                 coc: bool = False,
+                 exactbars: int = HEADLESS_EXACTBARS,
+                 **strategy_params) -> dict:
+    '''
+    不画图、不保留完整 line buffer 地运行一次回测。
+
+    Parameters:
+    - strategy: bt.Strategy 子类，strategy_params 为它的参数
+    - data: 还没有加入 Cerebro 的数据源
+    - commission: 手续费率，None 表示不收手续费
+    - coc: cheat-on-close，以订单创建日的收盘价成交
+
+    Returns:
+    - dict: final_value, return_percent, max_drawdown_percent, max_drawdown_start, max_drawdown_end,
+      round_trips, winning_round_trips, bars
+    '''
+    cerebro = bt.Cerebro(stdstats=False, exactbars=exactbars)
+    cerebro.adddata(data)
+    cerebro.addstrategy(strategy, **strategy_params)
+    cerebro.broker.setcash(start_cash)
+    if commission is not None:
+        cerebro.broker.setcommission(commission=commission)
+    cerebro.broker.set_coc(coc)
+    cerebro.addanalyzer(EquityAnalyzer, _name='equity', record=False)
+
+    strat = cerebro.run()[0]
+    analysis = strat.analyzers.equity.get_analysis()
+    final_value = float(cerebro.broker.getvalue())
+    return dict(final_value=final_value,
+                return_percent=(final_value - start_cash) / start_cash * 100,
+                max_drawdown_percent=float(analysis['max_drawdown']) * 100,
+                max_drawdown_start=analysis['max_drawdown_start'],
+                max_drawdown_end=analysis['max_drawdown_end'],
+                round_trips=analysis['round_trips'],
+                winning_round_trips=analysis['winning_round_trips'],
+                bars=len(strat))
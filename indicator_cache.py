@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from native_indicators import parabolic_sar, rsi_safe, sma
+
+DATA_PATH = './data'
+CACHE_PATH = os.path.join(DATA_PATH, 'indicator_cache')  # 每个 ticker 一个子目录，每个 (指标, 参数, 数据) 一个 .npy 文件
+
+# 指标名称 -> 计算函数，函数的参数为 data_df 和指标参数
+INDICATORS = {
+    'psar': lambda data_df, **params: parabolic_sar(data_df['high'], data_df['low'], data_df['close'], **params),
+    'rsi_safe': lambda data_df, **params: rsi_safe(data_df['close'], **params),
+    'sma': lambda data_df, **params: sma(data_df['close'], **params),
+}
+
+# MonkeyStrategy 使用的指标和参数，列名同 common.IndicatorPandasData 的 lines
+MONKEY_INDICATORS = {
+    'psar': ('psar', dict(period=20, af=0.015)),
+    'rsi_safe': ('rsi_safe', dict(period=14)),
+    'sma': ('sma', dict(period=50)),
+}
+
+_loaded = {}  # 已打开的缓存文件，path -> memory-mapped 数组；文件名包含内容 hash，写入后不会再改变
+
+
+def data_hash(data_df: pd.DataFrame) -> str:
+    ''' 用日期和 high/low/close 的内容计算 hash，数据有任何变化时 hash 都会不同 '''
+    sha = hashlib.sha1()
+    sha.update(data_df.index.to_numpy(dtype='datetime64[ns]').tobytes())
+    for column in ['high', 'low', 'close']:
+        sha.update(data_df[column].to_numpy(dtype=np.float64).tobytes())
+    return sha.hexdigest()
+
+
+def cache_key(name: str, params: dict, content_hash: str) -> str:
+    return hashlib.sha1('{}|{}|{}'.format(name, json.dumps(params, sort_keys=True), content_hash).encode()).hexdigest()
+
+
+def cached_indicator(ticker: str, name: str, data_df: pd.DataFrame, content_hash: str = None, **params) -> np.ndarray:
+    '''
+    读取缓存的指标数组（memory-mapped，只读）；没有缓存时计算并写入缓存。
+
+    Parameters:
+    - name: INDICATORS 中的指标名称
+    - content_hash: 可选，data_hash(data_df) 的结果，一次取多个指标时避免重复计算
+    '''
+    content_hash = content_hash or data_hash(data_df)
+    path = os.path.join(CACHE_PATH, ticker, '{}_{}.npy'.format(name, cache_key(name, params, content_hash)))
+    if path in _loaded:
+        return _loaded[path]
+    if os.path.exists(path):
+        values = _loaded[path] = np.load(path, mmap_mode='r')
+        return values
+
+    values = np.asarray(INDICATORS[name](data_df, **params), dtype=np.float64)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())  # 多个进程可能同时计算同一个指标
+    with open(tmp_path, 'wb') as f:
+        np.save(f, values)
+    os.replace(tmp_path, path)
+    values = _loaded[path] = np.load(path, mmap_mode='r')
+    return values
+
+
+def monkey_indicators(ticker: str, data_df: pd.DataFrame) -> dict:
+    ''' MonkeyStrategy 使用的指标，列名 -> 数组 '''
+    content_hash = data_hash(data_df)
+    return {column: cached_indicator(ticker, name, data_df, content_hash=content_hash, **params)
+            for column, (name, params) in MONKEY_INDICATORS.items()}
+
+
+def add_monkey_indicators(ticker: str, data_df: pd.DataFrame) -> pd.DataFrame:
+    ''' 返回加上了 psar、rsi_safe、sma 列的 data_df 副本，可以直接用于 common.IndicatorPandasData '''
+    return data_df.assign(**monkey_indicators(ticker, data_df))
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from data_cache import read_canonical, read_fear_greed, content_hash, source_path
+from native_indicators import parabolic_sar
+
+# 每个 ticker 一个预先对齐好的行情面板：价格和 rsi（<ticker>.csv）、恐贪指数（all_fng_csv.csv）、psar（参数同 MonkeyStrategy）。
+# 面板只在输入文件内容、面板版本、psar 参数或缺失值规则改变时重新生成，保存为 data/market_panel/<ticker>/<key>/ 下的
+#   dates.npy   datetime64[ns] 交易日
+#   values.npy  float64 二维数组，一行一个交易日，列的顺序见 meta.json
+#   meta.json   列名、版本、输入文件的 hash、缺失值规则
+# 读取时 values.npy 整块 memory-mapped，作为 DataFrame 的唯一数据块，不复制。
+#
+# 缺失值规则（MISSING_VALUES）：交易日以价格文件为准，辅助序列按日期对齐到交易日，不在交易日上的日期被丢弃。
+#   'nan'   没有数据的交易日为 nan（例如 2011 年以前没有恐贪指数），策略在这些日子不会产生信号
+#   'ffill' 用之前最近一个交易日的数据填充
+# 默认全部为 'nan'，和原来按索引赋值的结果相同。
+
+DATA_PATH = './data'
+PANEL_PATH = os.path.join(DATA_PATH, 'market_panel')
+
+PANEL_VERSION = 1  # 面板的生成规则改变时加 1
+
+FEAR_GREED_FILE = 'all_fng_csv.csv'  # 同 data_cache.read_fear_greed
+PSAR_PARAMS = dict(period=20, af=0.015)  # 同 MonkeyStrategy
+
+MISSING_VALUES = {'fear_greed': 'nan', 'psar': 'nan'}
+
+_loaded = {}  # 已打开的面板，目录 -> (dates, values, columns)；目录名包含 key，写入后不会再改变
+
+
+def panel_inputs(ticker: str, missing_values: dict = None) -> dict:
+    ''' 决定面板内容的全部输入：面板版本、输入文件内容的 hash、psar 参数和缺失值规则 '''
+    return dict(version=PANEL_VERSION,
+                price=content_hash(source_path(ticker + '.csv')),
+                fear_greed=content_hash(source_path(FEAR_GREED_FILE)),
+                psar=PSAR_PARAMS,
+                missing_values={**MISSING_VALUES, **(missing_values or {})})
+
+
+def panel_key(inputs: dict) -> str:
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def _align(series: pd.Series, dates: pd.DatetimeIndex, policy: str) -> np.ndarray:
+    if policy == 'nan':
+        return series.reindex(dates).to_numpy(dtype=np.float64)
+    if policy == 'ffill':
+        return series.reindex(series.index.union(dates)).ffill().reindex(dates).to_numpy(dtype=np.float64)
+    raise ValueError('未知的缺失值规则: {}'.format(policy))
+
+
+def build_panel(ticker: str, missing_values: dict = None) -> pd.DataFrame:
+    ''' 不读写磁盘，直接生成面板，列为 <ticker>.csv 的各列、fear_greed、psar '''
+    missing_values = {**MISSING_VALUES, **(missing_values or {})}
+    panel_df = read_canonical(ticker + '.csv')
+    fear_greed = read_fear_greed()
+    panel_df['fear_greed'] = _align(fear_greed, panel_df.index, missing_values['fear_greed'])
+    psar = pd.Series(parabolic_sar(panel_df['high'], panel_df['low'], panel_df['close'], **PSAR_PARAMS), index=panel_df.index)
+    if missing_values['psar'] == 'ffill':
+        psar = psar.ffill()
+    panel_df['psar'] = psar.to_numpy(dtype=np.float64)
+    return panel_df
+
+
+def _write_panel(path: str, panel_df: pd.DataFrame, meta: dict):
+    ''' 先写到临时目录再改名，其他进程不会读到写了一半的面板 '''
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'dates.npy'), panel_df.index.to_numpy(dtype='datetime64[ns]'))
+    np.save(os.path.join(tmp_path, 'values.npy'), np.ascontiguousarray(panel_df.to_numpy(dtype=np.float64)))
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1, ensure_ascii=False)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:  # 另一个进程已经生成了同样的面板
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _remove_stale_panels(ticker: str, key: str, missing_values: dict):
+    ''' 删除同一个 ticker、同样缺失值规则的旧面板（输入或版本已经改变），其他规则的面板保留 '''
+    ticker_path = os.path.join(PANEL_PATH, ticker)
+    for old_key in os.listdir(ticker_path):
+        old_path = os.path.join(ticker_path, old_key)
+        if old_key == key or old_key.endswith('.tmp'):
+            continue
+        try:
+            with open(os.path.join(old_path, 'meta.json')) as f:
+                stale = json.load(f).get('missing_values') == missing_values
+        except (OSError, ValueError):
+            stale = True
+        if stale:
+            shutil.rmtree(old_path, ignore_errors=True)
+
+
+def load_panel(ticker: str, missing_values: dict = None) -> pd.DataFrame:
+    '''
+    读取 ticker 的行情面板，需要时先生成。返回的 DataFrame 以只读的 memory-mapped 数组为数据块，
+    可以切片、增加列，但不能原地修改已有的值。
+
+    Returns:
+    - pd.DataFrame: 日期索引，列为 open, high, low, close, adj close, volume, rsi, fear_greed, psar（全部 float64）
+    '''
+    inputs = panel_inputs(ticker, missing_values)
+    key = panel_key(inputs)
+    path = os.path.join(PANEL_PATH, ticker, key)
+    if path not in _loaded:
+        if not os.path.exists(path):
+            panel_df = build_panel(ticker, missing_values)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_panel(path, panel_df, dict(ticker=ticker, columns=list(panel_df.columns), **inputs))
+            _remove_stale_panels(ticker, key, inputs['missing_values'])
+        with open(os.path.join(path, 'meta.json')) as f:
+            columns = json.load(f)['columns']
+        _loaded[path] = (pd.DatetimeIndex(np.load(os.path.join(path, 'dates.npy')), name='date'),
+                         np.load(os.path.join(path, 'values.npy'), mmap_mode='r'),
+                         columns)
+    dates, values, columns = _loaded[path]
+    return pd.DataFrame(values, index=dates, columns=columns, copy=False)
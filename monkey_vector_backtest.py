@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from common import Signal, Loglevel
+from native_indicators import parabolic_sar, rsi_safe, sma
+from indicator_cache import monkey_indicators
+
+START_CASH = 1000000  # 和 run_strategy 相同
+
+
+def compute_indicators(data_df: pd.DataFrame, ticker: str = None) -> dict:
+    '''
+    和 compute_indicators_backtrader 相同的结果，用 native_indicators 计算，不需要 backtrader。
+    传入 ticker 时从 indicator_cache 的磁盘缓存读取，同样的数据只计算一次。
+    '''
+    first_bar = max(20, 14 + 1, 50) - 1  # psar、rsi、sma 中最长的预热期
+    if ticker is not None:
+        cached = monkey_indicators(ticker, data_df)
+        return dict(psar=cached['psar'], rsi=cached['rsi_safe'], sma=cached['sma'], first_bar=first_bar)
+    closes = data_df['close'].to_numpy(dtype=np.float64)
+    return dict(psar=parabolic_sar(data_df['high'], data_df['low'], closes, period=20, af=0.015),
+                rsi=rsi_safe(closes, period=14),
+                sma=sma(closes, period=50),
+                first_bar=first_bar)
+
+
+def compute_indicators_backtrader(data_df: pd.DataFrame) -> dict:
+    '''
+    用 backtrader 一次性（runonce 模式）计算 MonkeyStrategy 使用的指标，不运行任何交易逻辑。
+
+    Returns:
+    - dict: psar, rsi, sma 三个数组（长度和 data_df 相同，不足周期的部分为 nan），
+      first_bar 为 MonkeyStrategy.next 第一次被调用的行号（所有指标都有值的第一天）
+    '''
+    import backtrader as bt
+    from common import MyParabolicSAR, RsiFngPandasData
+
+    class IndicatorRecorder(bt.Strategy):
+        def __init__(self):
+            self.psar = MyParabolicSAR(period=20, af = 0.015)
+            self.rsi = bt.indicators.RSI_Safe(self.data.close, period=14)
+            self.sma = bt.indicators.SimpleMovingAverage(self.data.close, period=50)
+
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.adddata(RsiFngPandasData(dataname=data_df, rsi=6, fear_greed=7))
+    cerebro.addstrategy(IndicatorRecorder)
+    strat = cerebro.run()[0]
+    return dict(psar=np.array(strat.psar.lines.psar.array),
+                rsi=np.array(strat.rsi.lines.rsi.array),
+                sma=np.array(strat.sma.lines.sma.array),
+                first_bar=strat._minperiod - 1)
+
+
+def _threshold_signals(values, buy_below, sell_above):
+    ''' 小于 buy_below 为买入信号，大于 sell_above 为卖出信号，nan 没有信号 '''
+    with np.errstate(invalid='ignore'):
+        return np.where(values < buy_below, Signal.BUY_SIGNAL, np.where(values > sell_above, Signal.SELL_SIGNAL, Signal.NO_SIGNAL)).astype(np.int8)
+
+
+def psar_signals(psar, closes, sensitivity, first_bar):
+    '''
+    和 MonkeyStrategy.check_psar_indicator 相同：psar 连续 sensitivity 天在收盘价下方（上方）时给出一次买入（卖出）信号，
+    之后重新计数。psar 等于收盘价的那天不计数，也不打断连续计数。从 first_bar 开始计数。
+    '''
+    signals = np.zeros(len(closes), dtype=np.int8)
+    with np.errstate(invalid='ignore'):
+        direction = np.where(psar < closes, 1, np.where(psar > closes, -1, 0))
+    direction[:first_bar] = 0
+    counted = np.flatnonzero(direction != 0)
+    if len(counted) == 0:
+        return signals
+
+    counted_direction = direction[counted]
+    run_start = np.ones(len(counted), dtype=bool)
+    run_start[1:] = counted_direction[1:] != counted_direction[:-1]
+    run_start_positions = np.flatnonzero(run_start)
+    position_in_run = np.arange(len(counted)) - run_start_positions[np.cumsum(run_start) - 1] + 1
+    emit = position_in_run % sensitivity == 0
+    signals[counted[emit]] = np.where(counted_direction[emit] > 0, Signal.BUY_SIGNAL, Signal.SELL_SIGNAL)
+    return signals
+
+
+def monkey_signals(data_df, indicators, fear_greed=False, fear_greed_extreme_fear=25, fear_greed_extreme_greed=75,
+                   rsi=False, rsi_oversold=30, rsi_overbought=70, psar=False, psar_sensitivity=1) -> np.ndarray:
+    ''' 和 MonkeyStrategy.check_indicators 相同的多数投票，返回每天的 Signal 数组 '''
+    votes = []
+    if fear_greed:
+        votes.append(_threshold_signals(data_df['fear_greed'].to_numpy(dtype=np.float64), fear_greed_extreme_fear, fear_greed_extreme_greed))
+    if rsi:
+        votes.append(_threshold_signals(indicators['rsi'], rsi_oversold, rsi_overbought))
+    if psar:
+        votes.append(psar_signals(indicators['psar'], data_df['close'].to_numpy(dtype=np.float64), psar_sensitivity, indicators['first_bar']))
+
+    signals = np.zeros(len(data_df), dtype=np.int8)
+    if not votes:
+        return signals
+    votes = np.vstack(votes)
+    signals[(votes == Signal.BUY_SIGNAL).sum(axis=0) / len(votes) > 0.5] = Signal.BUY_SIGNAL
+    signals[(votes == Signal.SELL_SIGNAL).sum(axis=0) / len(votes) > 0.5] = Signal.SELL_SIGNAL
+    return signals
+
+
+def simulate_all_in(closes, signals, first_bar, start_cash=START_CASH, follow_signals=True):
+    '''
+    把信号数组变成资金曲线，规则和 MonkeyStrategy.next 相同：
+    first_bar 当天全仓买入（整数股），之后买入信号时用全部现金买入整数股，卖出信号时清仓；
+    cheat-on-close，订单以信号当天的收盘价成交；最后一天产生的订单不会成交。
+
+    只在交易发生的日子上循环，两次交易之间的资金曲线用数组直接计算。
+
+    Returns:
+    - values (np.ndarray): 每天的账户总价值
+    - trades (list): (行号, 成交股数) 列表，负数为卖出
+    '''
+    closes = np.asarray(closes, dtype=np.float64)
+    num_bars = len(closes)
+    last_order_bar = num_bars - 2  # 最后一天的订单不会成交
+
+    buy_bars = np.flatnonzero(signals == Signal.BUY_SIGNAL) if follow_signals else np.array([], dtype=int)
+    sell_bars = np.flatnonzero(signals == Signal.SELL_SIGNAL) if follow_signals else np.array([], dtype=int)
+    buy_bars = buy_bars[buy_bars <= last_order_bar]
+    sell_bars = sell_bars[sell_bars <= last_order_bar]
+
+    cash, shares = float(start_cash), 0
+    trades = []
+    if first_bar <= last_order_bar:
+        size = int(cash / closes[first_bar])
+        if size > 0:
+            cash -= size * closes[first_bar]
+            shares = size
+            trades.append((first_bar, size))
+    # first_bar 当天的其他信号：再次买入会因现金不足被拒绝，卖出时还没有持仓，所以都没有效果
+    bar = first_bar
+
+    while True:
+        next_sell = sell_bars[np.searchsorted(sell_bars, bar, side='right'):][:1] if shares > 0 else []
+        candidate_buys = buy_bars[np.searchsorted(buy_bars, bar, side='right'):]
+        affordable = np.flatnonzero(closes[candidate_buys] <= cash)[:1]  # 买得起至少一股
+        next_buy = candidate_buys[affordable]
+        if len(next_sell) == 0 and len(next_buy) == 0:
+            break
+        if len(next_buy) == 0 or (len(next_sell) > 0 and next_sell[0] < next_buy[0]):
+            bar = next_sell[0]
+            cash += shares * closes[bar]
+            trades.append((bar, -shares))
+            shares = 0
+        else:
+            bar = next_buy[0]
+            size = int(cash / closes[bar])
+            cash -= size * closes[bar]
+            shares += size
+            trades.append((bar, size))
+
+    # 每天的现金和持股数在交易日之间保持不变
+    cash_path = np.full(num_bars, float(start_cash))
+    shares_path = np.zeros(num_bars)
+    running_cash, running_shares = float(start_cash), 0
+    for trade_bar, size in trades:
+        running_cash -= size * closes[trade_bar]
+        running_shares += size
+        cash_path[trade_bar:] = running_cash
+        shares_path[trade_bar:] = running_shares
+    values = cash_path + shares_path * closes
+    return values, trades
+
+
+def run_vector_strategy(data_df: pd.DataFrame,
+                        start_date: datetime,
+                        end_date: datetime,
+                        follow_signals: bool = True,
+                        indicators: dict = None,
+                        ticker: str = None,
+                        **params) -> dict:
+    '''
+    不使用 backtrader 的 MonkeyStrategy 快速回测，参数和返回值同 bt_Monkey_spy_qqq.run_strategy。
+    data_df 为 load_strategy_data 加载的全部数据；indicators 可以传入已经计算好的指标（需要和区间切片对应）；
+    传入 ticker 时指标从磁盘缓存读取，扫描阈值参数时不会重复计算指标。
+    '''
+    data_df = data_df[(data_df.index >= start_date) & (data_df.index <= end_date)]
+    if indicators is None:
+        indicators = compute_indicators(data_df, ticker=ticker)
+    closes = data_df['close'].to_numpy(dtype=np.float64)
+    signals = monkey_signals(data_df, indicators, **params)
+    values, trades = simulate_all_in(closes, signals, indicators['first_bar'], follow_signals=follow_signals)
+
+    # 和 common.EquityAnalyzer 相同，从策略第一次运行的那天开始计算回撤
+    tracked_values = values[indicators['first_bar']:]
+    running_peak = np.maximum.accumulate(tracked_values)
+    max_drawdown = ((running_peak - tracked_values) / running_peak).max() if len(tracked_values) > 0 else 0.0
+
+    return dict(return_percent=(values[-1] - START_CASH) / START_CASH * 100,
+                max_drawdown_percent=max_drawdown * 100,
+                benchmark_percent=(closes[-1] / closes[0] - 1) * 100,
+                trades=len(trades),
+                values=pd.Series(values, index=data_df.index))
+
+
+def check_cerebro_parity(configs, ticker: str = 'spy', tolerance: float = 0.01) -> pd.DataFrame:
+    '''
+    用同样的配置分别运行 run_vector_strategy 和 backtrader 的 run_strategy，比较最终资金。
+
+    Parameters:
+    - configs: dict 列表，每个 dict 包括 start_date, end_date 以及 run_strategy 的策略参数
+
+    Returns:
+    - pd.DataFrame: 每个配置一行，包括两边的最终资金、差值，以及是否一致（差值不超过 tolerance）
+    '''
+    from bt_Monkey_spy_qqq import load_strategy_data, run_strategy
+
+    data_df = load_strategy_data(ticker)
+    rows = []
+    for config in configs:
+        config = {'follow_signals': True, **config}
+        vector_result = run_vector_strategy(data_df, **config)
+        cerebro_result = run_strategy(ticker=ticker, loglevel=Loglevel.NONE, data_df=data_df, **config)
+        vector_value = START_CASH * (1 + vector_result['return_percent'] / 100)
+        cerebro_value = START_CASH * (1 + cerebro_result['return_percent'] / 100)
+        rows.append(dict(**config, vector_value=vector_value, cerebro_value=cerebro_value,
+                         difference=vector_value - cerebro_value,
+                         max_drawdown_difference=vector_result['max_drawdown_percent'] - cerebro_result['max_drawdown_percent'],
+                         match=abs(vector_value - cerebro_value) <= tolerance))
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    periods = [(datetime(2020,3,16), datetime(2022,1,4)), (datetime(2022,1,3), datetime(2022,10,25)), (datetime(2006,1,31), datetime(2012,6,12))]
+    indicator_params = [dict(fear_greed=True), dict(rsi=True), dict(psar=True), dict(psar=True, psar_sensitivity=2),
+                        dict(fear_greed=True, rsi=True, psar=True), dict(follow_signals=False)]
+    configs = [dict(start_date=start, end_date=end, **params) for start, end in periods for params in indicator_params]
+
+    parity_df = check_cerebro_parity(configs)
+    print(parity_df.drop(columns=['start_date', 'end_date']).fillna('').to_string())
+    print('一致: {}/{}'.format(parity_df['match'].sum(), len(parity_df)))
@@ -0,0 +1,180 @@
+import math
+from collections import deque
+
+import numpy as np
+
+# 不依赖 backtrader 的指标实现，计算方法和 backtrader 的 ParabolicSAR / RSI_Safe / SimpleMovingAverage 相同，
+# 不足周期的部分为 nan。每个指标有两种形式：对整个数组计算的函数，以及逐根 bar 更新的 update(bar) 类。
+
+
+def _field(bar, name):
+    return bar[name] if not hasattr(bar, name) else getattr(bar, name)
+
+
+def sma(closes, period: int = 50) -> np.ndarray:
+    ''' 简单移动平均，同 bt.indicators.SimpleMovingAverage '''
+    closes = np.asarray(closes, dtype=np.float64)
+    result = np.full(len(closes), np.nan)
+    if len(closes) >= period:
+        result[period - 1:] = np.lib.stride_tricks.sliding_window_view(closes, period).sum(axis=1) / period
+    return result
+
+
+def rsi_safe(closes, period: int = 14, safehigh: float = 100.0, safelow: float = 50.0) -> np.ndarray:
+    '''
+    同 bt.indicators.RSI_Safe：涨跌幅用 Wilder 平滑（SMMA，以前 period 个值的算术平均为初值），
+    平均跌幅为 0 时，平均涨幅不为 0 则 RSI 为 safehigh，都为 0 则为 safelow。
+    '''
+    closes = np.asarray(closes, dtype=np.float64)
+    result = np.full(len(closes), np.nan)
+    if len(closes) <= period:
+        return result
+
+    changes = np.diff(closes)
+    updays = np.maximum(changes, 0.0).tolist()
+    downdays = np.maximum(-changes, 0.0).tolist()
+    alpha = 1.0 / period
+    alpha1 = 1.0 - alpha
+
+    maup = math.fsum(updays[:period]) / period
+    madown = math.fsum(downdays[:period]) / period
+    values = [_rsi_value(maup, madown, safehigh, safelow)]
+    for up, down in zip(updays[period:], downdays[period:]):
+        maup = maup * alpha1 + up * alpha
+        madown = madown * alpha1 + down * alpha
+        values.append(_rsi_value(maup, madown, safehigh, safelow))
+    result[period:] = values
+    return result
+
+
+def _rsi_value(maup, madown, safehigh, safelow):
+    if madown == 0.0:
+        return safelow if maup == 0.0 else safehigh
+    return 100.0 - 100.0 / (1.0 + maup / madown)
+
+
+def parabolic_sar(highs, lows, closes, period: int = 20, af: float = 0.015, afmax: float = 0.20) -> np.ndarray:
+    ''' 同 bt.indicators.ParabolicSAR（MyParabolicSAR），从第 2 根 bar 开始计算，前 period - 1 根为 nan '''
+    psar = ParabolicSAR(period=period, af=af, afmax=afmax)
+    update = psar.update_values
+    result = [update(high, low, close) for high, low, close in
+              zip(np.asarray(highs, dtype=np.float64).tolist(), np.asarray(lows, dtype=np.float64).tolist(), np.asarray(closes, dtype=np.float64).tolist())]
+    return np.array(result, dtype=np.float64)
+
+
+class SMA:
+    ''' 逐根 bar 更新的简单移动平均 '''
+
+    def __init__(self, period: int = 50):
+        self.period = period
+        self._window = deque(maxlen=period)
+
+    def update(self, bar) -> float:
+        return self.update_value(_field(bar, 'close'))
+
+    def update_value(self, close) -> float:
+        self._window.append(close)
+        if len(self._window) < self.period:
+            return math.nan
+        return math.fsum(self._window) / self.period
+
+
+class RSI:
+    ''' 逐根 bar 更新的 RSI_Safe '''
+
+    def __init__(self, period: int = 14, safehigh: float = 100.0, safelow: float = 50.0):
+        self.period = period
+        self.safehigh = safehigh
+        self.safelow = safelow
+        self._prev_close = None
+        self._seed_ups = []
+        self._seed_downs = []
+        self._maup = None
+        self._madown = None
+
+    def update(self, bar) -> float:
+        return self.update_value(_field(bar, 'close'))
+
+    def update_value(self, close) -> float:
+        prev_close, self._prev_close = self._prev_close, close
+        if prev_close is None:
+            return math.nan
+        up = max(close - prev_close, 0.0)
+        down = max(prev_close - close, 0.0)
+
+        if self._maup is None:  # 还在积累初值
+            self._seed_ups.append(up)
+            self._seed_downs.append(down)
+            if len(self._seed_ups) < self.period:
+                return math.nan
+            self._maup = math.fsum(self._seed_ups) / self.period
+            self._madown = math.fsum(self._seed_downs) / self.period
+        else:
+            alpha = 1.0 / self.period
+            self._maup = self._maup * (1.0 - alpha) + up * alpha
+            self._madown = self._madown * (1.0 - alpha) + down * alpha
+        return _rsi_value(self._maup, self._madown, self.safehigh, self.safelow)
+
+
+class ParabolicSAR:
+    ''' 逐根 bar 更新的 ParabolicSAR，update 返回当天的 psar '''
+
+    def __init__(self, period: int = 20, af: float = 0.015, afmax: float = 0.20):
+        self.period = period
+        self.af = af
+        self.afmax = afmax
+        self._bars = 0
+        self._prev_high = self._prev_low = self._prev_close = None
+        # 为下一根 bar 准备好的状态：trend（True 为上涨）, sar, ep, af
+        self._trend = self._sar = self._ep = self._af = None
+
+    def update(self, bar) -> float:
+        return self.update_values(_field(bar, 'high'), _field(bar, 'low'), _field(bar, 'close'))
+
+    def update_values(self, high, low, close) -> float:
+        self._bars += 1
+        prev_high, prev_low, prev_close = self._prev_high, self._prev_low, self._prev_close
+        self._prev_high, self._prev_low, self._prev_close = high, low, close
+        if self._bars == 1:
+            return math.nan
+
+        if self._bars == 2:  # 第二根 bar 开始计算，初始趋势取反，下面会立即反转
+            self._sar = (high + low) / 2.0
+            self._af = self.af
+            if close >= prev_close:
+                self._trend, self._ep = False, prev_low
+            else:
+                self._trend, self._ep = True, prev_high
+
+        trend, sar = self._trend, self._sar
+        if (trend and sar >= low) or (not trend and sar <= high):  # 反转
+            trend = not trend
+            sar = self._ep
+            ep = high if trend else low
+            af = self.af
+        else:
+            ep = self._ep
+            af = self._af
+
+        psar = sar
+
+        if trend:
+            if high > ep:
+                ep = high
+                af = min(af + self.af, self.afmax)
+        else:
+            if low < ep:
+                ep = low
+                af = min(af + self.af, self.afmax)
+
+        sar = sar + af * (ep - sar)  # 明天的 sar
+
+        if trend:
+            if sar > low or sar > prev_low:
+                sar = min(low, prev_low)
+        else:
+            if sar < high or sar < prev_high:
+                sar = max(high, prev_high)
+
+        self._trend, self._sar, self._ep, self._af = trend, sar, ep, af
+        return psar if self._bars >= self.period else math.nan
@@ -0,0 +1,153 @@
+import json
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+# 可选的分阶段计时。默认关闭，span() 几乎没有开销；调用 enable_timing() 之后，
+# 每个 span 记录一条 {name, seconds, pid, 计数...}，可以写成 JSON lines 文件，也可以用 report() 汇总。
+#
+#   recorder = enable_timing('timing.jsonl')
+#   run_strategy(...)
+#   print(recorder.report())
+#
+# 进程池的子进程各自记录，任务结束时用 drain() 把记录交回主进程，主进程用 extend() 合并。
+
+_recorder = None  # 当前进程的记录器，None 表示没有开启计时
+
+
+class TimingRecorder:
+    def __init__(self, jsonl_path: str = None):
+        self.jsonl_path = jsonl_path
+        self.spans = []
+
+    def record(self, name: str, seconds: float, **counts):
+        self.extend([dict(name=name, seconds=seconds, pid=os.getpid(), **counts)])
+
+    def extend(self, spans):
+        ''' 加入已经记录好的 span（例如子进程 drain() 返回的），有 jsonl_path 时同时追加到文件 '''
+        spans = list(spans)
+        self.spans.extend(spans)
+        if self.jsonl_path and spans:
+            with open(self.jsonl_path, 'a') as f:
+                for span_record in spans:
+                    f.write(json.dumps(span_record, default=str) + '\n')
+
+    def drain(self) -> list:
+        ''' 取出并清空已经记录的 span，子进程在每个任务结束时调用 '''
+        spans, self.spans = self.spans, []
+        return spans
+
+    def report(self) -> pd.DataFrame:
+        '''
+        按阶段汇总：calls, total_s, mean_s, max_s, processes（参与的进程数），以及各数值计数的总和，按 total_s 从大到小排序
+        '''
+        if not self.spans:
+            return pd.DataFrame(columns=['calls', 'total_s', 'mean_s', 'max_s', 'processes'])
+        spans_df = pd.DataFrame(self.spans)
+        grouped = spans_df.groupby('name', sort=False)
+        report_df = pd.DataFrame({'calls': grouped.size(), 'total_s': grouped['seconds'].sum(), 'mean_s': grouped['seconds'].mean(),
+                                  'max_s': grouped['seconds'].max(), 'processes': grouped['pid'].nunique()})
+        # 只汇总数值计数，ticker 等标签列不参与
+        count_columns = list(spans_df.drop(columns=['name', 'seconds', 'pid']).select_dtypes('number').columns)
+        if count_columns:
+            report_df = report_df.join(grouped[count_columns].sum(min_count=1))
+        return report_df.sort_values('total_s', ascending=False)
+
+
+class _Span:
+    def __init__(self, counts):
+        self.counts = counts
+
+    def set(self, **counts):
+        ''' 在 span 结束前补充计数，例如读取完成后才知道的行数 '''
+        self.counts.update(counts)
+
+
+class _NullSpan:
+    def set(self, **counts):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable_timing(jsonl_path: str = None) -> TimingRecorder:
+    ''' 开启当前进程的计时，返回记录器；jsonl_path 不为空时每个 span 结束后追加一行 JSON '''
+    global _recorder
+    _recorder = TimingRecorder(jsonl_path)
+    return _recorder
+
+
+def disable_timing():
+    global _recorder
+    _recorder = None
+
+
+def timing_enabled() -> bool:
+    return _recorder is not None
+
+
+def get_recorder() -> TimingRecorder:
+    return _recorder
+
+
+def record(name: str, seconds: float, **counts):
+    ''' 记录一个已经测量好的阶段（开始和结束不在同一个代码块中时使用），没有开启计时时忽略 '''
+    if _recorder is not None:
+        _recorder.record(name, seconds, **counts)
+
+
+@contextmanager
+def span(name: str, **counts):
+    ''' 记录 with 代码块的耗时和计数，没有开启计时时什么也不做 '''
+    if _recorder is None:
+        yield _NULL_SPAN
+        return
+    current = _Span(dict(counts))
+    start_time = time.perf_counter()
+    try:
+        yield current
+    finally:
+        _recorder.record(name, time.perf_counter() - start_time, **current.counts)
+
+
+def init_worker_timing(enabled: bool):
+    ''' 进程池 initializer 中调用：主进程开启了计时，子进程也开启（只在内存中记录，由主进程统一写文件） '''
+    if enabled:
+        enable_timing()
+    else:
+        disable_timing()
+
+
+def drain_worker_spans() -> list:
+    ''' 子进程任务结束时调用，返回本任务记录的 span；没有开启计时时返回空列表 '''
+    return _recorder.drain() if _recorder is not None else []
+
+
+def call_with_spans(function, *args):
+    ''' 进程池任务的包装：在子进程中运行 function(*args)，返回 (结果, 本任务记录的 span) '''
+    return function(*args), drain_worker_spans()
+
+
+def merge_worker_spans(spans):
+    ''' 主进程中合并子进程交回的 span '''
+    if _recorder is not None and spans:
+        _recorder.extend(spans)
+
+
+def starmap_with_spans(function, args, processes: int = 1) -> list:
+    '''
+    对 args 中的每组参数运行 function(*arg)，按顺序返回结果。processes 大于 1 时使用进程池，
+    子进程按主进程是否开启计时来初始化，各任务记录的 span 合并回主进程。
+    '''
+    if processes <= 1:
+        return [function(*arg) for arg in args]
+    results = []
+    with multiprocessing.Pool(processes=processes, initializer=init_worker_timing, initargs=(timing_enabled(),)) as pool:
+        for result, spans in pool.starmap(call_with_spans, [(function,) + tuple(arg) for arg in args]):
+            results.append(result)
+            merge_worker_spans(spans)
+    return results
@@ -1,14 +1,11 @@
 from datetime import datetime, timedelta
-import matplotlib.ticker as ticker
-import backtrader as bt
 
-import matplotlib.pyplot as plt
-import akshare as ak
 import pandas as pd
+import numpy as np
 
-import os
+import warnings
 
-DATA_PATH = './data'
+from market_panel import load_panel
 
 today = datetime(2023,11,24)  ## datetime.now().date()   #.strftime('%Y-%m-%d')
 
@@ -18,87 +15,149 @@ three_yeas_ago = today - timedelta(days=3*365)
 one_year_ago = today - timedelta(days=365)
 
 
-def calc(data_df, years, interval):
-    start_date = today - timedelta(days=years*365)
-    end_date = today
-    data_df = data_df[(data_df.index >= pd.to_datetime(start_date)) & (data_df.index <= pd.to_datetime(end_date))]
-    
-    closes_list = data_df['close'].to_list()
-    fng_list = data_df['fear_greed'].to_list()
-    rsi_list = data_df['rsi'].to_list()
-    psar_list = data_df['psar'].to_list()
-    dates_list = data_df.index
-    profits = []
-    buying_dates_win = pd.Series()
-    buying_dates_lose = pd.Series()
-    
-    signal_tag = 0
-    
-    for i in range(len(closes_list) - interval):
-        
-        # if (fng_list[i] >= 75):
-        # if (fng_list[i] <= 25):
-        # if (rsi_list[i] >= 70):
-        # if (rsi_list[i] <= 30):
-        
-        # if (psar_list[i] < closes_list[i]): # psar 买入信号
-        if (psar_list[i] > closes_list[i]): # psar 卖出信号
-            signal_tag = signal_tag + 1
-            if (signal_tag == 2) : # & (rsi_list[i] > 60) :
-                profit_rate = (closes_list[i+interval] - closes_list[i])/closes_list[i]
-                profits.append(profit_rate)
-                if profit_rate > 0:
-                    buying_dates_win[dates_list[i]] = closes_list[i]
-                else:
-                    buying_dates_lose[dates_list[i]] = closes_list[i]
-                print('买入时间：{}  当天价格：{:.2f} 当天恐贪指数{} rsi {}, {}交易日后 {} 价格: {:.2f}, 收益率为 {:.2f}%'.format(
-                    dates_list[i].strftime('%Y-%m-%d'), closes_list[i], fng_list[i], rsi_list[i], interval, dates_list[i+interval].strftime('%Y-%m-%d'), closes_list[i+interval], profit_rate*100) )
-        else:
-            signal_tag = 0
-        
-    average_profit = sum(profits)/len(profits)
-    
-    positive_profit_list = [i for i in profits if i >= 0]    
-    negative_profit_list = [i for i in profits if i < 0] 
-    
-    positive_days = len(positive_profit_list)
-    # negative_days = len(negative_profit_list)
-    
-    max_loss = min(profits)
-    max_win = max(profits)
+def load_analysis_data(ticker: str = 'qqq') -> pd.DataFrame:
+    ''' 价格、rsi、恐贪指数，以及直接计算的 psar（参数同 MonkeyStrategy），来自预先对齐好的行情面板（见 market_panel） '''
+    return load_panel(ticker)
+
+
+def default_signals(data_df: pd.DataFrame) -> dict:
+    '''
+    常用的信号定义，信号名称 -> 条件，条件为布尔数组，或者 (布尔数组, n) 表示条件连续成立的第 n 天
+    （条件不成立时重新计数，同 calc 原来的 signal_tag 计数器）
+    '''
+    closes = data_df['close']
+    return {
+        '全部交易日': np.ones(len(data_df), dtype=bool),
+        '恐贪指数 <= 25': data_df['fear_greed'] <= 25,
+        '恐贪指数 >= 75': data_df['fear_greed'] >= 75,
+        'RSI <= 30': data_df['rsi'] <= 30,
+        'RSI >= 70': data_df['rsi'] >= 70,
+        'psar 买入信号': data_df['psar'] < closes,
+        'psar 买入信号首次出现': (data_df['psar'] < closes, 1),
+        'psar 卖出信号': data_df['psar'] > closes,
+        'psar 卖出信号首次出现': (data_df['psar'] > closes, 1),
+        'psar 卖出信号第二天': (data_df['psar'] > closes, 2),
+    }
+
+
+def _signal_masks(signals: dict, start: int, end: int) -> np.ndarray:
+    ''' 每个信号在 [start, end) 区间内的触发日，连续计数从 start 开始，返回 (信号数, 天数) 的布尔矩阵 '''
+    masks = np.zeros((len(signals), end - start), dtype=bool)
+    for row, condition in enumerate(signals.values()):
+        streak = None
+        if isinstance(condition, tuple):
+            condition, streak = condition
+        condition = np.asarray(condition, dtype=bool)[start:end]
+        if streak is None:
+            masks[row] = condition
+            continue
+        days = np.arange(len(condition))
+        last_false = np.maximum.accumulate(np.where(condition, -1, days))
+        masks[row] = condition & (days - last_false == streak)  # 以当天结束的连续成立天数等于 streak
+    return masks
+
+
+def forward_returns(closes, horizons) -> np.ndarray:
+    ''' (天数, 周期数) 的矩阵：第 i 天买入，horizons[j] 个交易日后的收益率，超出数据范围为 nan '''
+    closes = np.asarray(closes, dtype=np.float64)
+    returns = np.full((len(closes), len(horizons)), np.nan)
+    for column, horizon in enumerate(horizons):
+        if horizon < len(closes):
+            returns[:len(closes) - horizon, column] = (closes[horizon:] - closes[:len(closes) - horizon]) / closes[:len(closes) - horizon]
+    return returns
+
+
+def event_study(data_df: pd.DataFrame, signals: dict, years_options, interval_options, end_date: datetime = today) -> pd.DataFrame:
+    '''
+    对每个 (信号, 回看年数, 持有交易日数) 统计信号出现当天买入、持有 interval 个交易日的收益，
+    结果和对每个组合调用一次 calc 相同，但所有信号和持有期在一次矩阵运算中完成，不画图、不逐条打印。
+
+    Parameters:
+    - signals (dict): 信号名称 -> 条件，见 default_signals
+    - years_options: 回看年数列表，区间为 [end_date - years*365 天, end_date]
+    - interval_options: 持有的交易日数列表
+
+    Returns:
+    - pd.DataFrame: 每个 (signal, years, interval) 一行，包括 count（买点出现次数）, mean_percent, win_rate_percent（收益 >= 0 的比例）,
+      max_gain_percent, max_loss_percent
+    '''
+    dates = data_df.index
+    closes = data_df['close'].to_numpy(dtype=np.float64)
+    end = np.searchsorted(dates, pd.to_datetime(end_date), side='right')
+    returns = forward_returns(closes[:end], interval_options)  # 只使用 end_date 之前的价格
+    names = list(signals.keys())
+
+    results = []
+    for years in years_options:
+        start = np.searchsorted(dates, pd.to_datetime(end_date - timedelta(days=years*365)), side='left')
+        masks = _signal_masks(signals, start, end)               # (信号数, 天数)
+        window_returns = returns[start:end]                       # (天数, 周期数)
+        valid = ~np.isnan(window_returns)
+        filled_returns = np.where(valid, window_returns, 0.0)
+
+        counts = masks.astype(np.float64) @ valid                 # (信号数, 周期数)
+        sums = masks.astype(np.float64) @ filled_returns
+        wins = masks.astype(np.float64) @ (valid & (filled_returns >= 0))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+            win_rates = wins / counts
+        # 最大盈利/损失按信号逐个取买点的收益，避免 (信号数, 天数, 周期数) 的大数组；没有买点的组合为 nan
+        max_gains = np.full(counts.shape, np.nan)
+        max_losses = np.full(counts.shape, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            for row in range(len(names)):
+                hit_returns = window_returns[masks[row]]
+                if len(hit_returns) > 0:
+                    max_gains[row] = np.nanmax(hit_returns, axis=0)
+                    max_losses[row] = np.nanmin(hit_returns, axis=0)
+
+        for row, name in enumerate(names):
+            for column, interval in enumerate(interval_options):
+                results.append(dict(signal=name, years=years, interval=interval, count=int(counts[row, column]),
+                                    mean_percent=means[row, column]*100, win_rate_percent=win_rates[row, column]*100,
+                                    max_gain_percent=max_gains[row, column]*100, max_loss_percent=max_losses[row, column]*100))
+    return pd.DataFrame(results)
+
+
+def calc(data_df, years, interval, signal=None, plotting=True):
+    '''
+    打印一个信号在 years 年内、持有 interval 个交易日的统计，plotting 为 True 时画出买点（盈利为红色，亏损为绿色）。
+    signal 的格式同 default_signals 中的条件，默认为 psar 卖出信号连续出现的第二天。
+    '''
+    if signal is None:
+        signal = (data_df['psar'] > data_df['close'], 2)
+    stats = event_study(data_df, {'signal': signal}, [years], [interval]).iloc[0]
     
     print("{}年内，买点出现次数:{}, {}个交易日内，平均利润：{:.2f}%, 盈利概率: {:.2f}%, 最大盈利：{:.2f}%, 最大损失：{:.2f}%".format(
-        years, len(profits), interval, average_profit*100, positive_days/len(profits)*100, max_win*100, max_loss*100))
+        years, stats['count'], interval, stats['mean_percent'], stats['win_rate_percent'], stats['max_gain_percent'], stats['max_loss_percent']))
     
-    data_s = data_df['close']
-    psar_s = data_df['psar']
+    if not plotting:
+        return stats
+
+    import matplotlib.pyplot as plt  # 只在画图时导入
+    start = np.searchsorted(data_df.index, pd.to_datetime(today - timedelta(days=years*365)), side='left')
+    end = np.searchsorted(data_df.index, pd.to_datetime(today), side='right')
+    window_df = data_df.iloc[start:end]
+    hits = np.flatnonzero(_signal_masks({'signal': signal}, start, end)[0])
+    hits = hits[hits < len(window_df) - interval]
+    closes = window_df['close'].to_numpy()
+    profits = (closes[hits + interval] - closes[hits]) / closes[hits]
+    buying_dates_win = window_df['close'].iloc[hits[profits > 0]]
+    buying_dates_lose = window_df['close'].iloc[hits[profits <= 0]]
     
     plt.scatter(buying_dates_win.index, buying_dates_win, marker='^', color='red', s=40)
     plt.scatter(buying_dates_lose.index, buying_dates_lose, marker='v', color='green', s=40)
     
-    data_s.plot()
-    plt.scatter(psar_s.index, psar_s, marker='o', s=3, color='grey')   
+    window_df['close'].plot()
+    plt.scatter(window_df.index, window_df['psar'], marker='o', s=3, color='grey')   
     plt.show()
-    
-
+    return stats
 
 
 if __name__ == '__main__':
     
-    data_df = pd.read_csv(os.path.join(DATA_PATH, 'qqq.csv'))
-    data_df['date'] = pd.to_datetime(data_df['date'], format='%Y-%m-%d') 
-    data_df.set_index('date', inplace=True)
-        
-    fear_greed_index_df = pd.read_csv(os.path.join(DATA_PATH, 'all_fng_csv.csv'))
-    fear_greed_index_df.rename(columns={'Date': 'date'}, inplace=True)
-    fear_greed_index_df['date'] = pd.to_datetime(fear_greed_index_df['date'], format='%Y-%m-%d') 
-    fear_greed_index_df.set_index('date', inplace=True)
-    data_df['fear_greed'] = fear_greed_index_df['Fear Greed']
-    
-    psar_df = pd.read_csv(os.path.join(DATA_PATH, 'qqq_psar.csv'))
-    psar_df['date'] = pd.to_datetime(psar_df['date'], format='%Y-%m-%d') 
-    psar_df.set_index('date', inplace=True)
-    data_df['psar'] = psar_df['psar']
+    data_df = load_analysis_data('qqq')
 
     years_options = [3]
     interval_options = [8]
@@ -107,6 +166,10 @@ if __name__ == '__main__':
         for years in years_options:
             calc(data_df=data_df, years=years, interval=interval)
     
+    # 所有信号 × 回看年数 × 持有期一次算完
+    study_df = event_study(data_df, default_signals(data_df), years_options=[1, 3, 5, 10], interval_options=[7, 22, 66])
+    print(study_df.round(2).to_string())
+    
             
     # data_df_plot = pd.DataFrame()
     # data_df_plot.index = data_df.index
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+# backtrader 的日期数值为公历序数（0001-01-01 为 1），1970-01-01 的序数
+_UNIX_EPOCH_ORDINAL = 719163
+
+
+class TradingCalendar:
+    '''
+    交易日历索引：对一组交易日（一个数据源的全部 bar）预先计算每周、每月、每季度、每年的第一个和最后一个交易日，
+    策略和向量化计算直接按行号查询，不需要在每根 bar 上比较日期。
+
+    第一个交易日为和前一个交易日不在同一周期的日子，第 0 行不算（数据可能从周期中间开始）；
+    最后一个交易日为和后一个交易日不在同一周期的日子，最后一行不算。
+    注意 is_last_trading_day 用到了下一个交易日的日期，只适用于数据已经全部加载的回测。
+    '''
+
+    PERIODS = {'week': 'W', 'month': 'M', 'quarter': 'Q', 'year': 'Y'}
+
+    def __init__(self, dates):
+        self.dates = pd.DatetimeIndex(dates)
+        self._first_days = {}
+        self._last_days = {}
+        self._is_first = {}
+        self._is_last = {}
+        for period, freq in self.PERIODS.items():
+            keys = self.dates.to_period(freq).asi8
+            changes = np.flatnonzero(keys[1:] != keys[:-1])
+            self._first_days[period] = changes + 1
+            self._last_days[period] = changes
+            is_first = np.zeros(len(self.dates), dtype=bool)
+            is_first[changes + 1] = True
+            is_last = np.zeros(len(self.dates), dtype=bool)
+            is_last[changes] = True
+            # list 的下标访问比 numpy 标量快，在 next() 中逐根 bar 调用
+            self._is_first[period] = is_first.tolist()
+            self._is_last[period] = is_last.tolist()
+
+    @classmethod
+    def from_feed(cls, data):
+        '''
+        用 backtrader 数据源已经预加载的全部日期建立日历，在策略的 __init__ 中调用。
+        数据源没有预加载（例如 exactbars 模式）时，需要用数据的日期直接建立 TradingCalendar 并通过策略参数传入。
+        '''
+        nums = np.asarray(data.datetime.array, dtype=np.float64)
+        if len(nums) == 0:
+            raise ValueError('数据源没有预加载，请用 TradingCalendar(dates) 建立日历')
+        return cls((np.floor(nums).astype(np.int64) - _UNIX_EPOCH_ORDINAL).astype('datetime64[D]'))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def first_days(self, period: str = 'month') -> np.ndarray:
+        ''' 每个周期第一个交易日的行号 '''
+        return self._first_days[period]
+
+    def last_days(self, period: str = 'month') -> np.ndarray:
+        ''' 每个周期最后一个交易日的行号 '''
+        return self._last_days[period]
+
+    def is_first_trading_day(self, i: int, period: str = 'month') -> bool:
+        return self._is_first[period][i]
+
+    def is_last_trading_day(self, i: int, period: str = 'month') -> bool:
+        return self._is_last[period][i]